@@ -1,5 +1,9 @@
+import time
+STARTUP_STARTED = time.perf_counter()
+
 import discord
 from discord.ext import commands
+from aiohttp import web
 import requests
 import json
 import os
@@ -9,28 +13,258 @@ import asyncio
 from datetime import datetime, timezone
 import random
 import string
+import functools
+import sys
+import socket
+import struct
+import contextlib
+import signal
+import sqlite3
+import contextvars
+import threading
+import gzip
+import gc
+import hashlib
+import bisect
+import secrets
+from collections import deque
+
+# Optional faster encoders for user data snapshots
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Startup phases as (name, seconds since the previous phase), reported once the users are loaded and the gateway is ready
+startup_phases = []
+startup_last_mark = STARTUP_STARTED
+
+def mark_startup_phase(name):
+    global startup_last_mark
+    now = time.perf_counter()
+    startup_phases.append((name, now - startup_last_mark))
+    startup_last_mark = now
+
+mark_startup_phase("imports")
+
+# Settings come from CONFIG_FILE, and BOT_<NAME> environment variables override the file
+CONFIG_FILE = os.environ.get("BOT_CONFIG", "config.json")
+
+def parse_list(value):
+    if isinstance(value, str):
+        return [item.strip() for item in value.split(",") if item.strip()]
+    return list(value)
+
+def parse_bool(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    return bool(value)
+
+def parse_rate(value):
+    count, per = parse_list(value)
+    return (int(count), int(per))
+
+def parse_optional_int(value):
+    return int(value) if value not in (None, "", "none") else None
+
+def parse_prices(value):
+    """Prices as a dict, or from the environment as NAME=credits pairs separated by commas"""
+    if isinstance(value, str):
+        return {name.strip(): int(price) for name, _, price in (item.partition("=") for item in parse_list(value))}
+    return {name: int(price) for name, price in value.items()}
+
+def parse_quotas(value):
+    """Record limits as a dict of record type (or "total") -> count, written like prices"""
+    return {name.upper() if name.lower() != "total" else "total": limit for name, limit in parse_prices(value).items()}
+
+def parse_snapshot_format(value):
+    if value not in ("json", "msgpack"):
+        raise ValueError(f"unknown data_format {value}, use json or msgpack")
+    if value == "msgpack" and msgpack is None:
+        raise ValueError("data_format msgpack needs the msgpack package")
+    return value
+
+# Settings a tenant can have of its own, the rest always come from the top-level config
+TENANT_SETTINGS = {"zone_id", "base_domain", "cloudflare_api_key", "cloudflare_email", "data_file", "rate_limit"}
+
+def parse_tenants(value):
+    """Guild id -> tenant settings, from the environment as a JSON object"""
+    if isinstance(value, str):
+        value = json.loads(value)
+    tenants = {}
+    for guild_id, settings in value.items():
+        unknown = set(settings) - TENANT_SETTINGS
+        if unknown:
+            raise ValueError(f"unknown settings for tenant {guild_id}: {', '.join(sorted(unknown))}")
+        tenants[str(int(guild_id))] = dict(settings)
+        if "rate_limit" in settings:
+            tenants[str(int(guild_id))]["rate_limit"] = parse_rate(settings["rate_limit"])
+    return tenants
+
+def parse_nameservers(value):
+    nameservers = []
+    for server in parse_list(value):
+        host, _, port = server.partition(":")
+        nameservers.append((host, int(port or 53)))
+    return nameservers
+
+# name -> (parser, default)
+CONFIG_FIELDS = {
+    "token": (str, "DiscordBotToken"),
+    "cloudflare_api_key": (str, "CloudflareAPIKey"),
+    "cloudflare_email": (str, "MailOfOwnerAPIKey"),
+    "zone_id": (str, "ZoneIDOfBaseDomain"),
+    "base_domain": (str, "BaseDomain"),
+    "record_types": (parse_list, ["A", "AAAA", "CNAME", "TXT", "MX", "SRV"]),
+    "subdomain_price": (int, 10),
+    # Credits charged per created record by type, and per subdomain created from a template
+    # (template subdomains cost subdomain_price unless listed here)
+    "record_prices": (parse_prices, {}),
+    "template_prices": (parse_prices, {}),
+    # Credits charged per subdomain every renewal_interval_days, 0 turns renewals off.
+    # Subdomains that stay unpaid for renewal_grace_days after they're due are removed.
+    "renewal_price": (int, 0),
+    "renewal_interval_days": (int, 30),
+    "renewal_grace_days": (int, 7),
+    # Most records a user may have across all their subdomains, and a single subdomain may have,
+    # by record type and in "total". Types that aren't listed are only limited by the total.
+    "user_record_quota": (parse_quotas, {}),
+    "subdomain_record_quota": (parse_quotas, {}),
+    # Subdomain names that are held for an admin, along with lookalikes and names containing them,
+    # and how many create requests per seconds a user can make before the rest are held
+    "reserved_names": (parse_list, [
+        "www", "mail", "email", "smtp", "imap", "pop", "ftp", "ns", "ns1", "ns2", "dns", "mx", "api", "cdn",
+        "admin", "administrator", "root", "support", "help", "status", "billing", "login", "signin",
+        "account", "accounts", "secure", "security", "abuse", "postmaster", "hostmaster", "webmaster",
+        "autodiscover", "autoconfig", "webmail", "cpanel", "discord", "google", "paypal", "apple",
+        "microsoft", "amazon", "steam", "cloudflare", "friendlynodes"
+    ]),
+    "squat_burst": (parse_rate, (5, 3600)),
+    # Hours between sweeps for placeholder and unreachable records (0 turns them off), and the
+    # days a placeholder record is kept before it's deleted
+    "sweep_interval_hours": (int, 24),
+    "sweep_grace_days": (int, 7),
+    "data_file": (str, "users.json"),
+    # How the data file is written, json or msgpack. Any of them, and the old pretty-printed
+    # users.json, is read no matter what this is set to.
+    "data_format": (parse_snapshot_format, "json"),
+    # Only subscribe to the gateway events the bot uses and keep no member or message cache.
+    # %grant_role and %grant_all need the member list, so they don't work while this is on.
+    "lean_gateway": (parse_bool, False),
+    # Rate limits as (commands, per seconds)
+    "user_rate_limit": (parse_rate, (5, 60)),
+    "guild_rate_limit": (parse_rate, (60, 60)),
+    # Nameservers used by %check as host:port. Empty means the zone's authoritative nameservers.
+    "dns_nameservers": (parse_nameservers, []),
+    # Seconds between zone snapshots for the change feed, and where to log every change
+    "change_feed_interval": (int, 60),
+    "change_log_channel_id": (parse_optional_int, None),
+    # Guilds with their own partition, as guild id -> settings. A tenant keeps its users in a data file
+    # of its own (data_file with the guild id added, unless it sets one) and may set its own zone_id,
+    # base_domain, cloudflare_api_key, cloudflare_email and rate_limit (its guild_rate_limit).
+    # All other guilds and DMs share the default partition made of the settings above.
+    "tenants": (parse_tenants, {}),
+    # Admins of this guild run the commands that affect every tenant, like %reload_config and the
+    # templates, and are the only ones managing the default tenant. Unset means admins of any
+    # guild that isn't a tenant.
+    "admin_guild_id": (parse_optional_int, None),
+    # Serve the HTTP API on this host and port, no port means the API is off
+    "api_host": (str, "127.0.0.1"),
+    "api_port": (parse_optional_int, None)
+}
 
-# Hardcoded credentials (too lazy to make it a environment variable_
-TOKEN = "DiscordBotToken"
-CLOUDFLARE_API_KEY = "CloudflareAPIKey"
-CLOUDFLARE_EMAIL = "MailOfOwnerAPIKey"
-ZONE_ID = "ZoneIDOfBaseDomain"
-BASE_DOMAIN = "BaseDomain"
-
-#bot setup
-intents = discord.Intents.default()
-intents.messages = True
-intents.message_content = True
-intents.guilds = True
-intents.members = True
-intents.dm_messages = True
+# These are only read at startup, changing them needs a restart
+RESTART_ONLY_FIELDS = {"token", "data_file", "lean_gateway", "api_host", "api_port", "tenants"}
+
+class Config:
+    """Typed bot settings. Instances are never modified, a reload swaps in a new one."""
+    __slots__ = tuple(CONFIG_FIELDS) + ("headers",)
+
+    def __init__(self, values):
+        for name, (parse, default) in CONFIG_FIELDS.items():
+            setattr(self, name, parse(values[name]) if name in values else default)
+        prices = (self.subdomain_price, self.renewal_price, *self.record_prices.values(), *self.template_prices.values())
+        if any(price < 0 for price in prices):
+            raise ValueError("prices can't be negative")
+        if any(limit < 0 for limit in (*self.user_record_quota.values(), *self.subdomain_record_quota.values())):
+            raise ValueError("record quotas can't be negative")
+        if self.change_feed_interval < 1 or self.renewal_interval_days < 1:
+            raise ValueError("change_feed_interval and renewal_interval_days must be at least 1")
+        if self.sweep_interval_hours < 0 or self.sweep_grace_days < 0:
+            raise ValueError("sweep_interval_hours and sweep_grace_days can't be negative")
+        self.headers = {
+            "X-Auth-Email": self.cloudflare_email,
+            "X-Auth-Key": self.cloudflare_api_key,
+            "Content-Type": "application/json"
+        }
 
-bot = commands.Bot(command_prefix="%", intents=intents)
+def load_config():
+    values = {}
+    if os.path.exists(CONFIG_FILE):
+        with open(CONFIG_FILE, "r") as f:
+            values.update(json.load(f))
+    for name in CONFIG_FIELDS:
+        env_value = os.environ.get(f"BOT_{name.upper()}")
+        if env_value is not None:
+            values[name] = env_value
+    return Config(values)
 
-DATA_FILE = "users.json"
+config = load_config()
+mark_startup_phase("config")
 
-# Allowed records
-RECORD_TYPES = ["A", "AAAA", "CNAME", "TXT", "MX", "SRV"]
+#bot setup
+COMMAND_PREFIX = "%"
+
+if config.lean_gateway:
+    # Guild info plus guild and DM messages is all the commands and DM sessions need
+    intents = discord.Intents.none()
+    intents.guilds = True
+    intents.guild_messages = True
+    intents.dm_messages = True
+    intents.message_content = True
+    bot = commands.Bot(
+        command_prefix=COMMAND_PREFIX,
+        intents=intents,
+        max_messages=None,
+        member_cache_flags=discord.MemberCacheFlags.none(),
+        chunk_guilds_at_startup=False
+    )
+else:
+    intents = discord.Intents.default()
+    intents.messages = True
+    intents.message_content = True
+    intents.guilds = True
+    intents.members = True
+    intents.dm_messages = True
+    bot = commands.Bot(command_prefix=COMMAND_PREFIX, intents=intents)
+
+JOBS_FILE = "jobs.json"
+TEMPLATES_FILE = "templates.json"
+SUBSCRIPTIONS_FILE = "subscriptions.json"
+SESSIONS_FILE = "sessions.db"
+
+# Seconds an idle %records session is kept, in memory and on disk
+SESSION_TTL = 30 * 60
+# Seconds between batched writes of changed sessions, and between sweeps for expired ones
+SESSION_FLUSH_INTERVAL = 1
+SESSION_SWEEP_INTERVAL = 60
+
+# Number of background workers for admin jobs and how many finished jobs to keep around
+JOB_WORKERS = 2
+FINISHED_JOBS_KEPT = 50
+
+# How many Cloudflare-calling handlers may run at once
+CLOUDFLARE_CONCURRENCY = 4
+DNS_TIMEOUT = 2.0
+DNS_MAX_CONCURRENT_QUERIES = 32
+# Most record changes Cloudflare accepts in one dns_records/batch request
+CLOUDFLARE_BATCH_LIMIT = 200
+# Content of the example record every new subdomain starts with
+PLACEHOLDER_IP = "1.2.3.4"
 
 #Other bot things
 SUCCESS_COLOR = 0x4CAF50  # Green
@@ -38,31 +272,717 @@ ERROR_COLOR = 0xF44336    # Red
 INFO_COLOR = 0x2196F3     # Blue
 WARNING_COLOR = 0xFF9800  # Orange
 
+# Profiling
+# Off by default. While on, every command and DM session step is traced: time spent in named
+# spans (HTTP wait, JSON decode, list scans, embed building, disk saves) is added up per
+# handler, and a background thread samples the event loop's stack PROFILE_DEFAULT_HZ times a
+# second. Both are written to PROFILE_DIR every PROFILE_DUMP_INTERVAL seconds, and only the
+# newest PROFILE_DUMPS_KEPT dumps are kept.
+PROFILE_DIR = "profiles"
+PROFILE_DUMP_INTERVAL = 60
+PROFILE_DUMPS_KEPT = 60
+PROFILE_DEFAULT_HZ = 10
+PROFILE_MAX_DEPTH = 64
+
+profile_trace = contextvars.ContextVar("profile_trace", default=None)
+profile_spans = {}  # handler -> span -> [calls, total seconds, max seconds]
+profile_stacks = {}  # collapsed stack -> samples
+profile_stacks_lock = threading.Lock()
+profiler = None  # {"hz", "stop", "thread", "task"} while profiling is on
+
+@contextlib.contextmanager
+def span(name):
+    """Time a block as part of the handler being traced, does nothing when profiling is off"""
+    trace = profile_trace.get()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        spans = trace["spans"]
+        spans[name] = spans.get(name, 0.0) + time.perf_counter() - started
+
+def start_trace(handler):
+    if profiler is not None:
+        profile_trace.set({"handler": handler, "started": time.perf_counter(), "spans": {}})
+
+def finish_trace():
+    trace = profile_trace.get()
+    if trace is None:
+        return
+    profile_trace.set(None)
+    total = time.perf_counter() - trace["started"]
+    spans = trace["spans"]
+    spans["other"] = max(total - sum(spans.values()), 0.0)
+    spans["total"] = total
+    stats = profile_spans.setdefault(trace["handler"], {})
+    for name, seconds in spans.items():
+        entry = stats.setdefault(name, [0, 0.0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] = max(entry[2], seconds)
+
+def sample_stacks(thread_id, interval, stop):
+    """Runs in its own thread and counts the event loop thread's stacks"""
+    while not stop.wait(interval):
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None and len(stack) < PROFILE_MAX_DEPTH:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        key = ";".join(reversed(stack))
+        with profile_stacks_lock:
+            profile_stacks[key] = profile_stacks.get(key, 0) + 1
+
+def write_profile_dump(stamp, stacks, spans):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    # One "stack count" line per stack, the collapsed format flame graph tools read
+    with open(os.path.join(PROFILE_DIR, f"{stamp}.stacks.txt"), "w") as f:
+        for stack, count in sorted(stacks.items(), key=lambda item: -item[1]):
+            f.write(f"{stack} {count}\n")
+    with open(os.path.join(PROFILE_DIR, f"{stamp}.spans.json"), "w") as f:
+        json.dump(spans, f, indent=4)
+    prune_profile_dumps()
+
+def prune_profile_dumps():
+    # The stamps sort by time, so the oldest dumps come first
+    stamps = sorted({file.split(".", 1)[0] for file in os.listdir(PROFILE_DIR) if file.endswith((".stacks.txt", ".spans.json"))})
+    for stamp in stamps[:max(0, len(stamps) - PROFILE_DUMPS_KEPT)]:
+        for suffix in (".stacks.txt", ".spans.json"):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(PROFILE_DIR, stamp + suffix))
+
+async def dump_profile():
+    """Write out and reset the samples and span totals gathered since the last dump"""
+    global profile_stacks, profile_spans
+    with profile_stacks_lock:
+        stacks, profile_stacks = profile_stacks, {}
+    spans, profile_spans = profile_spans, {}
+    if stacks or spans:
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+        await asyncio.to_thread(write_profile_dump, stamp, stacks, spans)
+
+async def profile_dumper():
+    while True:
+        await asyncio.sleep(PROFILE_DUMP_INTERVAL)
+        try:
+            await dump_profile()
+        except Exception as e:
+            print(f"Error writing profile: {str(e)}")
+
+def start_profiling(hz):
+    global profiler
+    if profiler is not None:
+        stop_profiling()
+    stop = threading.Event()
+    thread = threading.Thread(target=sample_stacks, args=(threading.get_ident(), 1 / hz, stop), daemon=True)
+    thread.start()
+    profiler = {"hz": hz, "stop": stop, "thread": thread, "task": asyncio.create_task(profile_dumper())}
+
+def stop_profiling():
+    global profiler
+    if profiler is not None:
+        profiler["stop"].set()
+        profiler["task"].cancel()
+        profiler = None
+
+RECORD_TYPE_DESCRIPTIONS = {
+    "A": "Maps a domain to an IPv4 address",
+    "AAAA": "Maps a domain to an IPv6 address",
+    "CNAME": "Creates an alias pointing to another domain",
+    "TXT": "Stores text information (e.g., verification)",
+    "MX": "Specifies mail servers for the domain",
+    "SRV": "Specifies location of services"
+}
+
+def build_record_type_menu():
+    menu = discord.Embed(title="🆕 Create DNS Record", color=INFO_COLOR)
+    for i, record_type in enumerate(config.record_types, 1):
+        menu.add_field(name=f"{i}. {record_type}", value=RECORD_TYPE_DESCRIPTIONS.get(record_type, f"{record_type} record"), inline=False)
+    menu.set_footer(text="Type 'cancel' to exit")
+    return menu.to_dict()
+
+# Embed templates, built once at startup. Handlers only fill in the dynamic parts.
+EMBED_TEMPLATES = {
+    "action_menu": discord.Embed(
+        description="What would you like to do?",
+        color=INFO_COLOR
+    ).add_field(
+        name="1. List Records", value="View all DNS records for this domain", inline=False
+    ).add_field(
+        name="2. Add Record", value="Create a new DNS record", inline=False
+    ).add_field(
+        name="3. Edit Record", value="Modify an existing DNS record", inline=False
+    ).add_field(
+        name="4. Delete Record", value="Remove a DNS record", inline=False
+    ).set_footer(text="Type 'cancel' to exit").to_dict(),
+    "record_type_menu": build_record_type_menu(),
+    "error": discord.Embed(title="❌ Error", color=ERROR_COLOR).to_dict(),
+    "permission_denied": discord.Embed(
+        title="❌ Permission Denied",
+        description="You don't have permission to use this command.",
+        color=ERROR_COLOR
+    ).to_dict(),
+    "invalid_selection": discord.Embed(
+        title="❌ Invalid Selection",
+        description="Please enter a valid number from the list.",
+        color=ERROR_COLOR
+    ).to_dict(),
+    "api_error": discord.Embed(title="❌ API Error", color=ERROR_COLOR).to_dict(),
+    "no_records": discord.Embed(title="❌ No Records", color=ERROR_COLOR).to_dict(),
+    "cancelled": discord.Embed(title="✅ Cancelled", color=INFO_COLOR).to_dict(),
+    "cloudflare_down": discord.Embed(
+        title="🔌 Cloudflare Unavailable",
+        description="Cloudflare isn't responding right now, so changes can't be made. Please try again in a minute.",
+        color=WARNING_COLOR
+    ).to_dict(),
+    "rate_limited": discord.Embed(
+        title="⏳ Slow Down",
+        description="You're sending commands too quickly. Please wait a moment and try again.",
+        color=WARNING_COLOR
+    ).to_dict(),
+    "navigation": discord.Embed(
+        title="ℹ️ Navigation",
+        description="Type '**back**' to return to the main menu or '**cancel**' to exit.",
+        color=INFO_COLOR
+    ).to_dict()
+}
+
+def render_embed(template, **overrides):
+    """Create an embed from a prebuilt template, overriding only the given keys"""
+    with span("embed build"):
+        data = EMBED_TEMPLATES[template]
+        if overrides:
+            data = {**data, **overrides}
+        # from_dict would share the template's field list and field dicts with the embed, so the
+        # fields are added as new ones and nothing done to the embed can change the template
+        embed = discord.Embed.from_dict({key: value for key, value in data.items() if key != "fields"})
+        for field in data.get("fields", ()):
+            embed.add_field(name=field["name"], value=field["value"], inline=field.get("inline", True))
+        return embed
+
+RATE_LIMITED_EMBED = render_embed("rate_limited")
+
+def error_embed(description, title="❌ Error"):
+    return render_embed("error", title=title, description=description)
+
+def action_menu_embed(domain):
+    return render_embed("action_menu", title=f"🔧 Managing {domain}.{tenant().base_domain}")
+
+class User:
+    """Per-user record, slotted to keep memory per user small"""
+    __slots__ = ("credits", "subdomains", "renewals")
+
+    def __init__(self, credits=0, subdomains=(), renewals=None):
+        self.credits = credits
+        self.subdomains = set(subdomains)
+        self.renewals = renewals or {}  # subdomain -> unix time its next renewal is due
+
+class UserStore:
+    """All users keyed by Discord id, with an index from subdomain name to its owner.
+
+    Users stay as their loaded (credits, subdomains, renewals) rows until first accessed,
+    only the owner index is built up front.
+    """
+
+    def __init__(self, raw=None):
+        self.users = {}
+        self.raw = raw or {}
+        self.owners = {}
+        for user_id, (_, subdomains, _) in self.raw.items():
+            for name in subdomains:
+                self.owners[name] = user_id
+
+    def __contains__(self, user_id):
+        return user_id in self.users or user_id in self.raw
+
+    def __len__(self):
+        return len(self.users) + len(self.raw)
+
+    def get(self, user_id):
+        user = self.users.get(user_id)
+        if user is None and user_id in self.raw:
+            user = self.users[user_id] = User(*self.raw.pop(user_id))
+        return user
+
+    def get_or_create(self, user_id):
+        user = self.get(user_id)
+        if user is None:
+            user = self.users[user_id] = User()
+        return user
+
+    def owner_of(self, name):
+        return self.owners.get(name)
+
+    def has_subdomain(self, user_id, name):
+        return self.owners.get(name) == user_id
+
+    def add_subdomain(self, user_id, name):
+        self.get_or_create(user_id).subdomains.add(name)
+        self.owners[name] = user_id
+
+    def remove_subdomain(self, user_id, name):
+        user = self.get(user_id)
+        if user is not None:
+            user.subdomains.discard(name)
+            user.renewals.pop(name, None)
+        if self.owners.get(name) == user_id:
+            del self.owners[name]
+
+    def grant_credits(self, user_ids, amount):
+        """Add credits to many users in one go, the caller saves once afterwards"""
+        for user_id in user_ids:
+            self.get_or_create(user_id).credits += amount
+
+    def rows(self):
+        """[user id, credits, subdomains, renewals] for every user, the ones never touched exactly as they were loaded"""
+        for user_id, (credits, subdomains, renewals) in self.raw.items():
+            yield [user_id, credits, subdomains, renewals or {}]
+        for user_id, user in self.users.items():
+            yield [user_id, user.credits, sorted(user.subdomains), user.renewals]
+
+    def memory_usage(self):
+        """Approximate bytes used by the users, loaded rows and hydrated ones alike, and the owner index"""
+        total = sys.getsizeof(self.users) + sys.getsizeof(self.raw) + sys.getsizeof(self.owners)
+        for user_id, (credits, subdomains, renewals) in self.raw.items():
+            total += sys.getsizeof(user_id) + sys.getsizeof((credits, subdomains, renewals)) + sys.getsizeof(credits)
+            total += sys.getsizeof(subdomains) + sum(sys.getsizeof(name) for name in subdomains)
+            if renewals:
+                total += sys.getsizeof(renewals) + sum(sys.getsizeof(due) for due in renewals.values())
+        for user_id, user in self.users.items():
+            total += sys.getsizeof(user_id) + sys.getsizeof(user) + sys.getsizeof(user.credits)
+            total += sys.getsizeof(user.subdomains) + sum(sys.getsizeof(name) for name in user.subdomains)
+            total += sys.getsizeof(user.renewals) + sum(sys.getsizeof(due) for due in user.renewals.values())
+        return total
+
+# Snapshots
+# The data file used to be a single pretty-printed JSON object of user id -> user, that's snapshot version 1
+# and is still read. Version 2 is a header record followed by one [user id, credits, subdomains, renewals]
+# row per user, so it's read a row at a time instead of parsing the whole file in one go.
+SNAPSHOT_VERSION = 2
+
+class JsonSnapshot:
+    """Compact JSON, the header and every row on a line of their own"""
+    name = "json"
+
+    @staticmethod
+    def encode(value):
+        if orjson is not None:
+            return orjson.dumps(value) + b"\n"
+        return json.dumps(value, separators=(",", ":")).encode() + b"\n"
+
+    def write(self, f, header, rows):
+        f.write(self.encode(header))
+        f.writelines(map(self.encode, rows))
+
+    def read(self, f):
+        loads = orjson.loads if orjson is not None else json.loads
+        header = loads(f.readline())
+        return header, (loads(line) for line in f if line.strip())
+
+class MsgpackSnapshot:
+    """msgpack, the header and then the rows as a stream of packed arrays"""
+    name = "msgpack"
+
+    def write(self, f, header, rows):
+        packer = msgpack.Packer()
+        f.write(packer.pack(header))
+        f.writelines(map(packer.pack, rows))
+
+    def read(self, f):
+        unpacker = msgpack.Unpacker(f, raw=False)
+        return next(unpacker), unpacker
+
+SNAPSHOT_FORMATS = {snapshot.name: snapshot for snapshot in (JsonSnapshot(), MsgpackSnapshot())}
+
+def read_legacy_snapshot(f):
+    """Version 1, the whole file is one JSON object"""
+    return {
+        user_id: (user_data.get("credits", 0), user_data.get("subdomains", ()), user_data.get("renewals"))
+        for user_id, user_data in json.load(f).items()
+    }
+
+@contextlib.contextmanager
+def gc_paused():
+    """Loading allocates millions of containers that all live on, collecting while that happens only wastes time"""
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+def read_snapshot(path):
+    """Users in the file at path as UserStore rows, whatever snapshot format and version it was written in"""
+    with gc_paused(), open(path, "rb") as f:
+        first = f.peek(1)[:1]
+        if first in (b"{", b""):
+            # Version 2 JSON starts with its header line, version 1 with an object of users
+            try:
+                header = json.loads(f.readline())
+            except json.JSONDecodeError:
+                header = None
+            f.seek(0)
+            if not isinstance(header, dict) or "snapshot" not in header:
+                return read_legacy_snapshot(f)
+            snapshot = SNAPSHOT_FORMATS["json"]
+        elif msgpack is None:
+            raise ValueError(f"{path} isn't JSON, and reading msgpack snapshots needs the msgpack package")
+        else:
+            snapshot = SNAPSHOT_FORMATS["msgpack"]
+        header, rows = snapshot.read(f)
+        if header.get("snapshot", 0) > SNAPSHOT_VERSION:
+            raise ValueError(f"{path} is snapshot version {header['snapshot']}, this bot reads up to {SNAPSHOT_VERSION}")
+        return {user_id: (credits, subdomains, renewals) for user_id, credits, subdomains, renewals in rows}
+
+def write_snapshot(data, path, format_name):
+    """Write data to path, through a temporary file so a crash never leaves a half-written snapshot"""
+    snapshot = SNAPSHOT_FORMATS[format_name]
+    header = {"snapshot": SNAPSHOT_VERSION, "format": snapshot.name, "users": len(data)}
+    temp_file = f"{path}.tmp"
+    with open(temp_file, "wb") as f:
+        snapshot.write(f, header, data.rows())
+    os.replace(temp_file, path)
+
 def load_data():
-    if os.path.exists(DATA_FILE):
+    """The current tenant's users. Raises if the data file exists but can't be read, so it's never replaced by an empty one."""
+    data_file = tenant().data_file
+    if os.path.exists(data_file):
         try:
-            with open(DATA_FILE, "r") as f:
-                return json.load(f)
-        except json.JSONDecodeError:
-            print("Error loading data file, creating new one")
-            return {}
+            rows = read_snapshot(data_file)
+            with gc_paused():
+                return UserStore(rows)
+        except Exception as e:
+            raise RuntimeError(f"Can't read data file {data_file} ({e}), it was left untouched") from e
     else:
-        print(f"Data file {DATA_FILE} not found, creating new one")
-        return {}
+        print(f"Data file {data_file} not found, creating new one")
+        return UserStore()
 
 def save_data(data):
+    if users_load_error is not None:
+        # Some data file couldn't be read, nothing is written until it's fixed so it can't be lost
+        print("Not saving data, it failed to load")
+        return
     try:
-        with open(DATA_FILE, "w") as f:
-            json.dump(data, f, indent=4)
+        with span("disk save"):
+            write_snapshot(data, tenant().data_file, config.data_format)
         print("Data saved successfully")
     except Exception as e:
         print(f"Error saving data: {str(e)}")
 
-headers = {
-    "X-Auth-Email": CLOUDFLARE_EMAIL,
-    "X-Auth-Key": CLOUDFLARE_API_KEY,
-    "Content-Type": "application/json"
-}
+# Tenants
+# Every guild in config.tenants is a tenant: its users live in their own data file, and it can have
+# its own zone, Cloudflare credentials and rate limit. All other guilds and DMs share the default
+# tenant, which is the top-level config. Handlers read theirs from current_tenant, which is set from
+# the guild of each command, from where a %records session was started, from the API token and by
+# the background loops for each tenant in turn, so the same code serves every tenant.
+class Tenant:
+    """A guild's partition of users along with its zone and limits, the default partition when guild_id is None"""
+    __slots__ = ("guild_id", "users", "record_counts")
+
+    def __init__(self, guild_id=None):
+        self.guild_id = guild_id
+        self.users = None
+        self.record_counts = None  # subdomain -> {record type: count}, built on first use
+
+    @property
+    def key(self):
+        return self.guild_id or "default"
+
+    @property
+    def settings(self):
+        return config.tenants.get(self.guild_id, {}) if self.guild_id else {}
+
+    @property
+    def zone_id(self):
+        return self.settings.get("zone_id", config.zone_id)
+
+    @property
+    def base_domain(self):
+        return self.settings.get("base_domain", config.base_domain)
+
+    @property
+    def headers(self):
+        settings = self.settings
+        if "cloudflare_api_key" not in settings and "cloudflare_email" not in settings:
+            return config.headers
+        return dict(
+            config.headers,
+            **{"X-Auth-Email": settings.get("cloudflare_email", config.cloudflare_email), "X-Auth-Key": settings.get("cloudflare_api_key", config.cloudflare_api_key)}
+        )
+
+    @property
+    def rate_limit(self):
+        return self.settings.get("rate_limit", config.guild_rate_limit)
+
+    @property
+    def data_file(self):
+        if self.guild_id is None:
+            return config.data_file
+        root, extension = os.path.splitext(config.data_file)
+        return self.settings.get("data_file", f"{root}-{self.guild_id}{extension}")
+
+    def scoped(self, key):
+        """key made unique to this tenant, keys of the default tenant stay as they always were"""
+        return key if self.guild_id is None else f"{self.guild_id}/{key}"
+
+default_tenant = Tenant()
+tenants = {guild_id: Tenant(guild_id) for guild_id in config.tenants}
+current_tenant = contextvars.ContextVar("current_tenant", default=default_tenant)
+
+def tenant():
+    return current_tenant.get()
+
+def all_tenants():
+    return [default_tenant, *tenants.values()]
+
+def tenant_for(guild_id):
+    """The tenant serving a guild, guilds that aren't tenants and DMs (None) get the default one"""
+    return tenants.get(str(guild_id), default_tenant) if guild_id is not None else default_tenant
+
+def find_tenant(guild_id):
+    """The tenant with a guild id stored by an earlier run, None if it's no longer configured"""
+    return default_tenant if guild_id is None else tenants.get(guild_id)
+
+@contextlib.contextmanager
+def tenant_scope(scoped_tenant):
+    token = current_tenant.set(scoped_tenant)
+    try:
+        yield
+    finally:
+        current_tenant.reset(token)
+
+class TenantUsers:
+    """Stands in for the current tenant's UserStore, so handlers use users the same way for every tenant"""
+
+    def __getattr__(self, name):
+        return getattr(tenant().users, name)
+
+    def __contains__(self, user_id):
+        return user_id in tenant().users
+
+    def __len__(self):
+        return len(tenant().users)
+
+users = TenantUsers()
+
+CLOUDFLARE_API = "https://api.cloudflare.com/client/v4"
+# Connect and read timeouts in seconds for every Cloudflare request
+CLOUDFLARE_TIMEOUT = (5, 20)
+# Consecutive failures that open the circuit breaker, and seconds it stays open before one request may try again
+CIRCUIT_FAILURES = 5
+CIRCUIT_RESET = 30
+
+class CloudflareUnavailable(Exception):
+    """Cloudflare timed out, failed, or isn't being called because the circuit breaker is open"""
+
+class CircuitBreaker:
+    """Stops calling an API after repeated failures and lets a single trial request through every reset seconds"""
+
+    def __init__(self, failures, reset, name="Cloudflare"):
+        self.name = name
+        self.failures = failures
+        self.reset = reset
+        self.consecutive = 0
+        self.opened_at = None
+        self.trial = False
+
+    def available(self):
+        """False while open, checking doesn't use up the trial request"""
+        return self.opened_at is None or time.monotonic() - self.opened_at >= self.reset
+
+    def retry_in(self):
+        return 0 if self.opened_at is None else max(0, round(self.opened_at + self.reset - time.monotonic()))
+
+    def allow(self):
+        if self.opened_at is None:
+            return True
+        if not self.trial and time.monotonic() - self.opened_at >= self.reset:
+            self.trial = True
+            return True
+        return False
+
+    def abandon(self):
+        """The request allow() let through ended without an answer either way, let another one try"""
+        self.trial = False
+
+    def record(self, ok):
+        if ok:
+            if self.opened_at is not None:
+                print(f"{self.name} is reachable again, circuit breaker closed")
+            self.consecutive = 0
+            self.opened_at = None
+            self.trial = False
+            return
+        self.consecutive += 1
+        if self.trial or self.consecutive >= self.failures:
+            if self.opened_at is None:
+                print(f"{self.name} failed {self.consecutive} times in a row, circuit breaker opened")
+            self.opened_at = time.monotonic()
+            self.trial = False
+
+# One breaker per tenant, a tenant with a bad key or zone only shuts itself out of Cloudflare
+cloudflare_breakers = {}  # tenant key -> CircuitBreaker
+
+def cloudflare_breaker():
+    """The current tenant's circuit breaker"""
+    key = tenant().key
+    breaker = cloudflare_breakers.get(key)
+    if breaker is None:
+        breaker = cloudflare_breakers[key] = CircuitBreaker(CIRCUIT_FAILURES, CIRCUIT_RESET, f"Cloudflare for tenant {key}")
+    return breaker
+
+async def cloudflare_request(method, path, **kwargs):
+    """Call the Cloudflare API from a worker thread so the event loop keeps running"""
+    breaker = cloudflare_breaker()
+    if not breaker.allow():
+        raise CloudflareUnavailable(f"Cloudflare is unavailable, retrying in {breaker.retry_in()}s")
+    trial = breaker.trial
+    if method != "GET":
+        # Reads already in flight may miss this write, make later readers start a fresh one
+        inflight_reads.clear()
+    try:
+        with span("http wait"):
+            response = await asyncio.to_thread(requests.request, method, f"{CLOUDFLARE_API}{path}", headers=tenant().headers, timeout=CLOUDFLARE_TIMEOUT, **kwargs)
+    except requests.RequestException as e:
+        breaker.record(False)
+        raise CloudflareUnavailable(str(e)) from e
+    except BaseException:
+        # Cancelled or failed before Cloudflare answered, so it says nothing about Cloudflare
+        if trial:
+            breaker.abandon()
+        raise
+    breaker.record(response.status_code < 500 and response.status_code != 429)
+    if profiler is not None:
+        decode = response.json
+        def timed_json(**json_kwargs):
+            with span("json decode"):
+                return decode(**json_kwargs)
+        response.json = timed_json
+    return response
+
+# Reads currently in flight, keyed by path
+inflight_reads = {}
+# The last successful listing of each zone and when it was fetched, served marked stale while Cloudflare is down
+zone_cache = {}  # path -> (data, fetched)
+
+class StaleResponse:
+    """Stands in for a response with data from an earlier fetch"""
+    status_code = 200
+    stale = True
+
+    def __init__(self, data, fetched):
+        self.data = data
+        self.fetched = fetched
+        self.text = ""
+
+    def json(self):
+        return self.data
+
+def stale_note(response):
+    """A line telling the user the data is from the cache, or an empty string for a live response"""
+    if not getattr(response, "stale", False):
+        return ""
+    return f"\n⚠️ Cloudflare is unreachable, showing records as of <t:{int(response.fetched)}:R>."
+
+async def cloudflare_get(path):
+    """GET from the Cloudflare API, concurrent identical reads share a single request"""
+    task = inflight_reads.get(path)
+    if task is None:
+        task = asyncio.ensure_future(shared_read(path))
+        inflight_reads[path] = task
+        task.add_done_callback(lambda done: inflight_reads.pop(path) if inflight_reads.get(path) is done else None)
+    # Shield so one waiter giving up doesn't cancel the request for everyone else
+    zone_path = path == f"/zones/{tenant().zone_id}/dns_records"
+    try:
+        with span("http wait"):
+            response = await asyncio.shield(task)
+    except CloudflareUnavailable:
+        if zone_path and path in zone_cache:
+            return StaleResponse(*zone_cache[path])
+        raise
+    if zone_path:
+        if response.status_code == 200:
+            zone_cache[path] = (response.json(), time.time())
+        elif response.status_code >= 500 and path in zone_cache:
+            return StaleResponse(*zone_cache[path])
+    return response
+
+async def shared_read(path):
+    # Every waiter times the read itself, so it isn't also counted for whoever started it
+    profile_trace.set(None)
+    return await cloudflare_request("GET", path)
+
+BATCH_OPERATIONS = ("deletes", "patches", "puts", "posts")
+
+async def cloudflare_batch(deletes=(), patches=(), puts=(), posts=()):
+    """Apply record changes through the zone's dns_records/batch endpoint.
+
+    Changes are split into chunks of CLOUDFLARE_BATCH_LIMIT, each applied atomically
+    by Cloudflare. If a chunk is rejected its changes are retried one request per record.
+    Returns a dict with a result list per operation, None where that change failed.
+    """
+    changes = {"deletes": list(deletes), "patches": list(patches), "puts": list(puts), "posts": list(posts)}
+    results = {operation: [None] * len(items) for operation, items in changes.items()}
+    pending = [(operation, i) for operation in BATCH_OPERATIONS for i in range(len(changes[operation]))]
+
+    for start in range(0, len(pending), CLOUDFLARE_BATCH_LIMIT):
+        chunk = pending[start:start + CLOUDFLARE_BATCH_LIMIT]
+        body = {}
+        for operation, i in chunk:
+            body.setdefault(operation, []).append(changes[operation][i])
+
+        response = await cloudflare_request("POST", f"/zones/{tenant().zone_id}/dns_records/batch", json=body)
+        if response.status_code == 200 and response.json().get("success"):
+            batch_result = response.json().get("result") or {}
+            offsets = dict.fromkeys(body, 0)
+            for operation, i in chunk:
+                items = batch_result.get(operation) or []
+                if offsets[operation] < len(items):
+                    results[operation][i] = items[offsets[operation]]
+                offsets[operation] += 1
+            continue
+
+        print(f"Batch request failed, falling back to single requests: {response.text}")
+        for operation, i in chunk:
+            results[operation][i] = await cloudflare_single_change(operation, changes[operation][i])
+
+    return results
+
+async def cloudflare_single_change(operation, change):
+    if operation == "posts":
+        response = await cloudflare_request("POST", f"/zones/{tenant().zone_id}/dns_records", json=change)
+    elif operation == "deletes":
+        response = await cloudflare_request("DELETE", f"/zones/{tenant().zone_id}/dns_records/{change['id']}")
+    else:
+        record = {k: v for k, v in change.items() if k != "id"}
+        method = "PATCH" if operation == "patches" else "PUT"
+        response = await cloudflare_request(method, f"/zones/{tenant().zone_id}/dns_records/{change['id']}", json=record)
+
+    if response.status_code == 200 and response.json().get("success"):
+        return response.json().get("result") or change
+    print(f"Failed to apply {operation[:-1]} change: {response.text}")
+    return None
+
+async def create_record_set(records):
+    """Create several records as one batch, deleting any that got created if the rest failed.
+
+    Returns (created records, True) on success and ([], False) after a rollback.
+    """
+    results = await cloudflare_batch(posts=records)
+    created = [r for r in results["posts"] if r is not None]
+    if len(created) == len(records):
+        return created, True
+
+    if created:
+        rollback = await cloudflare_batch(deletes=[{"id": r["id"]} for r in created if "id" in r])
+        if any(r is None for r in rollback["deletes"]):
+            print(f"Rollback left records behind: {created}")
+    return [], False
 
 def is_valid_subdomain(name):
     """Check if subdomain name is valid (alphanumeric and hyphen only)"""
@@ -82,11 +1002,2112 @@ def is_valid_hostname(hostname):
 
 active_sessions = {}
 
+# Sessions are written to SESSIONS_FILE shortly after every step so a restart doesn't lose them.
+# Changed sessions are written in batches from a worker thread, and read back only when
+# that user sends their next DM.
+session_db = None
+session_db_lock = threading.Lock()
+stored_session_ids = set()
+changed_session_ids = set()
+session_task = None
+
+def open_session_store():
+    global session_db
+    if session_db is not None:
+        return
+    session_db = sqlite3.connect(SESSIONS_FILE, check_same_thread=False)
+    session_db.execute("PRAGMA journal_mode=WAL")
+    session_db.execute("PRAGMA synchronous=NORMAL")
+    session_db.execute("CREATE TABLE IF NOT EXISTS sessions (user_id TEXT PRIMARY KEY, step TEXT, data TEXT, expires REAL)")
+    session_db.execute("DELETE FROM sessions WHERE expires < ?", (time.time(),))
+    session_db.commit()
+    stored_session_ids.update(row[0] for row in session_db.execute("SELECT user_id FROM sessions"))
+
+def persist_session(user_id):
+    """Queue the user's session to be written to disk, or removed there if the session has ended"""
+    session = active_sessions.get(user_id)
+    if session is not None:
+        session["expires"] = time.time() + SESSION_TTL
+    changed_session_ids.add(user_id)
+
+def take_session_changes():
+    """Rows to write and user ids to delete for the sessions changed since the last write"""
+    rows, deleted = [], []
+    for user_id in changed_session_ids:
+        session = active_sessions.get(user_id)
+        if session is not None:
+            rows.append((user_id, session["step"], json.dumps(session["data"], separators=(",", ":")), session["expires"]))
+            stored_session_ids.add(user_id)
+        elif user_id in stored_session_ids:
+            deleted.append((user_id,))
+            stored_session_ids.discard(user_id)
+    changed_session_ids.clear()
+    return rows, deleted
+
+def write_sessions(rows, deleted, expired_before=None):
+    """Apply a batch of session changes in one transaction, returns the ids of expired sessions removed"""
+    expired = []
+    with session_db_lock:
+        session_db.executemany("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?)", rows)
+        session_db.executemany("DELETE FROM sessions WHERE user_id = ?", deleted)
+        if expired_before is not None:
+            expired = [row[0] for row in session_db.execute("SELECT user_id FROM sessions WHERE expires < ?", (expired_before,))]
+            session_db.execute("DELETE FROM sessions WHERE expires < ?", (expired_before,))
+        session_db.commit()
+    return expired
+
+def sweep_sessions():
+    """Drop sessions that sat idle past SESSION_TTL without the user sending another DM"""
+    now = time.time()
+    for user_id in [user_id for user_id, session in active_sessions.items() if session.get("expires", float("inf")) < now]:
+        del active_sessions[user_id]
+        changed_session_ids.add(user_id)
+    return now
+
+def flush_sessions():
+    """Write out changed sessions synchronously, used at shutdown"""
+    if session_db is not None and changed_session_ids:
+        write_sessions(*take_session_changes())
+
+async def session_writer():
+    swept_at = time.monotonic()
+    while True:
+        await asyncio.sleep(SESSION_FLUSH_INTERVAL)
+        expired_before = None
+        if time.monotonic() - swept_at >= SESSION_SWEEP_INTERVAL:
+            swept_at = time.monotonic()
+            expired_before = sweep_sessions()
+        if not changed_session_ids and expired_before is None:
+            continue
+        try:
+            expired = await asyncio.to_thread(write_sessions, *take_session_changes(), expired_before)
+            stored_session_ids.difference_update(user_id for user_id in expired if user_id not in active_sessions)
+        except Exception as e:
+            print(f"Error saving sessions: {str(e)}")
+
+def start_session_writer():
+    global session_task
+    if session_task is None:
+        open_session_store()
+        session_task = asyncio.create_task(session_writer())
+
+def restore_session(user_id):
+    """Load a session saved before a restart, returns None if there is none or it expired"""
+    open_session_store()
+    if user_id not in stored_session_ids:
+        return None
+    with session_db_lock:
+        row = session_db.execute("SELECT step, data, expires FROM sessions WHERE user_id = ?", (user_id,)).fetchone()
+    if row is None or row[2] < time.time():
+        active_sessions.pop(user_id, None)
+        persist_session(user_id)
+        return None
+    session = {"step": row[0], "data": json.loads(row[1]), "expires": row[2]}
+    active_sessions[user_id] = session
+    return session
+
+def compact_records(records):
+    """Keep only the record fields the session steps use"""
+    return [{"id": r["id"], "type": r["type"], "name": r["name"], "content": r.get("content", "")} for r in records]
+
+class TokenBucket:
+    """Token bucket that refills continuously up to its capacity"""
+    __slots__ = ("capacity", "rate", "tokens", "updated", "notified")
+
+    def __init__(self, capacity, per):
+        self.capacity = capacity
+        self.rate = capacity / per
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.notified = False
+
+    def refill(self):
+        """Add the tokens earned since the last call, returns how many there are now"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    def consume(self):
+        if self.refill() >= 1:
+            self.tokens -= 1
+            self.notified = False
+            return True
+        return False
+
+class FairQueue:
+    """Limits concurrent work and hands free slots round-robin to waiting groups, and within a group to its keys"""
+
+    def __init__(self, slots):
+        self.free = slots
+        self.waiters = {}  # group -> {key -> deque of futures}, dict order is the round-robin order
+
+    async def acquire(self, key, group=None):
+        if self.free > 0 and not self.waiters:
+            self.free -= 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(group, {}).setdefault(key, deque()).append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()
+            else:
+                keys = self.waiters.get(group, {})
+                queue = keys.get(key)
+                if queue and future in queue:
+                    queue.remove(future)
+                    if not queue:
+                        del keys[key]
+                    if not keys:
+                        del self.waiters[group]
+            raise
+
+    def release(self):
+        while self.waiters:
+            group = next(iter(self.waiters))
+            keys = self.waiters.pop(group)
+            key = next(iter(keys))
+            queue = keys.pop(key)
+            future = queue.popleft()
+            # Send this key and its group to the back so one busy tenant, or one busy user in it, can't hog the slots
+            if queue:
+                keys[key] = queue
+            if keys:
+                self.waiters[group] = keys
+            if not future.done():
+                future.set_result(None)
+                return
+        self.free += 1
+
+    @contextlib.asynccontextmanager
+    async def slot(self, key):
+        """Wait for a slot as key, queued with the rest of the current tenant's work"""
+        with span("queue wait"):
+            await self.acquire(key, tenant().key)
+        try:
+            yield
+        finally:
+            self.release()
+
+# Session steps whose handlers change records, refused straight away while Cloudflare is down
+CLOUDFLARE_WRITE_STEPS = {"confirm_create", "confirm_delete", "confirm_edit"}
+
+# Session steps whose handlers call the Cloudflare API
+CLOUDFLARE_STEPS = {"select_action", "confirm_create", "select_record_to_delete", "confirm_delete", "select_record_to_edit", "confirm_edit"}
+
+# Seconds between sweeps that drop full buckets, a new bucket would start out the same
+BUCKET_PRUNE_INTERVAL = 300
+
+user_buckets = {}
+guild_buckets = {}
+buckets_pruned = time.monotonic()
+cloudflare_queue = FairQueue(CLOUDFLARE_CONCURRENCY)
+
+def prune_buckets():
+    global buckets_pruned
+    now = time.monotonic()
+    if now - buckets_pruned < BUCKET_PRUNE_INTERVAL:
+        return
+    buckets_pruned = now
+    for buckets in (user_buckets, guild_buckets):
+        for key in [key for key, bucket in buckets.items() if bucket.refill() >= bucket.capacity]:
+            del buckets[key]
+
+def check_rate_limit(user_id, guild_id=None):
+    """Take a token from the user's (and guild's) bucket, returns False and takes none if either is empty"""
+    prune_buckets()
+    bucket = user_buckets.get(user_id)
+    if bucket is None:
+        bucket = user_buckets[user_id] = TokenBucket(*config.user_rate_limit)
+    buckets = [bucket]
+
+    if guild_id is not None:
+        guild_bucket = guild_buckets.get(guild_id)
+        if guild_bucket is None:
+            guild_bucket = guild_buckets[guild_id] = TokenBucket(*tenant_for(guild_id).rate_limit)
+        buckets.append(guild_bucket)
+
+    if any(bucket.refill() < 1 for bucket in buckets):
+        return False
+    for bucket in buckets:
+        bucket.consume()
+    return True
+
+def throttled(func):
+    """Throttle a command per user and guild"""
+    @functools.wraps(func)
+    async def wrapper(ctx, *args, **kwargs):
+        user_id = str(ctx.author.id)
+        if not check_rate_limit(user_id, ctx.guild.id if ctx.guild else None):
+            bucket = user_buckets[user_id]
+            # Only answer once per empty bucket so spamming doesn't turn into spam replies
+            if not bucket.notified:
+                bucket.notified = True
+                await ctx.send(embed=RATE_LIMITED_EMBED)
+            return
+        return await func(ctx, *args, **kwargs)
+    return wrapper
+
+def rate_limited(func):
+    """Throttle a command per user and guild and queue it fairly for a Cloudflare slot"""
+    @throttled
+    @functools.wraps(func)
+    async def wrapper(ctx, *args, **kwargs):
+        async with cloudflare_queue.slot(str(ctx.author.id)):
+            return await func(ctx, *args, **kwargs)
+    return wrapper
+
+class RecordChangeError(Exception):
+    """A record change that was refused or failed, with a title and description for the user"""
+
+    def __init__(self, title, description, status=400):
+        super().__init__(description)
+        self.title = title
+        self.description = description
+        self.status = status
+
+async def create_user_record(user_id, domain, data, via="discord"):
+    """Create a record under one of the user's subdomains, charging its price and checking quotas.
+
+    Shared by the %records session and the HTTP API, returns the created record.
+    """
+    record_type = data["type"]
+    price = record_price(record_type)
+    user = users.get_or_create(user_id)
+    if user.credits < price:
+        raise RecordChangeError("Insufficient Credits", f"{record_type} records cost {price} credits. You currently have {user.credits} credits.", 402)
+
+    # Charged before the first await so concurrent creates can't spend the same credits, refunded if it fails
+    user.credits -= price
+    try:
+        await ensure_record_index()
+        violation = record_quota_violation(user_id, domain, [record_type])
+        if violation:
+            raise RecordChangeError("Record Limit Reached", violation, 403)
+
+        # Counted before the create so concurrent creates see it in their quota check, undone if it fails
+        count_record(domain, record_type, 1)
+        try:
+            create_response = await cloudflare_request(
+                "POST",
+                f"/zones/{tenant().zone_id}/dns_records",
+                json=data
+            )
+            if not (create_response.status_code == 200 or create_response.json().get("success")):
+                print(f"Failed to create record: {create_response.text}")
+                raise RecordChangeError("Creation Failed", f"Failed to create the record. API Error: {create_response.json().get('errors')}", 502)
+        except BaseException:
+            count_record(domain, record_type, -1)
+            raise
+    except BaseException:
+        user.credits += price
+        raise
+
+    if price:
+        save_data(users)
+    audit("create_record", user_id, type=record_type, name=data["name"], content=data.get("content"), via=via)
+    return create_response.json().get("result", data)
+
+def subdomain_records(records, name):
+    """Records that belong to the given subdomain (the subdomain itself and anything under it)"""
+    subdomain = f"{name}.{tenant().base_domain}"
+    with span("list scan"):
+        return [r for r in records if r["name"] == subdomain or r["name"].endswith(f".{subdomain}")]
+
+# DNS propagation checks
+DNS_TYPES = {"A": 1, "NS": 2, "CNAME": 5, "MX": 15, "TXT": 16, "AAAA": 28, "SRV": 33}
+DNS_TYPE_NAMES = {number: name for name, number in DNS_TYPES.items()}
+# Types %check looks at when the user doesn't pick one
+CHECK_RECORD_TYPES = ["A", "AAAA", "CNAME", "TXT", "MX"]
+# How long to remember that a name has no records of a type
+DNS_NEGATIVE_TTL = 30
+# Answers kept in dns_cache, the least recently used are dropped first
+DNS_CACHE_SIZE = 4096
+# Header flag set when the answer didn't fit in a UDP datagram
+DNS_FLAG_TRUNCATED = 0x0200
+
+dns_cache = {}  # (server, name, type) -> (expires at, answers), in least recently used order
+dns_query_slots = asyncio.Semaphore(DNS_MAX_CONCURRENT_QUERIES)
+authoritative_nameservers = {}  # zone id -> [(address, port)]
+
+class DNSQueryProtocol(asyncio.DatagramProtocol):
+    def __init__(self, future):
+        self.future = future
+
+    def datagram_received(self, data, addr):
+        if not self.future.done():
+            self.future.set_result(data)
+
+    def error_received(self, exc):
+        if not self.future.done():
+            self.future.set_exception(exc)
+
+def build_dns_query(query_id, name, record_type):
+    # Recursion is not requested, the nameservers we ask are authoritative
+    header = struct.pack("!HHHHHH", query_id, 0, 1, 0, 0, 0)
+    question = b"".join(bytes([len(label)]) + label.encode("ascii") for label in name.rstrip(".").split("."))
+    return header + question + b"\x00" + struct.pack("!HH", DNS_TYPES[record_type], 1)
+
+def read_dns_name(packet, offset):
+    """Read a possibly compressed name, returns the name and the offset just past it"""
+    labels = []
+    end = None
+    for _ in range(128):
+        length = packet[offset]
+        if length & 0xC0 == 0xC0:
+            if end is None:
+                end = offset + 2
+            offset = ((length & 0x3F) << 8) | packet[offset + 1]
+            continue
+        offset += 1
+        if length == 0:
+            return ".".join(labels), end if end is not None else offset
+        if offset + length > len(packet):
+            raise ValueError("DNS name runs past the end of the packet")
+        labels.append(packet[offset:offset + length].decode("ascii", "replace"))
+        offset += length
+    raise ValueError("DNS name compression loop")
+
+def parse_dns_rdata(packet, offset, record_type, length):
+    rdata = packet[offset:offset + length]
+    if record_type == DNS_TYPES["A"] or record_type == DNS_TYPES["AAAA"]:
+        return str(ipaddress.ip_address(rdata))
+    if record_type == DNS_TYPES["CNAME"] or record_type == DNS_TYPES["NS"]:
+        return read_dns_name(packet, offset)[0]
+    if record_type == DNS_TYPES["MX"]:
+        return f"{struct.unpack('!H', rdata[:2])[0]} {read_dns_name(packet, offset + 2)[0]}"
+    if record_type == DNS_TYPES["SRV"]:
+        priority, weight, port = struct.unpack("!HHH", rdata[:6])
+        return f"{priority} {weight} {port} {read_dns_name(packet, offset + 6)[0]}"
+    if record_type == DNS_TYPES["TXT"]:
+        strings = []
+        i = 0
+        while i < len(rdata):
+            strings.append(rdata[i + 1:i + 1 + rdata[i]].decode("utf-8", "replace"))
+            i += 1 + rdata[i]
+        return "".join(strings)
+    return rdata.hex()
+
+def parse_dns_response(packet, query_id):
+    """Returns the response code, whether the truncated flag is set and a list of (type name, ttl, value) answers.
+
+    Raises ValueError for a reply to another query or a packet that is cut short or malformed.
+    """
+    try:
+        response_id, flags, questions, answer_count = struct.unpack("!HHHH", packet[:8])
+        if response_id != query_id:
+            raise ValueError("DNS response for a different query")
+
+        offset = 12
+        for _ in range(questions):
+            offset = read_dns_name(packet, offset)[1] + 4
+
+        answers = []
+        for _ in range(answer_count):
+            offset = read_dns_name(packet, offset)[1]
+            record_type, _, ttl, length = struct.unpack("!HHIH", packet[offset:offset + 10])
+            offset += 10
+            if offset + length > len(packet):
+                raise ValueError("DNS record runs past the end of the packet")
+            value = parse_dns_rdata(packet, offset, record_type, length)
+            answers.append((DNS_TYPE_NAMES.get(record_type, str(record_type)), ttl, value))
+            offset += length
+    except (struct.error, IndexError):
+        raise ValueError("DNS response is cut short")
+    return flags & 0x0F, bool(flags & DNS_FLAG_TRUNCATED), answers
+
+async def dns_query_tcp(server, query):
+    """Send a query over TCP, for answers too large for UDP"""
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(*server), DNS_TIMEOUT)
+    try:
+        writer.write(struct.pack("!H", len(query)) + query)
+        length = struct.unpack("!H", await asyncio.wait_for(reader.readexactly(2), DNS_TIMEOUT))[0]
+        return await asyncio.wait_for(reader.readexactly(length), DNS_TIMEOUT)
+    finally:
+        writer.close()
+
+async def dns_query(server, name, record_type):
+    """Ask one nameserver for one name and type, answers are cached for their TTL"""
+    key = (server, name.lower(), record_type)
+    cached = dns_cache.pop(key, None)
+    if cached is not None and cached[0] > time.monotonic():
+        dns_cache[key] = cached
+        return cached[1]
+
+    async with dns_query_slots:
+        loop = asyncio.get_running_loop()
+        query_id = random.randint(0, 0xFFFF)
+        query = build_dns_query(query_id, name, record_type)
+        future = loop.create_future()
+        transport, _ = await loop.create_datagram_endpoint(lambda: DNSQueryProtocol(future), remote_addr=server)
+        try:
+            transport.sendto(query)
+            packet = await asyncio.wait_for(future, DNS_TIMEOUT)
+        finally:
+            transport.close()
+        rcode, truncated, answers = parse_dns_response(packet, query_id)
+        if truncated:
+            rcode, truncated, answers = parse_dns_response(await dns_query_tcp(server, query), query_id)
+
+    if rcode not in (0, 3):
+        raise RuntimeError(f"nameserver returned error code {rcode}")
+    # CNAMEs show up when asking for other types, only keep what was asked for
+    answers = [a for a in answers if a[0] == record_type]
+    ttl = min((a[1] for a in answers), default=DNS_NEGATIVE_TTL)
+    dns_cache[key] = (time.monotonic() + ttl, answers)
+    while len(dns_cache) > DNS_CACHE_SIZE:
+        del dns_cache[next(iter(dns_cache))]
+    return answers
+
+async def get_authoritative_nameservers():
+    """Addresses of the nameservers %check asks, looked up once per run"""
+    if config.dns_nameservers:
+        return config.dns_nameservers
+    zone_id = tenant().zone_id
+    if authoritative_nameservers.get(zone_id):
+        return authoritative_nameservers[zone_id]
+
+    response = await cloudflare_get(f"/zones/{zone_id}")
+    if response.status_code != 200:
+        raise RuntimeError(f"Failed to fetch the zone's nameservers. Status code: {response.status_code}")
+
+    loop = asyncio.get_running_loop()
+    servers = []
+    for host in response.json().get("result", {}).get("name_servers", []):
+        try:
+            addresses = await loop.getaddrinfo(host, 53, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        except socket.gaierror:
+            continue
+        servers.append((addresses[0][4][0], 53))
+    authoritative_nameservers[zone_id] = servers
+    return servers
+
+async def check_propagation(name, record_types):
+    """Query every nameserver for every type in parallel.
+
+    Returns {type: {server: answer values or an error string}}.
+    """
+    servers = await get_authoritative_nameservers()
+    lookups = [(record_type, server) for record_type in record_types for server in servers]
+    results = await asyncio.gather(*(dns_query(server, name, record_type) for record_type, server in lookups), return_exceptions=True)
+
+    report = {record_type: {} for record_type in record_types}
+    for (record_type, server), result in zip(lookups, results):
+        if isinstance(result, asyncio.TimeoutError):
+            report[record_type][server] = "timed out"
+        elif isinstance(result, Exception):
+            report[record_type][server] = str(result)
+        else:
+            report[record_type][server] = sorted(answer[2] for answer in result)
+    return report
+
+# Subdomain templates
+def load_templates():
+    if os.path.exists(TEMPLATES_FILE):
+        try:
+            with open(TEMPLATES_FILE, "r") as f:
+                return json.load(f)
+        except json.JSONDecodeError:
+            print("Error loading templates file, starting without templates")
+    return {}
+
+def save_templates():
+    try:
+        with open(TEMPLATES_FILE, "w") as f:
+            json.dump(templates, f, indent=4)
+    except Exception as e:
+        print(f"Error saving templates: {str(e)}")
+
+templates = {}
+
+def check_template_placeholders(text):
+    """Raise ValueError unless every placeholder in text is a plain {name}"""
+    try:
+        fields = [field for _, field, _, _ in string.Formatter().parse(text) if field is not None]
+    except ValueError:
+        raise ValueError(f"`{text}` has an unmatched `{{` or `}}`. Use `{{{{` and `}}}}` for literal braces.")
+    for field in fields:
+        if not field.isidentifier():
+            raise ValueError(f"`{{{field}}}` is not a valid placeholder, use a name like `{{ip}}`.")
+
+def parse_srv_content(content):
+    """Cloudflare's data for an SRV record written as `priority weight port target`, raises ValueError if it isn't"""
+    parts = content.split()
+    if len(parts) != 4 or not all(p.isdigit() and int(p) <= 65535 for p in parts[:3]) or not is_valid_hostname(parts[3]):
+        raise ValueError("SRV records need the form `priority weight port target`.")
+    return {"priority": int(parts[0]), "weight": int(parts[1]), "port": int(parts[2]), "target": parts[3]}
+
+def build_template_records(template, name, values):
+    """Turn a template into Cloudflare record payloads for the given subdomain.
+
+    Record names and contents may use {subdomain} and any key=value pair the user passed,
+    e.g. {ip}. Raises ValueError with a user-facing message if something is missing or invalid.
+    """
+    subdomain = f"{name}.{tenant().base_domain}"
+    values = {**values, "subdomain": subdomain}
+    records = []
+    for entry in template:
+        try:
+            content = entry["content"].format(**values)
+            record_name = entry["name"].format(**values)
+        except KeyError as e:
+            raise ValueError(f"This template needs a value for `{e.args[0]}`, e.g. `{e.args[0]}=...`")
+        except (IndexError, ValueError, AttributeError):
+            raise ValueError("This template has an invalid placeholder, ask an admin to fix it.")
+
+        record_type = entry["type"]
+        record = {
+            "type": record_type,
+            "name": subdomain if record_name == "@" else f"{record_name}.{subdomain}",
+            "ttl": 1,
+            "proxied": False
+        }
+
+        if record_type in ["A", "AAAA"] and not is_valid_ip(content):
+            raise ValueError(f"`{content}` is not a valid IP address for the {record_type} record.")
+        if record_type == "CNAME" and not is_valid_hostname(content):
+            raise ValueError(f"`{content}` is not a valid hostname for the CNAME record.")
+
+        if record_type == "MX":
+            priority, _, target = content.partition(" ")
+            if not priority.isdigit() or not is_valid_hostname(target):
+                raise ValueError("MX records need the form `priority mailserver`.")
+            record["priority"] = int(priority)
+            record["content"] = target
+        elif record_type == "SRV":
+            record["data"] = parse_srv_content(content)
+        else:
+            record["content"] = content
+        records.append(record)
+    return records
+
+# Background jobs
+class JobCancelled(Exception):
+    pass
+
+def load_jobs():
+    if os.path.exists(JOBS_FILE):
+        try:
+            with open(JOBS_FILE, "r") as f:
+                return json.load(f)
+        except json.JSONDecodeError:
+            print("Error loading jobs file, starting with an empty queue")
+    return {"next_id": 1, "jobs": {}}
+
+def write_jobs(data, temp_file):
+    try:
+        with open(temp_file, "w") as f:
+            f.write(data)
+        os.replace(temp_file, JOBS_FILE)
+    except Exception as e:
+        print(f"Error saving jobs: {str(e)}")
+
+def save_jobs():
+    write_jobs(json.dumps(job_state), f"{JOBS_FILE}.tmp")
+
+async def save_jobs_in_background():
+    """Save the jobs with the file written from a worker thread, for progress updates from running jobs"""
+    global jobs_saved_at
+    jobs_saved_at = time.monotonic()
+    data = json.dumps(job_state)
+    async with jobs_save_lock:
+        await asyncio.to_thread(write_jobs, data, f"{JOBS_FILE}.progress.tmp")
+
+# Running jobs save their progress at most this often, in seconds
+JOB_SAVE_INTERVAL = 5
+
+job_state = {"next_id": 1, "jobs": {}}
+job_queue = asyncio.Queue()
+job_workers = []
+jobs_saved_at = 0
+jobs_save_lock = asyncio.Lock()
+
+def enqueue_job(kind, args, ctx):
+    return enqueue_system_job(kind, args, {"author": str(ctx.author), "channel_id": ctx.channel.id})
+
+def enqueue_system_job(kind, args, owner):
+    """Queue a job on behalf of an admin command or the bot itself, owner has author and channel_id"""
+    job_id = str(job_state["next_id"])
+    job_state["next_id"] += 1
+    job = {
+        "id": job_id,
+        "kind": kind,
+        "args": args,
+        "status": "queued",
+        "progress": 0,
+        "total": 0,
+        "error": None,
+        "requested_by": owner["author"],
+        "channel_id": owner["channel_id"],
+        "tenant": tenant().guild_id,
+        "created_at": datetime.now(timezone.utc).isoformat()
+    }
+    job_state["jobs"][job_id] = job
+    prune_jobs()
+    save_jobs()
+    job_queue.put_nowait(job_id)
+    return job
+
+def prune_jobs():
+    finished = [j for j in job_state["jobs"].values() if j["status"] in ("done", "failed", "cancelled")]
+    for job in finished[:max(0, len(finished) - FINISHED_JOBS_KEPT)]:
+        del job_state["jobs"][job["id"]]
+
+def check_cancelled(job):
+    if job["status"] == "cancelling":
+        raise JobCancelled()
+
+async def job_progress(job, done=1):
+    """Record progress on a job and stop it if an admin cancelled it"""
+    job["progress"] += done
+    if time.monotonic() - jobs_saved_at >= JOB_SAVE_INTERVAL:
+        await save_jobs_in_background()
+    check_cancelled(job)
+
+async def purge_subdomain_records(job, names):
+    """Delete every DNS record of the subdomains with a single zone fetch, returns the number of records deleted.
+
+    The job's total is what's done plus what's still in the zone, so a resumed job doesn't count records twice.
+    """
+    check_cancelled(job)
+    response = await cloudflare_get(f"/zones/{tenant().zone_id}/dns_records")
+    if response.status_code != 200:
+        raise RuntimeError(f"Failed to fetch DNS records. Status code: {response.status_code}")
+
+    names = set(names)
+    with span("list scan"):
+        records_to_delete = [r for r in response.json().get("result", []) if subdomain_of(r["name"]) in names]
+    job["total"] = job["progress"] + len(records_to_delete)
+    await save_jobs_in_background()
+
+    deleted_count = 0
+    for start in range(0, len(records_to_delete), CLOUDFLARE_BATCH_LIMIT):
+        chunk = records_to_delete[start:start + CLOUDFLARE_BATCH_LIMIT]
+        results = await cloudflare_batch(deletes=[{"id": r["id"]} for r in chunk])
+        deleted_count += sum(1 for result in results["deletes"] if result is not None)
+        await job_progress(job, len(chunk))
+    for name in names:
+        (tenant().record_counts or {}).pop(name, None)
+    return deleted_count
+
+async def run_purge_subdomain(job):
+    """Remove a subdomain and its records, the optional reason argument is told to the owner"""
+    user_id, name = job["args"]["user_id"], job["args"]["name"]
+    try:
+        deleted_count = await purge_subdomain_records(job, [name])
+        if users.has_subdomain(user_id, name):
+            users.remove_subdomain(user_id, name)
+            save_data(users)
+    finally:
+        # Renewals queue the purge again next round if this one didn't finish
+        renewal_purges.discard(tenant().scoped(name))
+
+    reason = job["args"].get("reason")
+    description = f"Your subdomain **{name}.{tenant().base_domain}** was removed: {reason}." if reason else f"An administrator has removed your subdomain **{name}.{tenant().base_domain}**."
+    try:
+        user = await bot.fetch_user(int(user_id))
+        await user.send(embed=discord.Embed(
+            title="🗑️ Subdomain Removed",
+            description=description,
+            color=WARNING_COLOR,
+            timestamp=datetime.now(timezone.utc)
+        ))
+    except:
+        pass
+    return f"Removed subdomain **{name}.{tenant().base_domain}** and deleted {deleted_count} DNS records."
+
+async def run_purge_user(job):
+    user_id = job["args"]["user_id"]
+    user = users.get(user_id)
+    names = sorted(user.subdomains if user else ())
+    deleted_count = await purge_subdomain_records(job, names)
+    for name in names:
+        users.remove_subdomain(user_id, name)
+    save_data(users)
+    return f"Purged all subdomains of <@{user_id}> and deleted {deleted_count} DNS records."
+
+async def run_full_reset(job):
+    deleted_count = await purge_subdomain_records(job, list(users.owners))
+    tenant().users = UserStore()
+    save_data(users)
+    return f"All user data has been reset and {deleted_count} DNS records were deleted."
+
+JOB_HANDLERS = {
+    "purge_subdomain": run_purge_subdomain,
+    "purge_user": run_purge_user,
+    "full_reset": run_full_reset
+}
+
+async def job_worker():
+    while True:
+        job_id = await job_queue.get()
+        job = job_state["jobs"].get(job_id)
+        if job is None or job["status"] not in ("queued", "running"):
+            continue
+
+        job["status"] = "running"
+        save_jobs()
+        try:
+            job_tenant = find_tenant(job.get("tenant"))
+            if job_tenant is None:
+                raise RuntimeError(f"guild {job['tenant']} is no longer a tenant")
+            with tenant_scope(job_tenant):
+                result = await JOB_HANDLERS[job["kind"]](job)
+            job["status"] = "done"
+            embed = discord.Embed(title=f"✅ Job #{job_id} Finished", description=result, color=SUCCESS_COLOR)
+        except JobCancelled:
+            job["status"] = "cancelled"
+            embed = discord.Embed(
+                title=f"🛑 Job #{job_id} Cancelled",
+                description=f"Stopped after {job['progress']}/{job['total']} records.",
+                color=WARNING_COLOR
+            )
+        except Exception as e:
+            print(f"Error in job {job_id} ({job['kind']}): {str(e)}")
+            job["status"] = "failed"
+            job["error"] = str(e)
+            embed = error_embed(f"Job failed: {str(e)}", title=f"❌ Job #{job_id} Failed")
+        save_jobs()
+
+        channel = bot.get_channel(job["channel_id"]) if job["channel_id"] else None
+        if channel is not None:
+            try:
+                await channel.send(embed=embed)
+            except Exception as e:
+                print(f"Error reporting job {job_id}: {str(e)}")
+
+def start_job_workers():
+    """Start the workers and requeue jobs that were pending or running when the bot stopped"""
+    global job_state
+    if job_workers:
+        return
+    job_state = load_jobs()
+    for job in job_state["jobs"].values():
+        if job["status"] == "cancelling":
+            job["status"] = "cancelled"
+        elif job["status"] in ("queued", "running"):
+            # Handlers re-read the zone, so a half-done job just picks up what's left
+            job["status"] = "queued"
+            job_queue.put_nowait(job["id"])
+    save_jobs()
+    for _ in range(JOB_WORKERS):
+        job_workers.append(asyncio.create_task(job_worker()))
+
+# Credit engine
+RENEWAL_CHECK_INTERVAL = 60 * 60
+renewal_task = None
+renewal_warned = set()  # tenant-scoped subdomains whose owner was already told they can't pay
+renewal_purges = set()  # tenant-scoped subdomains already queued for removal
+
+def record_price(record_type):
+    return config.record_prices.get(record_type, 0)
+
+def template_price(template):
+    return config.template_prices.get(template, config.subdomain_price)
+
+async def notify_user(user_id, embed):
+    try:
+        user = bot.get_user(int(user_id)) or await bot.fetch_user(int(user_id))
+        await user.send(embed=embed)
+    except Exception as e:
+        print(f"Error sending DM to {user_id}: {str(e)}")
+
+async def run_renewals():
+    """Charge every subdomain of the current tenant that is due, remove the ones unpaid past the grace period"""
+    now = time.time()
+    interval = config.renewal_interval_days * 86400
+    grace = config.renewal_grace_days * 86400
+    changed = False
+    for name, user_id in list(users.owners.items()):
+        key = tenant().scoped(name)
+        user = users.get(user_id)
+        due = user.renewals.get(name)
+        if due is None:
+            user.renewals[name] = now + interval
+            changed = True
+            continue
+        if due > now:
+            continue
+
+        if user.credits >= config.renewal_price:
+            user.credits -= config.renewal_price
+            user.renewals[name] = due + interval
+            renewal_warned.discard(key)
+            changed = True
+        elif key in renewal_purges:
+            continue
+        elif now > due + grace:
+            renewal_purges.add(key)
+            print(f"Removing {name}, renewal unpaid since {datetime.fromtimestamp(due, timezone.utc)}")
+            enqueue_system_job(
+                "purge_subdomain",
+                {"user_id": user_id, "name": name, "reason": f"its renewal was unpaid for more than {config.renewal_grace_days} days"},
+                {"author": "renewals", "channel_id": None}
+            )
+            renewal_warned.discard(key)
+        elif key not in renewal_warned:
+            renewal_warned.add(key)
+            await notify_user(user_id, discord.Embed(
+                title="⚠️ Renewal Due",
+                description=f"Renewing **{name}.{tenant().base_domain}** costs {config.renewal_price} credits, but you only have {user.credits}.\nIt will be removed <t:{int(due + grace)}:R> unless you top up.",
+                color=WARNING_COLOR
+            ))
+    if changed:
+        save_data(users)
+
+async def renewal_loop():
+    while True:
+        if config.renewal_price > 0:
+            for guild_tenant in all_tenants():
+                try:
+                    with tenant_scope(guild_tenant):
+                        await run_renewals()
+                except Exception as e:
+                    print(f"Error running renewals for tenant {guild_tenant.key}: {str(e)}")
+        await asyncio.sleep(RENEWAL_CHECK_INTERVAL)
+
+def start_renewals():
+    global renewal_task
+    if renewal_task is None:
+        renewal_task = asyncio.create_task(renewal_loop())
+
+# Zone change feed
+zone_snapshot = None  # record id -> record, as of the last poll
+zone_cursor = ""  # newest modified_on seen so far
+change_feed_task = None
+
+def load_subscriptions():
+    if os.path.exists(SUBSCRIPTIONS_FILE):
+        try:
+            with open(SUBSCRIPTIONS_FILE, "r") as f:
+                return set(json.load(f))
+        except json.JSONDecodeError:
+            print("Error loading subscriptions file, starting without subscriptions")
+    return set()
+
+def save_subscriptions():
+    try:
+        with open(SUBSCRIPTIONS_FILE, "w") as f:
+            json.dump(sorted(subscribers), f)
+    except Exception as e:
+        print(f"Error saving subscriptions: {str(e)}")
+
+subscribers = set()
+
+def subdomain_of(record_name):
+    """The top-level subdomain label a record belongs to, e.g. foo for www.foo.BASE_DOMAIN"""
+    if not record_name.endswith(f".{tenant().base_domain}"):
+        return None
+    return record_name[:-len(tenant().base_domain) - 1].rsplit(".", 1)[-1]
+
+def diff_zone(records):
+    """Compare a fresh record list against the last snapshot and return the change events.
+
+    Only records modified after the cursor are compared, everything else is known unchanged.
+    """
+    global zone_snapshot, zone_cursor
+    previous = zone_snapshot or {}
+    events = []
+    current = {}
+    cursor = zone_cursor
+    for record in records:
+        current[record["id"]] = record
+        modified_on = record.get("modified_on", "")
+        if record["id"] not in previous:
+            events.append(("created", record))
+        elif modified_on > zone_cursor:
+            events.append(("updated", record))
+        cursor = max(cursor, modified_on)
+    for record_id, record in previous.items():
+        if record_id not in current:
+            events.append(("deleted", record))
+
+    first_snapshot = zone_snapshot is None
+    zone_snapshot = current
+    rebuild_record_counts(records)
+    zone_cursor = cursor
+    # The first poll only sets the baseline
+    return [] if first_snapshot else events
+
+def change_event_field(event, record):
+    icon = {"created": "🆕", "updated": "✏️", "deleted": "🗑️"}[event]
+    return f"{icon} {record['type']}: {record['name']}", f"{event.capitalize()}. Content: `{record.get('content', '')}`"
+
+async def send_change_batches(destination, events, title):
+    # An embed holds at most 25 fields, so big bursts of changes go out in several messages
+    for start in range(0, len(events), 25):
+        embed = discord.Embed(title=title, color=INFO_COLOR, timestamp=datetime.now(timezone.utc))
+        for event, record in events[start:start + 25]:
+            name, value = change_event_field(event, record)
+            embed.add_field(name=name, value=value, inline=False)
+        await destination.send(embed=embed)
+
+async def deliver_changes(events):
+    by_owner = {}
+    for event, record in events:
+        owner = users.owner_of(subdomain_of(record["name"]))
+        if owner in subscribers:
+            by_owner.setdefault(owner, []).append((event, record))
+
+    for owner, owner_events in by_owner.items():
+        try:
+            user = bot.get_user(int(owner)) or await bot.fetch_user(int(owner))
+            await send_change_batches(user, owner_events, "🔔 DNS Record Changes")
+        except Exception as e:
+            print(f"Error notifying {owner} of record changes: {str(e)}")
+
+    channel = bot.get_channel(config.change_log_channel_id) if config.change_log_channel_id else None
+    if channel is not None:
+        try:
+            await send_change_batches(channel, events, "📜 Zone Changes")
+        except Exception as e:
+            print(f"Error logging record changes: {str(e)}")
+
+async def change_feed():
+    while True:
+        try:
+            response = await cloudflare_get(f"/zones/{tenant().zone_id}/dns_records")
+            if response.status_code == 200:
+                events = diff_zone(response.json().get("result", []))
+                if events:
+                    await deliver_changes(events)
+            else:
+                print(f"Change feed could not fetch the zone. Status code: {response.status_code}")
+        except Exception as e:
+            print(f"Error in change feed: {str(e)}")
+        await asyncio.sleep(config.change_feed_interval)
+
+def start_change_feed():
+    global change_feed_task, subscribers
+    if change_feed_task is None:
+        subscribers = load_subscriptions()
+        change_feed_task = asyncio.create_task(change_feed())
+
+# Audit log
+# Entries are buffered in memory and appended to gzip segments in AUDIT_DIR by a background task.
+# A segment is closed after AUDIT_SEGMENT_ENTRIES entries. AUDIT_INDEX_FILE keeps the time range
+# of every segment, and a sorted list of the user ids in each segment is kept next to it, so
+# queries only open segments that can match.
+AUDIT_DIR = "audit"
+AUDIT_INDEX_FILE = os.path.join(AUDIT_DIR, "index.json")
+AUDIT_SEGMENT_ENTRIES = 10000
+AUDIT_FLUSH_INTERVAL = 5
+AUDIT_QUERY_LIMIT = 20
+
+audit_buffer = []
+audit_index = []  # one dict per segment, oldest first
+# Segment file -> user ids in it, a set for the open segment and a sorted tuple for closed ones
+audit_segment_users = {}
+audit_lock = asyncio.Lock()
+audit_task = None
+
+def audit(action, actor, targets=(), **details):
+    """Record an action in the current tenant, actor and targets are user ids (or "system")"""
+    entry = {"t": time.time(), "action": action, "actor": str(actor), "users": [str(t) for t in targets]}
+    if tenant().guild_id is not None:
+        entry["tenant"] = tenant().guild_id
+    audit_buffer.append(dict(entry, **details))
+
+def audit_users_file(segment_file):
+    return os.path.join(AUDIT_DIR, segment_file.replace(".jsonl.gz", ".users"))
+
+def save_audit_users(segment_file, user_ids):
+    with open(audit_users_file(segment_file), "w") as f:
+        f.write("\n".join(sorted(user_ids)))
+
+def load_audit_index():
+    """The segment index and the user ids of every segment"""
+    index = []
+    if os.path.exists(AUDIT_INDEX_FILE):
+        try:
+            with open(AUDIT_INDEX_FILE, "r") as f:
+                index = json.load(f)
+        except json.JSONDecodeError:
+            print("Error loading audit index, old audit entries won't be searchable")
+
+    segment_users = {}
+    for segment in index:
+        if "users" in segment:
+            # Written before the user ids moved out of the index
+            user_ids = segment.pop("users")
+            save_audit_users(segment["file"], user_ids)
+        else:
+            try:
+                with open(audit_users_file(segment["file"]), "r") as f:
+                    user_ids = f.read().split()
+            except FileNotFoundError:
+                user_ids = []
+        segment_users[segment["file"]] = tuple(sorted(user_ids))
+    if index:
+        segment_users[index[-1]["file"]] = set(segment_users[index[-1]["file"]])
+    return index, segment_users
+
+def save_audit_index():
+    temp_file = f"{AUDIT_INDEX_FILE}.tmp"
+    with open(temp_file, "w") as f:
+        json.dump(audit_index, f)
+    os.replace(temp_file, AUDIT_INDEX_FILE)
+
+def segment_has_user(segment_file, user_id):
+    user_ids = audit_segment_users.get(segment_file, ())
+    if isinstance(user_ids, set):
+        return user_id in user_ids
+    position = bisect.bisect_left(user_ids, user_id)
+    return position < len(user_ids) and user_ids[position] == user_id
+
+def index_audit_entries(entries):
+    """Assign entries to segments and update the index.
+
+    Returns (file, lines) pairs to append and the segments whose user ids changed.
+    """
+    writes = []
+    changed_users = set()
+    for entry in entries:
+        if not audit_index or audit_index[-1]["entries"] >= AUDIT_SEGMENT_ENTRIES:
+            if audit_index:
+                closed = audit_index[-1]["file"]
+                audit_segment_users[closed] = tuple(sorted(audit_segment_users[closed]))
+            audit_index.append({"file": f"segment-{len(audit_index) + 1:06d}.jsonl.gz", "first": entry["t"], "last": entry["t"], "entries": 0})
+            audit_segment_users[audit_index[-1]["file"]] = set()
+        segment = audit_index[-1]
+        segment["last"] = entry["t"]
+        segment["entries"] += 1
+        user_ids = audit_segment_users[segment["file"]]
+        for user_id in (entry["actor"], *entry["users"]):
+            if user_id not in user_ids:
+                user_ids.add(user_id)
+                changed_users.add(segment["file"])
+        if not writes or writes[-1][0] != segment["file"]:
+            writes.append((segment["file"], []))
+        writes[-1][1].append(json.dumps(entry, separators=(",", ":")))
+    return writes, changed_users
+
+def write_audit_entries(entries):
+    """Append entries to their segments, called from a worker thread except at shutdown"""
+    writes, changed_users = index_audit_entries(entries)
+    os.makedirs(AUDIT_DIR, exist_ok=True)
+    for file, lines in writes:
+        # Each append is its own gzip member, gzip reads them back as one stream
+        with gzip.open(os.path.join(AUDIT_DIR, file), "at") as f:
+            f.write("\n".join(lines) + "\n")
+    for file in changed_users:
+        save_audit_users(file, audit_segment_users[file])
+    save_audit_index()
+
+def flush_audit_log():
+    """Write out buffered entries synchronously, used at shutdown"""
+    entries = audit_buffer[:]
+    audit_buffer.clear()
+    if entries:
+        write_audit_entries(entries)
+
+async def audit_writer():
+    while True:
+        await asyncio.sleep(AUDIT_FLUSH_INTERVAL)
+        if not audit_buffer:
+            continue
+        try:
+            async with audit_lock:
+                entries = audit_buffer[:]
+                audit_buffer.clear()
+                await asyncio.to_thread(write_audit_entries, entries)
+        except Exception as e:
+            print(f"Error writing audit log: {str(e)}")
+
+def start_audit_log():
+    global audit_task, audit_index, audit_segment_users
+    if audit_task is None:
+        audit_index, audit_segment_users = load_audit_index()
+        audit_task = asyncio.create_task(audit_writer())
+
+def audit_matches(entry, guild_id, user_id, start, end):
+    if not start <= entry["t"] <= end or entry.get("tenant") != guild_id:
+        return False
+    return user_id is None or entry["actor"] == user_id or user_id in entry["users"]
+
+def read_audit_segments(files, guild_id, user_id, start, end, limit):
+    """Matching entries from the given segments, newest first"""
+    matches = []
+    for file in files:
+        path = os.path.join(AUDIT_DIR, file)
+        if not os.path.exists(path):
+            continue
+        with gzip.open(path, "rt") as f:
+            found = [entry for entry in map(json.loads, f) if audit_matches(entry, guild_id, user_id, start, end)]
+        matches.extend(reversed(found))
+        if len(matches) >= limit:
+            break
+    return matches[:limit]
+
+async def query_audit_log(user_id=None, start=0, end=float("inf"), limit=AUDIT_QUERY_LIMIT):
+    """The current tenant's newest entries for a user and/or time range, newest first"""
+    guild_id = tenant().guild_id
+    matches = [entry for entry in reversed(audit_buffer) if audit_matches(entry, guild_id, user_id, start, end)][:limit]
+    if len(matches) >= limit:
+        return matches
+    async with audit_lock:
+        files = [
+            segment["file"] for segment in reversed(audit_index)
+            if segment["last"] >= start and segment["first"] <= end and (user_id is None or segment_has_user(segment["file"], user_id))
+        ]
+        matches.extend(await asyncio.to_thread(read_audit_segments, files, guild_id, user_id, start, end, limit - len(matches)))
+    return matches
+
+AUDIT_RELATIVE_TIME = re.compile(r"^(\d+)([mhd])$")
+AUDIT_TIME_UNITS = {"m": 60, "h": 3600, "d": 86400}
+
+def parse_audit_time(value):
+    """A relative time like 30m, 24h or 7d, or an ISO date/time, as a unix timestamp"""
+    match = AUDIT_RELATIVE_TIME.match(value)
+    if match:
+        return time.time() - int(match.group(1)) * AUDIT_TIME_UNITS[match.group(2)]
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.timestamp()
+
+def format_audit_entry(entry):
+    actor = "system" if entry["actor"] == "system" else f"<@{entry['actor']}>"
+    line = f"<t:{int(entry['t'])}:f> **{entry['action']}** by {actor}"
+    if len(entry["users"]) == 1:
+        line += f" → <@{entry['users'][0]}>"
+    elif entry["users"]:
+        line += f" → {len(entry['users'])} users"
+    details = ", ".join(f"{key}: `{value}`" for key, value in entry.items() if key not in ("t", "action", "actor", "users", "tenant"))
+    return line + (f" ({details})" if details else "")
+
+# Record quotas
+# Record counts per subdomain and type for each tenant, built from a zone fetch on first use, rebuilt
+# from every change feed snapshot of the default zone and kept current in between by the bot's own
+# creates and deletes, so quota checks don't call the API.
+def rebuild_record_counts(records):
+    tenant().record_counts = {}
+    for record in records:
+        count_record(subdomain_of(record["name"]), record["type"], 1)
+
+def count_record(subdomain, record_type, delta):
+    record_counts = tenant().record_counts
+    if subdomain is None or record_counts is None:
+        return
+    counts = record_counts.setdefault(subdomain, {})
+    counts[record_type] = max(counts.get(record_type, 0) + delta, 0)
+
+def subdomain_record_counts(subdomain):
+    return (tenant().record_counts or {}).get(subdomain, {})
+
+# Tenant-scoped user id -> subdomains that user is creating right now, their records count toward
+# the user's quota before the subdomain is theirs
+pending_subdomains = {}
+# Tenant-scoped names of subdomains being created right now, so two creates can't both take one
+claimed_subdomains = set()
+
+def user_record_counts(user, pending=()):
+    totals = {}
+    for name in {*user.subdomains, *pending}:
+        for record_type, count in subdomain_record_counts(name).items():
+            totals[record_type] = totals.get(record_type, 0) + count
+    return totals
+
+def count_records(subdomain, record_types, delta):
+    for record_type in record_types:
+        count_record(subdomain, record_type, delta)
+
+async def ensure_record_index():
+    """Build the current tenant's record counts from a zone fetch if they haven't been built yet.
+
+    Does nothing while no record quota is configured, nothing needs the counts then.
+    """
+    if not (config.user_record_quota or config.subdomain_record_quota):
+        return
+    if tenant().record_counts is None:
+        response = await cloudflare_get(f"/zones/{tenant().zone_id}/dns_records")
+        if response.status_code != 200:
+            raise RuntimeError(f"Failed to fetch DNS records. Status code: {response.status_code}")
+        if tenant().record_counts is None:
+            rebuild_record_counts(response.json().get("result", []))
+
+def quota_exceeded(counts, new_types, quota):
+    """The first limit in quota that adding new_types to counts would break, as (type, limit), or None"""
+    if not quota:
+        return None
+    if "total" in quota and sum(counts.values()) + len(new_types) > quota["total"]:
+        return "total", quota["total"]
+    for record_type in set(new_types):
+        if record_type in quota and counts.get(record_type, 0) + new_types.count(record_type) > quota[record_type]:
+            return record_type, quota[record_type]
+    return None
+
+def record_quota_violation(user_id, subdomain, new_types):
+    """Why creating records of new_types under subdomain is over quota, or None if it's allowed"""
+    pending = pending_subdomains.get(tenant().scoped(user_id), ())
+    exceeded = quota_exceeded(user_record_counts(users.get_or_create(user_id), pending), new_types, config.user_record_quota)
+    if exceeded:
+        scope = "you"
+    else:
+        exceeded = quota_exceeded(subdomain_record_counts(subdomain), new_types, config.subdomain_record_quota)
+        scope = f"{subdomain}.{tenant().base_domain}"
+    if not exceeded:
+        return None
+    record_type, limit = exceeded
+    kind = "records" if record_type == "total" else f"{record_type} records"
+    return f"That would take {scope} over the limit of {limit} {kind}."
+
+def format_quota(counts, quota):
+    return "\n".join(
+        f"{'Total' if name == 'total' else name}: {sum(counts.values()) if name == 'total' else counts.get(name, 0)}/{limit}"
+        for name, limit in quota.items()
+    )
+
+# Squatting detection
+# Every %create_subdomain request is checked against the reserved names, the requester's recent
+# creation rate and the names the requester owns or others just asked for. Suspicious requests are
+# held for an admin instead of being created. Names are compared by their trigrams.
+HOLDS_FILE = "holds.json"
+# Seconds an approved request can be created in, the approval is used up by the create
+HOLD_APPROVAL_TTL = 7 * 86400
+# Trigram similarity (0 to 1) at which two names count as near-duplicates, and how many
+# near-duplicates among the user's own and everyone's recent names make a request suspicious
+SQUAT_SIMILARITY = 0.6
+SQUAT_SIMILAR_NAMES = 3
+# Similarity at which a name counts as a lookalike of a reserved name
+SQUAT_LOOKALIKE = 0.7
+# Reserved names this long or longer also match anywhere in a name, e.g. paypal-login
+SQUAT_MIN_SUBSTRING = 6
+SQUAT_LOOKALIKE_DIGITS = str.maketrans("0134578", "oleastb")
+
+recent_creates = deque()  # (time, user id, name) of requests within the burst window
+reserved_index = None  # (reserved set, long reserved names, trigram -> reserved names), rebuilt when config.reserved_names changes
+
+def load_holds():
+    if os.path.exists(HOLDS_FILE):
+        try:
+            with open(HOLDS_FILE, "r") as f:
+                state = json.load(f)
+            if isinstance(state["approved"], list):
+                # Approvals used to be kept without the time they were given
+                state["approved"] = {key: time.time() for key in state["approved"]}
+            return state
+        except json.JSONDecodeError:
+            print("Error loading holds file, starting without holds")
+    return {"next_id": 1, "holds": {}, "approved": {}}
+
+def save_holds():
+    try:
+        with open(HOLDS_FILE, "w") as f:
+            json.dump(hold_state, f, indent=4)
+    except Exception as e:
+        print(f"Error saving holds: {str(e)}")
+
+hold_state = None
+
+@functools.lru_cache(maxsize=4096)
+def trigrams(name):
+    # Runs of digits count as one symbol so shop1, shop2 and shop37 all look alike
+    padded = f"^{re.sub(r'[0-9]+', '#', name.lower())}$"
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+def similarity(a, b):
+    return len(a & b) / len(a | b) if a and b else 0.0
+
+def similar_names(name, index, threshold):
+    """Names in a trigram index at least threshold similar to name"""
+    grams = trigrams(name)
+    candidates = set()
+    for gram in grams:
+        candidates |= index.get(gram, set())
+    candidates.discard(name)
+    return [candidate for candidate in candidates if similarity(grams, trigrams(candidate)) >= threshold]
+
+def get_reserved_index():
+    global reserved_index
+    reserved = frozenset(name.lower() for name in config.reserved_names)
+    if reserved_index is None or reserved_index[0] != reserved:
+        index = {}
+        for name in reserved:
+            for gram in trigrams(name):
+                index.setdefault(gram, set()).add(name)
+        reserved_index = (reserved, tuple(name for name in reserved if len(name) >= SQUAT_MIN_SUBSTRING), index)
+    return reserved_index
+
+def reserved_match(name):
+    """The reserved name that name is, contains or imitates, or None"""
+    reserved, long_names, index = get_reserved_index()
+    lowered = name.lower()
+    for candidate in (lowered, lowered.translate(SQUAT_LOOKALIKE_DIGITS)):
+        if candidate in reserved:
+            return candidate
+        for reserved_name in long_names:
+            if reserved_name in candidate:
+                return reserved_name
+    if len(lowered) >= SQUAT_MIN_SUBSTRING:
+        lookalikes = similar_names(lowered.translate(SQUAT_LOOKALIKE_DIGITS), index, SQUAT_LOOKALIKE)
+        if lookalikes:
+            return lookalikes[0]
+    return None
+
+def squat_reasons(user_id, name):
+    """Why a create request looks like squatting, an empty list if it looks fine.
+
+    Also records the request for burst detection.
+    """
+    now = time.time()
+    count, per = config.squat_burst
+    while recent_creates and recent_creates[0][0] < now - per:
+        recent_creates.popleft()
+    recent_creates.append((now, user_id, name))
+
+    reasons = []
+    reserved = reserved_match(name)
+    if reserved:
+        reasons.append(f"matches the reserved name `{reserved}`")
+
+    requests_by_user = sum(1 for _, requester, _ in recent_creates if requester == user_id)
+    if requests_by_user > count:
+        reasons.append(f"{requests_by_user} create requests in the last {per // 60} minutes")
+
+    # Only the requester's own names and existing names others just asked for count, so those are
+    # the only ones compared instead of every name in the zone
+    user = users.get(user_id)
+    candidates = {recent_name for _, _, recent_name in recent_creates if users.owner_of(recent_name) is not None}
+    candidates.update(user.subdomains if user else ())
+    candidates.discard(name)
+    grams = trigrams(name)
+    similar = [other for other in candidates if similarity(grams, trigrams(other)) >= SQUAT_SIMILARITY]
+    if len(similar) >= SQUAT_SIMILAR_NAMES:
+        reasons.append(f"near-duplicate of {len(similar)} existing names, e.g. `{'`, `'.join(sorted(similar)[:3])}`")
+    return reasons
+
+def is_hold_approved(user_id, name):
+    approved = hold_state["approved"].get(tenant().scoped(f"{user_id}:{name}"))
+    return approved is not None and approved > time.time() - HOLD_APPROVAL_TTL
+
+def consume_hold_approval(user_id, name):
+    """Use up the approval for a request once it has been created, and drop approvals that expired"""
+    now = time.time()
+    key = tenant().scoped(f"{user_id}:{name}")
+    expired = [other for other, approved in hold_state["approved"].items() if approved <= now - HOLD_APPROVAL_TTL]
+    if key in hold_state["approved"] or expired:
+        hold_state["approved"].pop(key, None)
+        for other in expired:
+            del hold_state["approved"][other]
+        save_holds()
+
+def hold_request(user_id, name, reasons):
+    """Hold a request for review, returns the hold id. Asking again for a held name returns the same hold."""
+    for hold_id, hold in hold_state["holds"].items():
+        if (hold["user_id"], hold["name"], hold.get("tenant")) == (user_id, name, tenant().guild_id):
+            return hold_id
+    hold_id = str(hold_state["next_id"])
+    hold_state["next_id"] += 1
+    hold_state["holds"][hold_id] = {"user_id": user_id, "name": name, "reasons": reasons, "created": time.time(), "tenant": tenant().guild_id}
+    save_holds()
+    audit("hold_subdomain", "system", [user_id], name=name, hold=hold_id)
+    return hold_id
+
+def start_squat_detection():
+    global hold_state
+    if hold_state is None:
+        hold_state = load_holds()
+
+# ACME DNS-01 challenges
+# Challenge records from every user of a tenant are gathered for ACME_BATCH_WINDOW and created with
+# one batch request that takes a single Cloudflare slot, each caller gets its reply as soon as that
+# batch is done. Expired challenges are deleted together by a sweeper, also in batches.
+ACME_FILE = "acme.json"
+ACME_CHALLENGE_TTL = 60 * 60
+ACME_BATCH_WINDOW = 0.5
+ACME_SWEEP_INTERVAL = 60
+# Most live challenge records per subdomain, a wildcard plus SAN certificate needs a few
+ACME_MAX_VALUES = 10
+ACME_VALUE = re.compile(r"^[A-Za-z0-9_-]{1,255}$")
+
+acme_challenges = []  # {"id", "name", "subdomain", "user_id", "expires", "tenant"}
+acme_pending = {}  # tenant key -> [(record, future)] waiting for the next batch
+acme_flush_tasks = {}  # tenant key -> task that sends its next batch
+acme_reserved = {}  # tenant-scoped subdomain -> challenge values still being created
+acme_sweeper_task = None
+
+def load_acme_challenges():
+    if os.path.exists(ACME_FILE):
+        try:
+            with open(ACME_FILE, "r") as f:
+                return json.load(f)
+        except json.JSONDecodeError:
+            print("Error loading ACME challenges file, starting without challenges")
+    return []
+
+def save_acme_challenges():
+    try:
+        with open(ACME_FILE, "w") as f:
+            json.dump(acme_challenges, f, indent=4)
+    except Exception as e:
+        print(f"Error saving ACME challenges: {str(e)}")
+
+def tenant_challenges():
+    return [challenge for challenge in acme_challenges if challenge.get("tenant") == tenant().guild_id]
+
+def acme_target(name):
+    """Split a certificate name under a subdomain (foo, www.foo, *.foo or the full name) into the
+    subdomain and the host labels in front of it, raises RecordChangeError if it isn't valid"""
+    name = name.removesuffix(f".{tenant().base_domain}")
+    # A wildcard is validated on the name it covers
+    labels = name.removeprefix("*.").split(".")
+    host = ".".join(labels[:-1])
+    if not is_valid_subdomain(labels[-1]) or (host and not is_valid_hostname(host)):
+        raise RecordChangeError("Invalid Name", f"`{name}` isn't a name under one of your subdomains, e.g. `foo` or `www.foo`.")
+    return labels[-1], host
+
+def acme_record_name(subdomain, host=""):
+    return f"_acme-challenge.{host + '.' if host else ''}{subdomain}.{tenant().base_domain}"
+
+async def flush_acme_batch():
+    await asyncio.sleep(ACME_BATCH_WINDOW)
+    batch = acme_pending.pop(tenant().key)
+    del acme_flush_tasks[tenant().key]
+    try:
+        async with cloudflare_queue.slot("acme"):
+            results = await cloudflare_batch(posts=[record for record, _ in batch])
+    except Exception as e:
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(e)
+        return
+    for (_, future), result in zip(batch, results["posts"]):
+        if not future.done():
+            future.set_result(result)
+
+async def create_acme_challenges(user_id, subdomain, values, host=""):
+    """Add TXT challenge records for the values with the next shared batch, returns the created records.
+
+    host puts them under a name below the subdomain, e.g. www for a certificate that also covers www.foo.
+    """
+    if any(not ACME_VALUE.match(value) for value in values):
+        raise RecordChangeError("Invalid Challenge", "Challenge values are the base64url strings your ACME client prints.")
+    # Values from requests still waiting for their batch count too
+    key = tenant().scoped(subdomain)
+    live = sum(1 for challenge in tenant_challenges() if challenge["subdomain"] == subdomain) + acme_reserved.get(key, 0)
+    if live + len(values) > ACME_MAX_VALUES:
+        raise RecordChangeError("Too Many Challenges", f"{subdomain}.{tenant().base_domain} can have at most {ACME_MAX_VALUES} challenge records at once. Use `%acme_clear {subdomain}` to remove the old ones.", 403)
+
+    name = acme_record_name(subdomain, host)
+    loop = asyncio.get_running_loop()
+    futures = []
+    for value in values:
+        future = loop.create_future()
+        acme_pending.setdefault(tenant().key, []).append(({"type": "TXT", "name": name, "content": value, "ttl": 60, "proxied": False}, future))
+        futures.append(future)
+    if tenant().key not in acme_flush_tasks:
+        # The task inherits the current tenant, so it sends this tenant's batch to its zone
+        acme_flush_tasks[tenant().key] = asyncio.create_task(flush_acme_batch())
+
+    acme_reserved[key] = acme_reserved.get(key, 0) + len(values)
+    try:
+        results = await asyncio.gather(*futures)
+    finally:
+        acme_reserved[key] -= len(values)
+        if not acme_reserved[key]:
+            del acme_reserved[key]
+    created = [record for record in results if record is not None]
+    if not created:
+        raise RecordChangeError("Creation Failed", "Cloudflare didn't accept the challenge records.", 502)
+
+    expires = time.time() + ACME_CHALLENGE_TTL
+    for record in created:
+        acme_challenges.append({"id": record["id"], "name": name, "subdomain": subdomain, "user_id": user_id, "expires": expires, "tenant": tenant().guild_id})
+        count_record(subdomain, "TXT", 1)
+    save_acme_challenges()
+    audit("acme_challenge", user_id, name=subdomain, values=len(created))
+    return created
+
+async def remove_acme_challenges(challenges):
+    """Delete challenge records in one batch, returns how many were deleted"""
+    if not challenges:
+        return 0
+    async with cloudflare_queue.slot("acme"):
+        results = await cloudflare_batch(deletes=[{"id": challenge["id"]} for challenge in challenges])
+    now = time.time()
+    removed = set()
+    for challenge, result in zip(challenges, results["deletes"]):
+        # Records that can't be deleted (e.g. already purged with their subdomain) are given up on after a while
+        if result is not None or now > challenge["expires"] + ACME_CHALLENGE_TTL:
+            removed.add(challenge["id"])
+            if result is not None:
+                count_record(challenge["subdomain"], "TXT", -1)
+    acme_challenges[:] = [challenge for challenge in acme_challenges if challenge["id"] not in removed]
+    save_acme_challenges()
+    return sum(1 for result in results["deletes"] if result is not None)
+
+async def acme_sweeper():
+    while True:
+        try:
+            now = time.time()
+            for guild_tenant in all_tenants():
+                with tenant_scope(guild_tenant):
+                    await remove_acme_challenges([challenge for challenge in tenant_challenges() if challenge["expires"] <= now])
+        except Exception as e:
+            print(f"Error removing expired ACME challenges: {str(e)}")
+        await asyncio.sleep(ACME_SWEEP_INTERVAL)
+
+def start_acme_sweeper():
+    global acme_sweeper_task, acme_challenges
+    if acme_sweeper_task is None:
+        acme_challenges = load_acme_challenges()
+        acme_sweeper_task = asyncio.create_task(acme_sweeper())
+
+# Record sweeper
+# Finds placeholder records and records whose target doesn't answer on any PROBE_PORTS and tells
+# their owners in one DM each. Only placeholders are deleted, once they've stayed unchanged for
+# config.sweep_grace_days, a record can serve something other than the web so unreachable ones
+# are only reported. Proxied records are skipped, and so is a record that comes back to life.
+SWEEP_FILE = "sweep.json"
+PROBE_PORTS = (80, 443)
+PROBE_CONCURRENCY = 50
+PROBE_TIMEOUT = 3.0
+SWEEP_RECORD_TYPES = ("A", "AAAA", "CNAME")
+# Most records deleted per sweep and the pause between owner DMs, to stay easy on both APIs
+SWEEP_MAX_DELETES = CLOUDFLARE_BATCH_LIMIT
+SWEEP_NOTIFY_DELAY = 1.0
+
+sweep_flags = None  # record id -> {"name", "type", "content", "owner", "reason", "flagged", "tenant"}
+sweeper_task = None
+sweep_lock = asyncio.Lock()
+
+def load_sweep_flags():
+    if os.path.exists(SWEEP_FILE):
+        try:
+            with open(SWEEP_FILE, "r") as f:
+                return json.load(f)
+        except json.JSONDecodeError:
+            print("Error loading sweep file, starting without flagged records")
+    return {}
+
+def save_sweep_flags():
+    try:
+        with open(SWEEP_FILE, "w") as f:
+            json.dump(sweep_flags, f, indent=4)
+    except Exception as e:
+        print(f"Error saving sweep flags: {str(e)}")
+
+async def probe_port(host, port):
+    """True if host accepts a TCP connection on port, for port 80 it also has to answer an HTTP request"""
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), PROBE_TIMEOUT)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    try:
+        if port != 80:
+            return True
+        writer.write(f"HEAD / HTTP/1.0\r\nHost: {host}\r\n\r\n".encode())
+        await writer.drain()
+        return bool(await asyncio.wait_for(reader.read(1), PROBE_TIMEOUT))
+    except (OSError, asyncio.TimeoutError):
+        return False
+    finally:
+        writer.close()
+
+async def resolve_target(target):
+    """The addresses target points at, target itself if it's an address. Empty if it doesn't resolve."""
+    try:
+        return [ipaddress.ip_address(target)]
+    except ValueError:
+        pass
+    try:
+        infos = await asyncio.get_running_loop().getaddrinfo(target, None, type=socket.SOCK_STREAM)
+    except (OSError, UnicodeError):
+        return []
+    return list({ipaddress.ip_address(info[4][0]) for info in infos})
+
+async def probe_target(target, slots):
+    async with slots:
+        addresses = await resolve_target(target)
+        if not all(address.is_global for address in addresses):
+            # Private and reserved addresses can't be reached from here and aren't ours to probe,
+            # so they're given the benefit of the doubt
+            return True
+        for address in addresses:
+            for port in PROBE_PORTS:
+                if await probe_port(str(address), port):
+                    return True
+    return False
+
+async def find_dead_records(records):
+    """The reason each record should go, placeholder or unreachable, for the records that should"""
+    slots = asyncio.Semaphore(PROBE_CONCURRENCY)
+    targets = {record["content"] for record in records if record["content"] != PLACEHOLDER_IP}
+    alive = dict(zip(targets, await asyncio.gather(*(probe_target(target, slots) for target in targets))))
+    reasons = {}
+    for record in records:
+        if record["content"] == PLACEHOLDER_IP:
+            reasons[record["id"]] = "placeholder"
+        elif not alive[record["content"]]:
+            reasons[record["id"]] = "unreachable"
+    return reasons
+
+async def notify_sweep(by_owner, title, intro):
+    # One DM per owner, paced so a big sweep doesn't hit Discord's rate limits
+    for owner, lines in by_owner.items():
+        embed = discord.Embed(title=title, description=intro + "\n" + "\n".join(lines[:25]), color=WARNING_COLOR)
+        if len(lines) > 25:
+            embed.set_footer(text=f"and {len(lines) - 25} more")
+        await notify_user(owner, embed)
+        await asyncio.sleep(SWEEP_NOTIFY_DELAY)
+
+def tenant_sweep_flags():
+    return {record_id: flag for record_id, flag in sweep_flags.items() if flag.get("tenant") == tenant().guild_id}
+
+async def run_sweep():
+    """Flag, unflag and delete the current tenant's records, returns (newly flagged, deleted)"""
+    response = await cloudflare_get(f"/zones/{tenant().zone_id}/dns_records")
+    if response.status_code != 200:
+        raise RuntimeError(f"Failed to fetch DNS records. Status code: {response.status_code}")
+
+    candidates = []
+    owners = {}
+    for record in response.json().get("result", []):
+        owner = users.owner_of(subdomain_of(record["name"]) or "")
+        if owner is not None and record["type"] in SWEEP_RECORD_TYPES and not record.get("proxied"):
+            candidates.append(record)
+            owners[record["id"]] = owner
+    reasons = await find_dead_records(candidates)
+
+    now = time.time()
+    # Records that are gone or fine again drop out, new dead ones get flagged
+    for record_id in [record_id for record_id in tenant_sweep_flags() if record_id not in reasons]:
+        del sweep_flags[record_id]
+    flagged = {}
+    for record in candidates:
+        if record["id"] in reasons and record["id"] not in sweep_flags:
+            sweep_flags[record["id"]] = {
+                "name": record["name"], "type": record["type"], "content": record["content"],
+                "owner": owners[record["id"]], "reason": reasons[record["id"]], "flagged": now, "tenant": tenant().guild_id
+            }
+            flagged.setdefault(owners[record["id"]], {}).setdefault(reasons[record["id"]], []).append(f"{record['type']} `{record['name']}` → `{record['content']}`")
+
+    grace = config.sweep_grace_days * 86400
+    expired = [
+        (record_id, flag) for record_id, flag in tenant_sweep_flags().items()
+        if flag["reason"] == "placeholder" and now > flag["flagged"] + grace
+    ][:SWEEP_MAX_DELETES]
+    removed = {}
+    if expired:
+        async with cloudflare_queue.slot("sweeper"):
+            results = await cloudflare_batch(deletes=[{"id": record_id} for record_id, _ in expired])
+        for (record_id, flag), result in zip(expired, results["deletes"]):
+            if result is None:
+                continue
+            del sweep_flags[record_id]
+            count_record(subdomain_of(flag["name"]), flag["type"], -1)
+            audit("sweep_record", "system", [flag["owner"]], name=flag["name"], content=flag["content"], reason=flag["reason"])
+            removed.setdefault(flag["owner"], []).append(f"{flag['type']} `{flag['name']}` → `{flag['content']}`")
+    save_sweep_flags()
+
+    placeholders = {owner: lines["placeholder"] for owner, lines in flagged.items() if "placeholder" in lines}
+    unreachable = {owner: lines["unreachable"] for owner, lines in flagged.items() if "unreachable" in lines}
+    await notify_sweep(placeholders, "🧹 Records Scheduled for Removal", f"These records still point at the example address `{PLACEHOLDER_IP}`. They'll be deleted in {config.sweep_grace_days} days unless you change them:")
+    await notify_sweep(unreachable, "🧹 Records Not Responding", f"These records don't answer on ports {', '.join(map(str, PROBE_PORTS))}. They won't be deleted, but you may want to check them or remove them if they're no longer used:")
+    await notify_sweep(removed, "🧹 Records Removed", "These placeholder records were deleted after staying unchanged past the grace period:")
+    return sum(len(lines) for by_reason in flagged.values() for lines in by_reason.values()), sum(map(len, removed.values()))
+
+async def sweeper():
+    while True:
+        # An interval of 0 turns sweeping off, the setting is checked again every hour
+        await asyncio.sleep((config.sweep_interval_hours or 1) * 3600)
+        if config.sweep_interval_hours <= 0:
+            continue
+        for guild_tenant in all_tenants():
+            try:
+                async with sweep_lock:
+                    with tenant_scope(guild_tenant):
+                        flagged, removed = await run_sweep()
+                print(f"Record sweep of tenant {guild_tenant.key} flagged {flagged} and removed {removed} records")
+            except Exception as e:
+                print(f"Error sweeping records of tenant {guild_tenant.key}: {str(e)}")
+
+def start_sweeper():
+    global sweeper_task, sweep_flags
+    if sweeper_task is None:
+        sweep_flags = load_sweep_flags()
+        sweeper_task = asyncio.create_task(sweeper())
+
+# HTTP API
+# Optional JSON API on api_host:api_port for automation. Requests authenticate with a per-user
+# token from %api_token and go through the same ownership, credit, quota and rate limit checks
+# as Discord commands, sharing the Cloudflare client, read cache and request slots.
+API_TOKENS_FILE = "api_tokens.json"
+API_RECORD_NAME = re.compile(r"^([A-Za-z0-9_-]+\.)*[A-Za-z0-9_-]+$")
+
+api_tokens = {}  # sha256 of token -> user id, scoped to the tenant the token was issued in
+api_runner = None
+
+def load_api_tokens():
+    if os.path.exists(API_TOKENS_FILE):
+        try:
+            with open(API_TOKENS_FILE, "r") as f:
+                return json.load(f)
+        except json.JSONDecodeError:
+            print("Error loading API tokens file, starting without API tokens")
+    return {}
+
+def save_api_tokens():
+    try:
+        with open(API_TOKENS_FILE, "w") as f:
+            json.dump(api_tokens, f, indent=4)
+    except Exception as e:
+        print(f"Error saving API tokens: {str(e)}")
+
+def hash_api_token(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def issue_api_token(user_id):
+    """Replace the user's API token for the current tenant with a new one and return it, only its hash is stored"""
+    revoke_api_token(user_id)
+    token = secrets.token_urlsafe(32)
+    api_tokens[hash_api_token(token)] = tenant().scoped(user_id)
+    save_api_tokens()
+    return token
+
+def revoke_api_token(user_id):
+    owner = tenant().scoped(user_id)
+    for token_hash in [h for h, token_owner in api_tokens.items() if token_owner == owner]:
+        del api_tokens[token_hash]
+    save_api_tokens()
+
+def api_error(status, message):
+    return web.json_response({"error": message}, status=status)
+
+def api_record(record):
+    return {key: record.get(key) for key in ("id", "type", "name", "content", "data", "ttl", "proxied", "priority") if key in record}
+
+@web.middleware
+async def api_auth(request, handler):
+    header = request.headers.get("Authorization", "")
+    owner = api_tokens.get(hash_api_token(header[7:])) if header.startswith("Bearer ") else None
+    guild_id, _, user_id = (owner or "").rpartition("/")
+    token_tenant = find_tenant(guild_id or None)
+    if owner is None or token_tenant is None:
+        return api_error(401, "Missing or invalid API token.")
+    if not check_rate_limit(user_id, int(guild_id) if guild_id else None):
+        return api_error(429, "Too many requests, slow down.")
+    await users_loaded.wait()
+    if users_load_error is not None:
+        return api_error(503, "The bot couldn't load its data, try again later.")
+    request["user_id"] = user_id
+    with tenant_scope(token_tenant):
+        try:
+            if handler in API_BATCHED_HANDLERS:
+                return await handler(request)
+            async with cloudflare_queue.slot(user_id):
+                return await handler(request)
+        except RecordChangeError as e:
+            return api_error(e.status, e.description)
+        except CloudflareUnavailable:
+            response = api_error(503, "Cloudflare is unavailable, try again later.")
+            response.headers["Retry-After"] = str(max(cloudflare_breaker().retry_in(), 1))
+            return response
+        except json.JSONDecodeError:
+            return api_error(400, "The request body must be JSON.")
+        except web.HTTPException:
+            raise
+        except Exception as e:
+            print(f"Error in API request {request.method} {request.path}: {str(e)}")
+            return api_error(500, "Internal error.")
+
+def owned_subdomain(request):
+    name = request.match_info["name"]
+    if not users.has_subdomain(request["user_id"], name):
+        raise RecordChangeError("Not Found", f"You don't own {name}.{tenant().base_domain}.", 404)
+    return name
+
+async def owned_record(request, name):
+    response = await cloudflare_get(f"/zones/{tenant().zone_id}/dns_records")
+    if response.status_code != 200:
+        raise RecordChangeError("API Error", f"Failed to fetch DNS records. Status code: {response.status_code}", 502)
+    record_id = request.match_info["record_id"]
+    for record in subdomain_records(response.json().get("result", []), name):
+        if record["id"] == record_id:
+            return record
+    raise RecordChangeError("Not Found", "No such record under this subdomain.", 404)
+
+async def api_body(request):
+    body = await request.json()
+    if not isinstance(body, dict):
+        raise RecordChangeError("Invalid Body", "The request body must be a JSON object.")
+    return body
+
+def api_int(body, key, default, low, high, also=()):
+    """An integer field of a request body within [low, high] (or one of also), default if it's missing"""
+    value = body.get(key, default)
+    if isinstance(value, bool) or not isinstance(value, int) or not (low <= value <= high or value in also):
+        allowed = f"{' or '.join(map(str, also))} or " if also else ""
+        raise RecordChangeError("Invalid Value", f"{key} must be {allowed}a whole number from {low} to {high}.")
+    return value
+
+def api_ttl(body, default):
+    # 1 means automatic
+    return api_int(body, "ttl", default, 60, 86400, also=(1,))
+
+def validate_record_content(record_type, content):
+    if not isinstance(content, str) or not content:
+        raise RecordChangeError("Invalid Content", "content must be a non-empty string.")
+    if record_type in ["A", "AAAA"] and not is_valid_ip(content):
+        raise RecordChangeError("Invalid IP", "The provided IP address is invalid.")
+    if record_type in ["CNAME", "MX"] and not is_valid_hostname(content):
+        raise RecordChangeError("Invalid Hostname", "The provided hostname is invalid.")
+    if record_type == "SRV":
+        try:
+            parse_srv_content(content)
+        except ValueError as e:
+            raise RecordChangeError("Invalid SRV Record", str(e))
+
+def record_payload(record_type, name, content, ttl, proxied):
+    """The Cloudflare payload for a record, SRV records carry their fields in data instead of content"""
+    data = {"type": record_type, "name": name, "ttl": ttl, "proxied": proxied}
+    if record_type == "SRV":
+        data["data"] = parse_srv_content(content)
+    else:
+        data["content"] = content
+    return data
+
+async def api_list_subdomains(request):
+    user = users.get_or_create(request["user_id"])
+    return web.json_response({"credits": user.credits, "subdomains": sorted(user.subdomains)})
+
+async def api_list_records(request):
+    name = owned_subdomain(request)
+    response = await cloudflare_get(f"/zones/{tenant().zone_id}/dns_records")
+    if response.status_code != 200:
+        return api_error(502, f"Failed to fetch DNS records. Status code: {response.status_code}")
+    return web.json_response([api_record(r) for r in subdomain_records(response.json().get("result", []), name)])
+
+async def api_create_record(request):
+    name = owned_subdomain(request)
+    body = await api_body(request)
+    record_type = str(body.get("type", "")).upper()
+    if record_type not in config.record_types:
+        return api_error(400, f"type must be one of {', '.join(config.record_types)}.")
+    label = body.get("name") or "@"
+    if label != "@" and not (isinstance(label, str) and API_RECORD_NAME.match(label)):
+        return api_error(400, "name must be a relative record name like `www` or `_acme-challenge`, or `@`.")
+    validate_record_content(record_type, body.get("content"))
+
+    record_name = f"{name}.{tenant().base_domain}" if label == "@" else f"{label}.{name}.{tenant().base_domain}"
+    data = record_payload(record_type, record_name, body["content"], api_ttl(body, 1), False)
+    if record_type == "MX":
+        data["priority"] = api_int(body, "priority", 10, 0, 65535)
+    record = await create_user_record(request["user_id"], name, data, via="api")
+    return web.json_response(api_record(record), status=201)
+
+async def api_update_record(request):
+    name = owned_subdomain(request)
+    body = await api_body(request)
+    record = await owned_record(request, name)
+    validate_record_content(record["type"], body.get("content"))
+
+    data = record_payload(record["type"], record["name"], body["content"], api_ttl(body, record["ttl"]), record["proxied"])
+    if record["type"] == "MX":
+        data["priority"] = api_int(body, "priority", record.get("priority", 10), 0, 65535)
+    update_response = await cloudflare_request("PUT", f"/zones/{tenant().zone_id}/dns_records/{record['id']}", json=data)
+    if not (update_response.status_code == 200 and update_response.json().get("success")):
+        print(f"Failed to update record: {update_response.text}")
+        return api_error(502, f"Failed to update the record. API Error: {update_response.json().get('errors')}")
+    audit("edit_record", request["user_id"], type=record["type"], name=record["name"], old=record.get("content"), new=body["content"], via="api")
+    return web.json_response(api_record(update_response.json().get("result", data)))
+
+async def api_delete_record(request):
+    name = owned_subdomain(request)
+    record = await owned_record(request, name)
+    delete_response = await cloudflare_request("DELETE", f"/zones/{tenant().zone_id}/dns_records/{record['id']}")
+    if not (delete_response.status_code == 200 and delete_response.json().get("success")):
+        print(f"Failed to delete record: {delete_response.text}")
+        return api_error(502, f"Failed to delete the record. API Error: {delete_response.json().get('errors')}")
+    audit("delete_record", request["user_id"], type=record["type"], name=record["name"], content=record.get("content"), via="api")
+    count_record(name, record["type"], -1)
+    return web.json_response(api_record(record))
+
+async def api_create_acme(request):
+    name = owned_subdomain(request)
+    body = await api_body(request)
+    values = body.get("values")
+    if not isinstance(values, list) or not values or not all(isinstance(value, str) for value in values):
+        return api_error(400, "values must be a non-empty list of challenge strings.")
+    host = body.get("name") or ""
+    if not isinstance(host, str):
+        return api_error(400, "name must be a name under the subdomain like `www`, or left out for the subdomain itself.")
+    host = acme_target(f"{host}.{name}")[1] if host else ""
+    created = await create_acme_challenges(request["user_id"], name, values, host)
+    return web.json_response({"name": acme_record_name(name, host), "records": [api_record(r) for r in created], "expires_in": ACME_CHALLENGE_TTL}, status=201)
+
+async def api_clear_acme(request):
+    name = owned_subdomain(request)
+    deleted = await remove_acme_challenges([challenge for challenge in tenant_challenges() if challenge["subdomain"] == name])
+    return web.json_response({"deleted": deleted})
+
+# These queue their Cloudflare work into shared batches, which take a slot of their own
+API_BATCHED_HANDLERS = {api_create_acme, api_clear_acme}
+
+async def start_api():
+    global api_runner, api_tokens
+    if api_runner is not None or config.api_port is None:
+        return
+    api_tokens = load_api_tokens()
+    app = web.Application(middlewares=[api_auth])
+    app.add_routes([
+        web.get("/api/subdomains", api_list_subdomains),
+        web.get("/api/subdomains/{name}/records", api_list_records),
+        web.post("/api/subdomains/{name}/records", api_create_record),
+        web.put("/api/subdomains/{name}/records/{record_id}", api_update_record),
+        web.delete("/api/subdomains/{name}/records/{record_id}", api_delete_record),
+        web.post("/api/subdomains/{name}/acme", api_create_acme),
+        web.delete("/api/subdomains/{name}/acme", api_clear_acme)
+    ])
+    api_runner = web.AppRunner(app, access_log=None)
+    await api_runner.setup()
+    await web.TCPSite(api_runner, config.api_host, config.api_port).start()
+    print(f"HTTP API listening on {config.api_host}:{config.api_port}")
+
+# Config reloading
+def apply_config(new_config):
+    """Swap in a new config and drop state derived from the old one, returns restart-only fields that were skipped"""
+    global config, zone_snapshot, zone_cursor
+    old_config = config
+    skipped = []
+    for name in RESTART_ONLY_FIELDS:
+        if getattr(new_config, name) != getattr(old_config, name):
+            setattr(new_config, name, getattr(old_config, name))
+            skipped.append(name)
+
+    config = new_config
+
+    if (new_config.zone_id, new_config.base_domain) != (old_config.zone_id, old_config.base_domain):
+        zone_snapshot = None
+        zone_cursor = ""
+        for guild_tenant in all_tenants():
+            guild_tenant.record_counts = None
+        authoritative_nameservers.clear()
+        dns_cache.clear()
+    if new_config.record_types != old_config.record_types:
+        EMBED_TEMPLATES["record_type_menu"] = build_record_type_menu()
+    if new_config.user_rate_limit != old_config.user_rate_limit:
+        user_buckets.clear()
+    if new_config.guild_rate_limit != old_config.guild_rate_limit:
+        guild_buckets.clear()
+    return skipped
+
+async def reload_config():
+    new_config = await asyncio.to_thread(load_config)
+    skipped = apply_config(new_config)
+    print(f"Config reloaded from {CONFIG_FILE}" + (f", restart needed for: {', '.join(skipped)}" if skipped else ""))
+    return skipped
+
+async def reload_config_on_signal():
+    try:
+        await reload_config()
+    except Exception as e:
+        print(f"Error reloading config, keeping the current one: {str(e)}")
+
+def install_reload_signal():
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, lambda: asyncio.create_task(reload_config_on_signal()))
+    except (AttributeError, NotImplementedError, RuntimeError):
+        # No SIGHUP on this platform, %reload_config still works
+        pass
+
+# Startup
+users_loaded = asyncio.Event()
+users_load_task = None
+# Why the data couldn't be loaded, commands, DMs and the API report it instead of running
+users_load_error = None
+startup_ready = False
+
+DATA_UNAVAILABLE_EMBED = error_embed(
+    "The bot couldn't load its data and is not taking commands until an administrator fixes it and restarts it.",
+    title="❌ Data Unavailable"
+)
+
+class DataUnavailable(commands.CheckFailure):
+    """Raised by the global check when the data failed to load, the user has already been told"""
+
+def report_startup():
+    """Print the startup timings once the users are loaded and the gateway is ready"""
+    global startup_ready
+    if startup_ready or not {"users loaded", "gateway ready"} <= {name for name, _ in startup_phases}:
+        return
+    startup_ready = True
+    total = sum(seconds for _, seconds in startup_phases)
+    print("Startup: " + ", ".join(f"{name} {seconds:.3f}s" for name, seconds in startup_phases) + f", total {total:.3f}s")
+
+async def load_tenant_users(guild_tenant):
+    with tenant_scope(guild_tenant):
+        guild_tenant.users = await asyncio.to_thread(load_data)
+
+async def load_users_in_background():
+    """Read every tenant's data file in worker threads while the bot connects to the gateway"""
+    global templates, users_load_error
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(load_tenant_users(guild_tenant) for guild_tenant in all_tenants()))
+        templates = await asyncio.to_thread(load_templates)
+    except Exception as e:
+        users_load_error = str(e)
+        print(f"Error loading data, not taking commands until it is fixed and the bot restarted: {users_load_error}")
+        users_loaded.set()
+        return
+    mark_startup_phase("users loaded")
+    users_loaded.set()
+    report_startup()
+    print(f"Loaded {sum(len(guild_tenant.users) for guild_tenant in all_tenants())} users of {len(all_tenants())} tenants in {time.perf_counter() - started:.3f}s")
+    # Background work that needs the users starts only once they are there
+    start_job_workers()
+    start_renewals()
+    start_acme_sweeper()
+    start_squat_detection()
+    start_sweeper()
+
+async def setup_hook():
+    global users_load_task
+    mark_startup_phase("login")
+    users_load_task = asyncio.create_task(load_users_in_background())
+    start_audit_log()
+    start_session_writer()
+    await start_api()
+    install_reload_signal()
+
+bot.setup_hook = setup_hook
+
+@bot.check
+async def wait_for_users(ctx):
+    await users_loaded.wait()
+    if users_load_error is not None:
+        await ctx.send(embed=DATA_UNAVAILABLE_EMBED)
+        raise DataUnavailable()
+    return True
+
+@bot.event
+async def on_command_error(ctx, error):
+    if isinstance(error, DataUnavailable):
+        return
+    await commands.Bot.on_command_error(bot, ctx, error)
+
+@bot.before_invoke
+async def start_command(ctx):
+    # Every message is handled in a task of its own, so the tenant only applies to this command
+    current_tenant.set(tenant_for(ctx.guild.id if ctx.guild else None))
+    start_trace(ctx.command.qualified_name)
+
+@bot.after_invoke
+async def finish_command_trace(ctx):
+    finish_trace()
+
 @bot.event
 async def on_ready():
-    # Initialize global users dictionary
-    global users
-    users = load_data()
+    if not any(name == "gateway ready" for name, _ in startup_phases):
+        mark_startup_phase("gateway ready")
+        report_startup()
+    # The change feed's first poll fetches the whole zone, so it waits until we're connected
+    start_change_feed()
     print(f'Logged in as {bot.user} (ID: {bot.user.id})')
     print(f'Connected to {len(bot.guilds)} guilds')
     activity = discord.Activity(type=discord.ActivityType.watching, name="DNS records")
@@ -105,7 +3126,24 @@ async def ping(ctx):
     await ctx.send(embed=embed)
 
 def is_admin(ctx):
-    return ctx.author.guild_permissions.administrator
+    """Guild admins manage their own tenant, the commands they run only touch its users and zone.
+
+    Every guild that isn't a tenant shares the default one, so once admin_guild_id is set only
+    its admins manage the default tenant, not those of any guild the bot happens to be in.
+    """
+    if not ctx.author.guild_permissions.administrator:
+        return False
+    if config.admin_guild_id is not None and tenant_for(ctx.guild.id) is default_tenant:
+        return ctx.guild.id == config.admin_guild_id
+    return True
+
+def is_bot_admin(ctx):
+    """Admins allowed to change what every tenant shares, like the settings and templates"""
+    if not is_admin(ctx):
+        return False
+    if config.admin_guild_id is not None:
+        return ctx.guild.id == config.admin_guild_id
+    return tenant_for(ctx.guild.id) is default_tenant
 
 @bot.command()
 async def commands(ctx):
@@ -116,11 +3154,11 @@ async def commands(ctx):
         timestamp=datetime.now(timezone.utc)
     )
 
-    embed.add_field(name="General", value="`%ping` - Check if the bot is responding\n`%balance` - Check your credit balance", inline=False)
+    embed.add_field(name="General", value="`%ping` - Check if the bot is responding\n`%balance` - Check your credit balance\n`%prices` - Show what things cost", inline=False)
 
-    embed.add_field(name="Domain Management", value="`%create_subdomain name` - Create a subdomain (costs 10 credits)\n`%list_subdomains` - List all your subdomains\n`%records` - Interactive DNS record management", inline=False)
+    embed.add_field(name="Domain Management", value=f"`%create_subdomain name [template key=value ...]` - Create a subdomain (costs {config.subdomain_price} credits)\n`%templates` - List subdomain templates\n`%list_subdomains` - List all your subdomains\n`%records` - Interactive DNS record management\n`%check name [type]` - Check if a record is live\n`%subscribe` - Toggle DMs about changes to your records\n`%acme name value [value ...]` - Add ACME DNS-01 challenge records\n`%acme_clear name` - Remove your challenge records\n`%api_token [revoke]` - Get a token for the HTTP API", inline=False)
 
-    embed.add_field(name="Admin Commands", value="`%add_credits @user amount` - Add credits to a user\n`%remove_subdomain name @user` - Remove a user's subdomain\n`%remove_credits @user amount` - Remove credits from a user\n`%reset_all` - Reset all user data (requires confirmation string)", inline=False)
+    embed.add_field(name="Admin Commands", value="`%add_credits @user amount` - Add credits to a user\n`%grant_role @role amount` - Add credits to every member of a role\n`%grant_all amount` - Add credits to every member\n`%remove_subdomain name @user` - Remove a user's subdomain\n`%remove_credits @user amount` - Remove credits from a user\n`%purge_user @user` - Remove all of a user's subdomains\n`%reset_all` - Reset all user data and records (requires confirmation string)\n`%add_template name type record content` - Add a record to a template\n`%remove_template name` - Remove a template\n`%holds` - Show create requests held as possible squatting\n`%approve_hold id` / `%reject_hold id` - Review a held request\n`%sweep` - Flag placeholder and unreachable records now\n`%jobs` - Show background jobs\n`%cancel_job id` - Cancel a background job\n`%reload_config` - Reload the bot's settings\n`%startup` - Show startup timings\n`%profile [on [hz]|off]` - Profile command and DM handlers\n`%audit [@user|all] [since] [until]` - Search the audit log", inline=False)
 
     embed.set_footer(text=f"Requested by {ctx.author}", icon_url=ctx.author.avatar.url if ctx.author.avatar else None)
     await ctx.send(embed=embed)
@@ -130,39 +3168,48 @@ async def balance(ctx):
     try:
         user_id = str(ctx.author.id)
         if user_id not in users:
-            users[user_id] = {"credits": 0, "subdomains": []}
+            users.get_or_create(user_id)
             save_data(users)
 
-        credits = users[user_id]["credits"]
+        user = users.get(user_id)
+        credits = user.credits
         embed = discord.Embed(
             title="💰 Account Balance",
             description=f"You currently have **{credits} credits**.",
             color=INFO_COLOR,
             timestamp=datetime.now(timezone.utc)
         )
+        if config.renewal_price > 0 and user.renewals:
+            renewals = "\n".join(f"{name}.{tenant().base_domain}: <t:{int(due)}:R>" for name, due in sorted(user.renewals.items(), key=lambda item: item[1])[:10])
+            embed.add_field(name=f"Upcoming Renewals ({config.renewal_price} credits each)", value=renewals, inline=False)
+        if config.user_record_quota or config.subdomain_record_quota:
+            await ensure_record_index()
+            if config.user_record_quota:
+                embed.add_field(name="Record Quota", value=format_quota(user_record_counts(user), config.user_record_quota), inline=False)
+            if config.subdomain_record_quota:
+                for name in sorted(user.subdomains)[:10]:
+                    embed.add_field(name=f"{name}.{tenant().base_domain}", value=format_quota(subdomain_record_counts(name), config.subdomain_record_quota), inline=True)
         embed.set_footer(text=f"Requested by {ctx.author}", icon_url=ctx.author.avatar.url if ctx.author.avatar else None)
         await ctx.send(embed=embed)
     except Exception as e:
         print(f"Error in balance command: {str(e)}")
-        await ctx.send(embed=discord.Embed(title="❌ Error", description="An error occurred while checking your balance.", color=ERROR_COLOR))
+        await ctx.send(embed=error_embed("An error occurred while checking your balance."))
 
 @bot.command()
 async def add_credits(ctx, member: discord.Member, amount: int):
     try:
         if not is_admin(ctx):
-            embed = discord.Embed(title="❌ Permission Denied", description="You don't have permission to use this command.", color=ERROR_COLOR)
-            return await ctx.send(embed=embed)
+            return await ctx.send(embed=render_embed("permission_denied"))
 
         user_id = str(member.id)
-        if user_id not in users:
-            users[user_id] = {"credits": 0, "subdomains": []}
-
-        users[user_id]["credits"] += amount
+        user = users.get_or_create(user_id)
+        user.credits += amount
         save_data(users)
+        audit("add_credits", ctx.author.id, [user_id], amount=amount)
 
         embed = discord.Embed(
             title="💰 Credits Added",
-            description=f"Added **{amount} credits** to {member.mention}.\nThey now have **{users[user_id]['credits']} credits**.",
+            description=f"Added **{amount} credits** to {member.mention}.\nThey now have **{user.credits} credits**.",
             color=SUCCESS_COLOR,
             timestamp=datetime.now(timezone.utc)
         )
@@ -170,29 +3217,27 @@ async def add_credits(ctx, member: discord.Member, amount: int):
         await ctx.send(embed=embed)
     except Exception as e:
         print(f"Error in add_credits command: {str(e)}")
-        await ctx.send(embed=discord.Embed(title="❌ Error", description="An error occurred while adding credits.", color=ERROR_COLOR))
+        await ctx.send(embed=error_embed("An error occurred while adding credits."))
 
 @bot.command()
 async def remove_credits(ctx, member: discord.Member, amount: int):
     try:
         if not is_admin(ctx):
-            embed = discord.Embed(title="❌ Permission Denied", description="You don't have permission to use this command.", color=ERROR_COLOR)
-            return await ctx.send(embed=embed)
+            return await ctx.send(embed=render_embed("permission_denied"))
 
         user_id = str(member.id)
-        if user_id not in users:
-            users[user_id] = {"credits": 0, "subdomains": []}
-
-        if users[user_id]["credits"] < amount:
+        user = users.get_or_create(user_id)
+        if user.credits < amount:
             embed = discord.Embed(title="❌ Insufficient Credits", description=f"{member.mention} does not have enough credits to remove.", color=ERROR_COLOR)
             return await ctx.send(embed=embed)
 
-        users[user_id]["credits"] -= amount
+        user.credits -= amount
         save_data(users)
+        audit("remove_credits", ctx.author.id, [user_id], amount=amount)
 
         embed = discord.Embed(
             title="💰 Credits Removed",
-            description=f"Removed **{amount} credits** from {member.mention}.\nThey now have **{users[user_id]['credits']} credits**.",
+            description=f"Removed **{amount} credits** from {member.mention}.\nThey now have **{user.credits} credits**.",
             color=SUCCESS_COLOR,
             timestamp=datetime.now(timezone.utc)
         )
@@ -200,208 +3245,649 @@ async def remove_credits(ctx, member: discord.Member, amount: int):
         await ctx.send(embed=embed)
     except Exception as e:
         print(f"Error in remove_credits command: {str(e)}")
-        await ctx.send(embed=discord.Embed(title="❌ Error", description="An error occurred while removing credits.", color=ERROR_COLOR))
+        await ctx.send(embed=error_embed("An error occurred while removing credits."))
+
+MEMBER_LIST_DISABLED_EMBED = error_embed(
+    "The bot runs without the member list (`lean_gateway`), so it can't see role members. Turn `lean_gateway` off and restart to use bulk grants.",
+    title="❌ Member List Unavailable"
+)
+
+async def grant_to_members(ctx, members, amount, audience):
+    user_ids = [str(member.id) for member in members if not member.bot]
+    users.grant_credits(user_ids, amount)
+    save_data(users)
+    audit("grant_credits", ctx.author.id, user_ids, amount=amount)
+
+    embed = discord.Embed(
+        title="💰 Credits Granted",
+        description=f"Added **{amount} credits** to {len(user_ids)} members of {audience}.",
+        color=SUCCESS_COLOR,
+        timestamp=datetime.now(timezone.utc)
+    )
+    embed.set_footer(text=f"Action by {ctx.author}", icon_url=ctx.author.avatar.url if ctx.author.avatar else None)
+    await ctx.send(embed=embed)
+
+@bot.command()
+async def grant_role(ctx, role: discord.Role, amount: int):
+    try:
+        if not is_admin(ctx):
+            return await ctx.send(embed=render_embed("permission_denied"))
+        if amount <= 0:
+            return await ctx.send(embed=error_embed("The amount must be positive.", title="❌ Invalid Amount"))
+
+        if not bot.intents.members:
+            return await ctx.send(embed=MEMBER_LIST_DISABLED_EMBED)
+        if not ctx.guild.chunked:
+            await ctx.guild.chunk()
+        await grant_to_members(ctx, role.members, amount, role.mention)
+    except Exception as e:
+        print(f"Error in grant_role command: {str(e)}")
+        await ctx.send(embed=error_embed("An error occurred while granting credits."))
+
+@bot.command()
+async def grant_all(ctx, amount: int):
+    try:
+        if not is_admin(ctx):
+            return await ctx.send(embed=render_embed("permission_denied"))
+        if amount <= 0:
+            return await ctx.send(embed=error_embed("The amount must be positive.", title="❌ Invalid Amount"))
+
+        if not bot.intents.members:
+            return await ctx.send(embed=MEMBER_LIST_DISABLED_EMBED)
+        if not ctx.guild.chunked:
+            await ctx.guild.chunk()
+        await grant_to_members(ctx, ctx.guild.members, amount, "this server")
+    except Exception as e:
+        print(f"Error in grant_all command: {str(e)}")
+        await ctx.send(embed=error_embed("An error occurred while granting credits."))
+
+@bot.command()
+async def prices(ctx):
+    embed = discord.Embed(title="🏷️ Prices", color=INFO_COLOR, timestamp=datetime.now(timezone.utc))
+    embed.add_field(name="Subdomain", value=f"{config.subdomain_price} credits", inline=False)
+    if config.template_prices:
+        embed.add_field(name="Templates", value="\n".join(f"`{name}`: {price} credits" for name, price in config.template_prices.items()), inline=False)
+    if config.record_prices:
+        embed.add_field(name="Records", value="\n".join(f"{record_type}: {price} credits" for record_type, price in config.record_prices.items()), inline=False)
+    if config.renewal_price > 0:
+        embed.add_field(name="Renewal", value=f"{config.renewal_price} credits per subdomain every {config.renewal_interval_days} days", inline=False)
+    await ctx.send(embed=embed)
 
 @bot.command()
 async def remove_subdomain(ctx, name: str, member: discord.Member = None):
     try:
         if not is_admin(ctx):
-            embed = discord.Embed(title="❌ Permission Denied", description="You don't have permission to use this command.", color=ERROR_COLOR)
-            return await ctx.send(embed=embed)
+            return await ctx.send(embed=render_embed("permission_denied"))
 
         target_user = member or ctx.author
         user_id = str(target_user.id)
 
-        if user_id not in users or name not in users[user_id].get("subdomains", []):
+        if not users.has_subdomain(user_id, name):
             embed = discord.Embed(title="❌ Not Found", description=f"Subdomain not found for {target_user.mention}.", color=ERROR_COLOR)
             return await ctx.send(embed=embed)
 
-        subdomain = f"{name}.{BASE_DOMAIN}"
-        response = requests.get(
-            f"https://api.cloudflare.com/client/v4/zones/{ZONE_ID}/dns_records",
-            headers=headers
+        job = enqueue_job("purge_subdomain", {"user_id": user_id, "name": name}, ctx)
+        audit("remove_subdomain", ctx.author.id, [user_id], name=name, job=job["id"])
+        embed = discord.Embed(
+            title="🕒 Removal Queued",
+            description=f"Removing subdomain **{name}.{tenant().base_domain}** from {target_user.mention} as job **#{job['id']}**.\nUse `%jobs` to follow its progress.",
+            color=INFO_COLOR,
+            timestamp=datetime.now(timezone.utc)
         )
+        embed.set_footer(text=f"Action by {ctx.author}", icon_url=ctx.author.avatar.url if ctx.author.avatar else None)
+        await ctx.send(embed=embed)
 
-        if response.status_code != 200:
-            print(f"Cloudflare API error: {response.text}")
-            embed = discord.Embed(title="❌ API Error", description=f"Failed to connect to Cloudflare API. Status code: {response.status_code}", color=ERROR_COLOR)
+    except Exception as e:
+        print(f"Error in remove_subdomain command: {str(e)}")
+        await ctx.send(embed=error_embed(f"Error removing subdomain: {str(e)}"))
+
+@bot.command()
+async def reset_all(ctx):
+    try:
+        if not is_admin(ctx):
+            return await ctx.send(embed=render_embed("permission_denied"))
+
+        confirmation_string = ''.join(random.choices(string.ascii_letters + string.digits, k=10))
+        embed = discord.Embed(
+            title="⚠️ Confirmation Required",
+            description=f"To confirm resetting all user data, please type the following string:\n\n`{confirmation_string}`",
+            color=WARNING_COLOR,
+            timestamp=datetime.now(timezone.utc)
+        )
+        await ctx.send(embed=embed)
+
+        def check(m):
+            return m.author == ctx.author and m.content == confirmation_string
+
+        try:
+            msg = await bot.wait_for('message', check=check, timeout=60.0)
+        except asyncio.TimeoutError:
+            embed = discord.Embed(title="❌ Timeout", description="Confirmation string not entered in time.", color=ERROR_COLOR)
             return await ctx.send(embed=embed)
 
-        records = response.json().get("result", [])
-        records_to_delete = [r for r in records if r["name"].endswith(f"{name}.{BASE_DOMAIN}")]
+        job = enqueue_job("full_reset", {}, ctx)
+        audit("reset_all", ctx.author.id, job=job["id"])
+        embed = discord.Embed(
+            title="🕒 Reset Queued",
+            description=f"Deleting all subdomain records and resetting user data as job **#{job['id']}**.\nUse `%jobs` to follow its progress.",
+            color=INFO_COLOR,
+            timestamp=datetime.now(timezone.utc)
+        )
+        embed.set_footer(text=f"Action by {ctx.author}", icon_url=ctx.author.avatar.url if ctx.author.avatar else None)
+        await ctx.send(embed=embed)
+    except Exception as e:
+        print(f"Error in reset_all command: {str(e)}")
+        await ctx.send(embed=error_embed("An error occurred while resetting all user data."))
 
-        if not records_to_delete:
-            embed = discord.Embed(title="⚠️ Warning", description=f"No DNS records found for {subdomain}, but removing from user's list.", color=WARNING_COLOR)
-            users[user_id]["subdomains"].remove(name)
-            save_data(users)
+@bot.command(name="reload_config")
+async def reload_config_cmd(ctx):
+    try:
+        if not is_bot_admin(ctx):
+            return await ctx.send(embed=render_embed("permission_denied"))
+
+        try:
+            skipped = await reload_config()
+        except Exception as e:
+            print(f"Error reloading config: {str(e)}")
+            embed = error_embed(f"The config could not be loaded, the current settings are unchanged.\n`{str(e)}`", title="❌ Reload Failed")
+            return await ctx.send(embed=embed)
+
+        description = "The new settings are now in use."
+        if skipped:
+            description += f"\nThese settings need a restart to change: {', '.join(f'`{name}`' for name in skipped)}"
+        embed = discord.Embed(title="🔄 Config Reloaded", description=description, color=SUCCESS_COLOR, timestamp=datetime.now(timezone.utc))
+        embed.set_footer(text=f"Action by {ctx.author}", icon_url=ctx.author.avatar.url if ctx.author.avatar else None)
+        await ctx.send(embed=embed)
+    except Exception as e:
+        print(f"Error in reload_config command: {str(e)}")
+        await ctx.send(embed=error_embed("An error occurred while reloading the config."))
+
+@bot.command()
+async def startup(ctx):
+    if not is_bot_admin(ctx):
+        return await ctx.send(embed=render_embed("permission_denied"))
+
+    embed = discord.Embed(title="⏱️ Startup Timings", color=INFO_COLOR, timestamp=datetime.now(timezone.utc))
+    for name, seconds in startup_phases:
+        embed.add_field(name=name, value=f"{seconds * 1000:.0f}ms", inline=True)
+    embed.description = f"Process start to ready: **{sum(s for _, s in startup_phases) * 1000:.0f}ms**" if startup_ready else "The bot isn't ready yet."
+    await ctx.send(embed=embed)
+
+@bot.command(name="profile")
+async def profile_cmd(ctx, action: str = None, hz: int = PROFILE_DEFAULT_HZ):
+    try:
+        if not is_bot_admin(ctx):
+            return await ctx.send(embed=render_embed("permission_denied"))
+
+        if action == "on":
+            if not 1 <= hz <= 1000:
+                return await ctx.send(embed=error_embed("The sampling rate must be between 1 and 1000 per second.", title="❌ Invalid Rate"))
+            start_profiling(hz)
+            description = f"Tracing handlers and sampling the event loop {hz} times a second. Profiles are written to `{PROFILE_DIR}/` every {PROFILE_DUMP_INTERVAL} seconds."
+            return await ctx.send(embed=discord.Embed(title="🔬 Profiling On", description=description, color=SUCCESS_COLOR))
+        if action == "off":
+            stop_profiling()
+            await dump_profile()
+            return await ctx.send(embed=discord.Embed(title="🔬 Profiling Off", description=f"The last profile was written to `{PROFILE_DIR}/`.", color=SUCCESS_COLOR))
+
+        embed = discord.Embed(title="🔬 Profile", color=INFO_COLOR, timestamp=datetime.now(timezone.utc))
+        if profiler is None:
+            embed.description = "Profiling is off. Use `%profile on [samples per second]` to start it."
+        elif not profile_spans:
+            embed.description = "No handlers have run since the last dump."
+        else:
+            # Slowest handlers by total time since the last dump, with their average time per span
+            slowest = sorted(profile_spans.items(), key=lambda item: -item[1]["total"][1])[:10]
+            for handler, spans in slowest:
+                calls, total, worst = spans["total"]
+                breakdown = ", ".join(f"{name} {seconds / count * 1000:.1f}ms" for name, (count, seconds, _) in sorted(spans.items(), key=lambda item: -item[1][1]) if name != "total")
+                embed.add_field(name=f"{handler}: {calls} calls, avg {total / calls * 1000:.1f}ms, max {worst * 1000:.0f}ms", value=breakdown[:1024], inline=False)
+        await ctx.send(embed=embed)
+    except Exception as e:
+        print(f"Error in profile command: {str(e)}")
+        await ctx.send(embed=error_embed("An error occurred while profiling."))
+
+@bot.command()
+async def purge_user(ctx, member: discord.Member):
+    try:
+        if not is_admin(ctx):
+            return await ctx.send(embed=render_embed("permission_denied"))
+
+        user_id = str(member.id)
+        if user_id not in users or not users.get(user_id).subdomains:
+            embed = discord.Embed(title="❌ Not Found", description=f"{member.mention} doesn't have any subdomains.", color=ERROR_COLOR)
             return await ctx.send(embed=embed)
 
-        deleted_count = 0
-        for record in records_to_delete:
-            delete_response = requests.delete(
-                f"https://api.cloudflare.com/client/v4/zones/{ZONE_ID}/dns_records/{record['id']}",
-                headers=headers
-            )
+        job = enqueue_job("purge_user", {"user_id": user_id}, ctx)
+        audit("purge_user", ctx.author.id, [user_id], job=job["id"])
+        embed = discord.Embed(
+            title="🕒 Purge Queued",
+            description=f"Removing all subdomains of {member.mention} as job **#{job['id']}**.\nUse `%jobs` to follow its progress.",
+            color=INFO_COLOR,
+            timestamp=datetime.now(timezone.utc)
+        )
+        embed.set_footer(text=f"Action by {ctx.author}", icon_url=ctx.author.avatar.url if ctx.author.avatar else None)
+        await ctx.send(embed=embed)
+    except Exception as e:
+        print(f"Error in purge_user command: {str(e)}")
+        await ctx.send(embed=error_embed("An error occurred while queueing the purge."))
+
+@bot.command(name="audit")
+async def audit_log(ctx, target: str = "all", since: str = None, until: str = None):
+    try:
+        if not is_admin(ctx):
+            return await ctx.send(embed=render_embed("permission_denied"))
+
+        user_id = None
+        if target != "all":
+            match = re.fullmatch(r"<@!?(\d+)>|(\d+)", target)
+            if not match:
+                return await ctx.send(embed=error_embed("Give a user mention, a user id or `all`.", title="❌ Invalid User"))
+            user_id = match.group(1) or match.group(2)
+        try:
+            start = parse_audit_time(since) if since else 0
+            end = parse_audit_time(until) if until else float("inf")
+        except ValueError:
+            return await ctx.send(embed=error_embed("Times look like `30m`, `24h`, `7d` or an ISO date such as `2024-05-01`.", title="❌ Invalid Time"))
+
+        entries = await query_audit_log(user_id, start, end)
+        embed = discord.Embed(title="📜 Audit Log", color=INFO_COLOR, timestamp=datetime.now(timezone.utc))
+        if entries:
+            description = ""
+            for entry in entries:
+                line = format_audit_entry(entry) + "\n"
+                if len(description) + len(line) > 4000:
+                    break
+                description += line
+            embed.description = description
+        else:
+            embed.description = "No matching entries."
+        embed.set_footer(text=f"Newest {AUDIT_QUERY_LIMIT} matches first")
+        await ctx.send(embed=embed)
+    except Exception as e:
+        print(f"Error in audit command: {str(e)}")
+        await ctx.send(embed=error_embed("An error occurred while reading the audit log."))
+
+@bot.command()
+async def holds(ctx):
+    try:
+        if not is_admin(ctx):
+            return await ctx.send(embed=render_embed("permission_denied"))
+
+        embed = discord.Embed(title="⏸️ Held Requests", color=INFO_COLOR, timestamp=datetime.now(timezone.utc))
+        pending = [(hold_id, hold) for hold_id, hold in hold_state["holds"].items() if hold.get("tenant") == tenant().guild_id][-25:]
+        if not pending:
+            embed.description = "No requests are waiting for review."
+        for hold_id, hold in pending:
+            embed.add_field(
+                name=f"#{hold_id}: {hold['name']}.{tenant().base_domain}",
+                value=f"<@{hold['user_id']}> <t:{int(hold['created'])}:R>\n" + "\n".join(f"• {reason}" for reason in hold["reasons"]),
+                inline=False
+            )
+        embed.set_footer(text="Use %approve_hold id or %reject_hold id")
+        await ctx.send(embed=embed)
+    except Exception as e:
+        print(f"Error in holds command: {str(e)}")
+        await ctx.send(embed=error_embed("An error occurred while listing held requests."))
+
+async def resolve_hold(ctx, hold_id, approved):
+    hold = hold_state["holds"].get(hold_id)
+    # Admins only see the requests made in their own tenant
+    if hold is None or hold.get("tenant") != tenant().guild_id:
+        return await ctx.send(embed=error_embed(f"There is no held request **#{hold_id}**.", title="❌ Not Found"))
+    del hold_state["holds"][hold_id]
+    subdomain = f"{hold['name']}.{tenant().base_domain}"
+    if approved:
+        hold_state["approved"][tenant().scoped(f"{hold['user_id']}:{hold['name']}")] = time.time()
+    save_holds()
+    audit("approve_hold" if approved else "reject_hold", ctx.author.id, [hold["user_id"]], name=hold["name"], hold=hold_id)
+
+    if approved:
+        message = f"Your request for **{subdomain}** was approved. Run `%create_subdomain {hold['name']}` again within {HOLD_APPROVAL_TTL // 86400} days to create it."
+    else:
+        message = f"Your request for **{subdomain}** was rejected by an admin."
+    await notify_user(hold["user_id"], discord.Embed(title="⏸️ Request Reviewed", description=message, color=SUCCESS_COLOR if approved else ERROR_COLOR))
+
+    embed = discord.Embed(
+        title="✅ Hold Approved" if approved else "🗑️ Hold Rejected",
+        description=f"Request **#{hold_id}** for {subdomain} by <@{hold['user_id']}> was {'approved' if approved else 'rejected'}.",
+        color=SUCCESS_COLOR
+    )
+    embed.set_footer(text=f"Action by {ctx.author}", icon_url=ctx.author.avatar.url if ctx.author.avatar else None)
+    await ctx.send(embed=embed)
+
+@bot.command()
+async def approve_hold(ctx, hold_id: str):
+    try:
+        if not is_admin(ctx):
+            return await ctx.send(embed=render_embed("permission_denied"))
+        await resolve_hold(ctx, hold_id, True)
+    except Exception as e:
+        print(f"Error in approve_hold command: {str(e)}")
+        await ctx.send(embed=error_embed("An error occurred while approving the request."))
 
-            if delete_response.status_code == 200 and delete_response.json().get("success"):
-                deleted_count += 1
+@bot.command()
+async def reject_hold(ctx, hold_id: str):
+    try:
+        if not is_admin(ctx):
+            return await ctx.send(embed=render_embed("permission_denied"))
+        await resolve_hold(ctx, hold_id, False)
+    except Exception as e:
+        print(f"Error in reject_hold command: {str(e)}")
+        await ctx.send(embed=error_embed("An error occurred while rejecting the request."))
 
-        users[user_id]["subdomains"].remove(name)
-        save_data(users)
+@bot.command()
+async def sweep(ctx):
+    try:
+        if not is_admin(ctx):
+            return await ctx.send(embed=render_embed("permission_denied"))
+        if sweep_lock.locked():
+            return await ctx.send(embed=error_embed("A sweep is already running.", title="❌ Busy"))
 
+        await ctx.send(embed=discord.Embed(title="🧹 Sweeping", description="Probing records, this can take a minute.", color=INFO_COLOR))
+        async with sweep_lock:
+            flagged, removed = await run_sweep()
         embed = discord.Embed(
-            title="🗑️ Subdomain Removed",
-            description=f"Successfully removed subdomain **{subdomain}** from {target_user.mention}.\nDeleted {deleted_count} DNS records.",
+            title="🧹 Sweep Finished",
+            description=f"Flagged **{flagged}** new records and removed **{removed}**. **{sum(flag['reason'] == 'placeholder' for flag in tenant_sweep_flags().values())}** placeholder records are waiting out their grace period.",
             color=SUCCESS_COLOR,
             timestamp=datetime.now(timezone.utc)
         )
         embed.set_footer(text=f"Action by {ctx.author}", icon_url=ctx.author.avatar.url if ctx.author.avatar else None)
         await ctx.send(embed=embed)
+    except Exception as e:
+        print(f"Error in sweep command: {str(e)}")
+        await ctx.send(embed=error_embed(f"Error sweeping records: {str(e)}"))
 
-        if target_user != ctx.author:
-            try:
-                user_embed = discord.Embed(
-                    title="🗑️ Subdomain Removed",
-                    description=f"An administrator has removed your subdomain **{subdomain}**.",
-                    color=WARNING_COLOR,
-                    timestamp=datetime.now(timezone.utc)
-                )
-                await target_user.send(embed=user_embed)
-            except:
-                pass
+@bot.command()
+async def jobs(ctx):
+    try:
+        if not is_admin(ctx):
+            return await ctx.send(embed=render_embed("permission_denied"))
 
+        recent_jobs = [job for job in job_state["jobs"].values() if job.get("tenant") == tenant().guild_id][-10:]
+        embed = discord.Embed(
+            title="🕒 Background Jobs",
+            description="No jobs yet." if not recent_jobs else "Most recent jobs:",
+            color=INFO_COLOR,
+            timestamp=datetime.now(timezone.utc)
+        )
+        for job in reversed(recent_jobs):
+            value = f"Status: `{job['status']}`\nProgress: `{job['progress']}/{job['total']}`\nRequested by: {job['requested_by']}"
+            if job["error"]:
+                value += f"\nError: `{job['error']}`"
+            embed.add_field(name=f"#{job['id']} {job['kind']}", value=value, inline=False)
+        await ctx.send(embed=embed)
     except Exception as e:
-        print(f"Error in remove_subdomain command: {str(e)}")
-        await ctx.send(embed=discord.Embed(title="❌ Error", description=f"Error removing subdomain: {str(e)}", color=ERROR_COLOR))
+        print(f"Error in jobs command: {str(e)}")
+        await ctx.send(embed=error_embed("An error occurred while listing jobs."))
 
 @bot.command()
-async def reset_all(ctx):
+async def cancel_job(ctx, job_id: str):
     try:
         if not is_admin(ctx):
-            embed = discord.Embed(title="❌ Permission Denied", description="You don't have permission to use this command.", color=ERROR_COLOR)
+            return await ctx.send(embed=render_embed("permission_denied"))
+
+        job = job_state["jobs"].get(job_id.lstrip("#"))
+        if job is None or job.get("tenant") != tenant().guild_id or job["status"] not in ("queued", "running"):
+            embed = discord.Embed(title="❌ Not Found", description=f"No pending job #{job_id.lstrip('#')}.", color=ERROR_COLOR)
             return await ctx.send(embed=embed)
 
-        confirmation_string = ''.join(random.choices(string.ascii_letters + string.digits, k=10))
+        # Queued jobs are skipped by the workers, running ones stop after their current batch
+        job["status"] = "cancelled" if job["status"] == "queued" else "cancelling"
+        save_jobs()
+        embed = discord.Embed(title="🛑 Cancelling Job", description=f"Job **#{job['id']}** will be stopped.", color=WARNING_COLOR)
+        await ctx.send(embed=embed)
+    except Exception as e:
+        print(f"Error in cancel_job command: {str(e)}")
+        await ctx.send(embed=error_embed("An error occurred while cancelling the job."))
+
+@bot.command(name="templates")
+async def list_templates(ctx):
+    try:
         embed = discord.Embed(
-            title="⚠️ Confirmation Required",
-            description=f"To confirm resetting all user data, please type the following string:\n\n`{confirmation_string}`",
-            color=WARNING_COLOR,
+            title="🧩 Subdomain Templates",
+            description="Use `%create_subdomain name template key=value ...` to apply one." if templates else "No templates have been defined yet.",
+            color=INFO_COLOR,
             timestamp=datetime.now(timezone.utc)
         )
+        for template_name, template in templates.items():
+            value = "\n".join(f"`{entry['type']} {entry['name']} {entry['content']}`" for entry in template) or "No records"
+            embed.add_field(name=template_name, value=value, inline=False)
         await ctx.send(embed=embed)
+    except Exception as e:
+        print(f"Error in templates command: {str(e)}")
+        await ctx.send(embed=error_embed("An error occurred while listing templates."))
 
-        def check(m):
-            return m.author == ctx.author and m.content == confirmation_string
+@bot.command()
+async def add_template(ctx, template: str, record_type: str, record_name: str, *, content: str):
+    try:
+        if not is_bot_admin(ctx):
+            return await ctx.send(embed=render_embed("permission_denied"))
+
+        record_type = record_type.upper()
+        if record_type not in config.record_types:
+            embed = discord.Embed(title="❌ Invalid Record Type", description=f"Record type must be one of {', '.join(config.record_types)}.", color=ERROR_COLOR)
+            return await ctx.send(embed=embed)
 
         try:
-            msg = await bot.wait_for('message', check=check, timeout=60.0)
-        except asyncio.TimeoutError:
-            embed = discord.Embed(title="❌ Timeout", description="Confirmation string not entered in time.", color=ERROR_COLOR)
+            check_template_placeholders(record_name)
+            check_template_placeholders(content)
+        except ValueError as e:
+            embed = discord.Embed(title="❌ Invalid Template", description=str(e), color=ERROR_COLOR)
             return await ctx.send(embed=embed)
 
-        global users
-        users = {}
-        save_data(users)
+        templates.setdefault(template, []).append({"type": record_type, "name": record_name, "content": content})
+        save_templates()
 
         embed = discord.Embed(
-            title="✅ All User Data Reset",
-            description="All user data has been successfully reset.",
+            title="🧩 Template Updated",
+            description=f"Added `{record_type} {record_name} {content}` to template `{template}`.\nUse `@` as the name for the subdomain itself and `{{ip}}`-style placeholders for values users pass in.",
             color=SUCCESS_COLOR,
             timestamp=datetime.now(timezone.utc)
         )
         embed.set_footer(text=f"Action by {ctx.author}", icon_url=ctx.author.avatar.url if ctx.author.avatar else None)
         await ctx.send(embed=embed)
     except Exception as e:
-        print(f"Error in reset_all command: {str(e)}")
-        await ctx.send(embed=discord.Embed(title="❌ Error", description="An error occurred while resetting all user data.", color=ERROR_COLOR))
+        print(f"Error in add_template command: {str(e)}")
+        await ctx.send(embed=error_embed("An error occurred while updating the template."))
+
+@bot.command()
+async def remove_template(ctx, template: str):
+    try:
+        if not is_bot_admin(ctx):
+            return await ctx.send(embed=render_embed("permission_denied"))
+
+        if templates.pop(template, None) is None:
+            embed = discord.Embed(title="❌ Not Found", description=f"There is no template called `{template}`.", color=ERROR_COLOR)
+            return await ctx.send(embed=embed)
+        save_templates()
+
+        embed = discord.Embed(title="🧩 Template Removed", description=f"Removed template `{template}`.", color=SUCCESS_COLOR)
+        await ctx.send(embed=embed)
+    except Exception as e:
+        print(f"Error in remove_template command: {str(e)}")
+        await ctx.send(embed=error_embed("An error occurred while removing the template."))
 
 @bot.command()
-async def create_subdomain(ctx, name: str):
+@rate_limited
+async def create_subdomain(ctx, name: str, template: str = None, *values: str):
     try:
         if not is_valid_subdomain(name):
             embed = discord.Embed(title="❌ Invalid Name", description="Invalid subdomain name. Use only alphanumeric characters and hyphens.", color=ERROR_COLOR)
             return await ctx.send(embed=embed)
 
+        template_records = None
+        if template is not None:
+            if template not in templates:
+                embed = discord.Embed(title="❌ Unknown Template", description=f"There is no template called `{template}`. Use `%templates` to see them.", color=ERROR_COLOR)
+                return await ctx.send(embed=embed)
+            if any("=" not in value for value in values):
+                embed = discord.Embed(title="❌ Invalid Template Values", description="Template values must look like `key=value`.", color=ERROR_COLOR)
+                return await ctx.send(embed=embed)
+            try:
+                template_values = dict(value.split("=", 1) for value in values)
+                template_records = build_template_records(templates[template], name, template_values)
+            except ValueError as e:
+                embed = discord.Embed(title="❌ Invalid Template Values", description=str(e), color=ERROR_COLOR)
+                return await ctx.send(embed=embed)
+
+        if not cloudflare_breaker().available():
+            return await ctx.send(embed=render_embed("cloudflare_down"))
+
         user_id = str(ctx.author.id)
-        if user_id not in users:
-            users[user_id] = {"credits": 0, "subdomains": []}
+        user = users.get_or_create(user_id)
 
-        if users[user_id]["credits"] < 10:
+        price = config.subdomain_price if template is None else template_price(template)
+        if user.credits < price:
             embed = discord.Embed(
                 title="❌ Insufficient Credits",
-                description="You need 10 credits to create a subdomain. You currently have " + str(users[user_id]["credits"]) + " credits.",
+                description=f"You need {price} credits to create a subdomain. You currently have " + str(user.credits) + " credits.",
                 color=ERROR_COLOR
             )
             return await ctx.send(embed=embed)
 
-        subdomain = f"{name}.{BASE_DOMAIN}"
-
-        response = requests.get(
-            f"https://api.cloudflare.com/client/v4/zones/{ZONE_ID}/dns_records",
-            headers=headers
-        )
-
-        if response.status_code != 200:
-            print(f"Cloudflare API error: {response.text}")
-            embed = discord.Embed(title="❌ API Error", description=f"Failed to connect to Cloudflare API. Status code: {response.status_code}", color=ERROR_COLOR)
-            return await ctx.send(embed=embed)
+        subdomain = f"{name}.{tenant().base_domain}"
 
-        records = response.json().get("result", [])
-        if any(r["name"] == subdomain for r in records):
+        if users.owner_of(name) is not None:
             embed = discord.Embed(title="⚠️ Already Exists", description=f"Subdomain {subdomain} already exists.", color=WARNING_COLOR)
             return await ctx.send(embed=embed)
 
-        existing_subdomains = users[user_id]["subdomains"]
-        if any(subdomain.startswith(f"{existing}.{BASE_DOMAIN}") for existing in existing_subdomains) or name == BASE_DOMAIN:
-            embed = discord.Embed(title="❌ Invalid Subdomain", description="You cannot create a subdomain on an existing subdomain or the root domain.", color=ERROR_COLOR)
-            return await ctx.send(embed=embed)
-
-        data = {
-            "type": "A",
-            "name": subdomain,
-            "content": "1.2.3.4",
-            "ttl": 1,
-            "proxied": False
-        }
-
-        create_response = requests.post(
-            f"https://api.cloudflare.com/client/v4/zones/{ZONE_ID}/dns_records",
-            headers=headers,
-            json=data
-        )
-
-        if create_response.status_code == 200 or create_response.json().get("success"):
-            users[user_id]["credits"] -= 10
-            users[user_id]["subdomains"].append(name)
-            save_data(users)
-
+        reasons = squat_reasons(user_id, name)
+        if reasons and not is_hold_approved(user_id, name):
+            hold_id = hold_request(user_id, name, reasons)
             embed = discord.Embed(
-                title="✅ Subdomain Created. Remember to delete the example record!",
-                description=f"Successfully created subdomain **{subdomain}**\nDefault IP: `1.2.3.4`",
-                color=SUCCESS_COLOR,
-                timestamp=datetime.now(timezone.utc)
+                title="⏸️ Held for Review",
+                description=f"Your request for **{subdomain}** needs an admin's approval (hold **#{hold_id}**). You haven't been charged, you'll get a DM once it's reviewed.",
+                color=WARNING_COLOR
             )
-            embed.add_field(name="Next Steps", value="Use `%records` to manage DNS records for this subdomain.")
-            embed.set_footer(text=f"Created by {ctx.author}", icon_url=ctx.author.avatar.url if ctx.author.avatar else None)
-            await ctx.send(embed=embed)
-        else:
-            print(f"Failed to create subdomain: {create_response.text}")
-            embed = discord.Embed(
-                title="❌ Creation Failed",
-                description=f"Failed to create subdomain. API Error: {create_response.json().get('errors')}",
-                color=ERROR_COLOR
+            return await ctx.send(embed=embed)
+
+        # Claimed and charged before the first await so concurrent creates can't take the same name
+        # or spend the same credits, both are given back unless the subdomain gets created
+        claim = tenant().scoped(name)
+        if claim in claimed_subdomains:
+            embed = discord.Embed(title="⚠️ Already Exists", description=f"Subdomain {subdomain} is already being created.", color=WARNING_COLOR)
+            return await ctx.send(embed=embed)
+        claimed_subdomains.add(claim)
+        user.credits -= price
+        new_types = [record["type"] for record in template_records] if template_records is not None else ["A"]
+        pending = None
+        subdomain_created = False
+        try:
+            response = await cloudflare_get(f"/zones/{tenant().zone_id}/dns_records")
+
+            if response.status_code != 200:
+                print(f"Cloudflare API error: {response.text}")
+                embed = render_embed("api_error", description=f"Failed to connect to Cloudflare API. Status code: {response.status_code}")
+                return await ctx.send(embed=embed)
+
+            records = response.json().get("result", [])
+            if any(r["name"] == subdomain for r in records):
+                embed = discord.Embed(title="⚠️ Already Exists", description=f"Subdomain {subdomain} already exists.", color=WARNING_COLOR)
+                return await ctx.send(embed=embed)
+
+            if name == tenant().base_domain:
+                embed = discord.Embed(title="❌ Invalid Subdomain", description="You cannot create a subdomain on an existing subdomain or the root domain.", color=ERROR_COLOR)
+                return await ctx.send(embed=embed)
+
+            await ensure_record_index()
+            violation = record_quota_violation(user_id, name, new_types)
+            if violation:
+                embed = discord.Embed(title="❌ Record Limit Reached", description=violation, color=ERROR_COLOR)
+                return await ctx.send(embed=embed)
+
+            # Counted before the create so concurrent creates see them in their quota check, undone if it fails
+            count_records(name, new_types, 1)
+            pending = pending_subdomains.setdefault(tenant().scoped(user_id), set())
+            pending.add(name)
+            if template_records is not None:
+                created, ok = await create_record_set(template_records)
+                if not ok:
+                    embed = discord.Embed(
+                        title="❌ Creation Failed",
+                        description=f"Failed to create the records of template `{template}`. Nothing was created and no credits were charged.",
+                        color=ERROR_COLOR
+                    )
+                    return await ctx.send(embed=embed)
+
+                users.add_subdomain(user_id, name)
+                save_data(users)
+                audit("create_subdomain", user_id, name=name, price=price)
+                consume_hold_approval(user_id, name)
+                subdomain_created = True
+
+                embed = discord.Embed(
+                    title="✅ Subdomain Created",
+                    description=f"Successfully created subdomain **{subdomain}** from template `{template}`.",
+                    color=SUCCESS_COLOR,
+                    timestamp=datetime.now(timezone.utc)
+                )
+                for record in template_records:
+                    content = record.get("content") or " ".join(str(v) for v in record["data"].values())
+                    embed.add_field(name=f"{record['type']}: {record['name']}", value=f"`{content}`", inline=False)
+                embed.set_footer(text=f"Created by {ctx.author}", icon_url=ctx.author.avatar.url if ctx.author.avatar else None)
+                return await ctx.send(embed=embed)
+
+            data = {
+                "type": "A",
+                "name": subdomain,
+                "content": PLACEHOLDER_IP,
+                "ttl": 1,
+                "proxied": False
+            }
+
+            create_response = await cloudflare_request(
+                "POST",
+                f"/zones/{tenant().zone_id}/dns_records",
+                json=data
             )
-            await ctx.send(embed=embed)
+
+            if create_response.status_code == 200 or create_response.json().get("success"):
+                users.add_subdomain(user_id, name)
+                save_data(users)
+                audit("create_subdomain", user_id, name=name, price=price)
+                consume_hold_approval(user_id, name)
+                subdomain_created = True
+
+                embed = discord.Embed(
+                    title="✅ Subdomain Created. Remember to delete the example record!",
+                    description=f"Successfully created subdomain **{subdomain}**\nDefault IP: `{PLACEHOLDER_IP}`",
+                    color=SUCCESS_COLOR,
+                    timestamp=datetime.now(timezone.utc)
+                )
+                embed.add_field(name="Next Steps", value=f"Use `%records` to manage DNS records for this subdomain. Unchanged example records are removed automatically {config.sweep_grace_days} days after the next sweep.")
+                embed.set_footer(text=f"Created by {ctx.author}", icon_url=ctx.author.avatar.url if ctx.author.avatar else None)
+                await ctx.send(embed=embed)
+            else:
+                print(f"Failed to create subdomain: {create_response.text}")
+                embed = discord.Embed(
+                    title="❌ Creation Failed",
+                    description=f"Failed to create subdomain. API Error: {create_response.json().get('errors')}",
+                    color=ERROR_COLOR
+                )
+                await ctx.send(embed=embed)
+        finally:
+            claimed_subdomains.discard(claim)
+            if pending is not None:
+                pending.discard(name)
+                if not pending:
+                    pending_subdomains.pop(tenant().scoped(user_id), None)
+                if not subdomain_created:
+                    count_records(name, new_types, -1)
+            if not subdomain_created:
+                user.credits += price
     except Exception as e:
         print(f"Error in create_subdomain command: {str(e)}")
-        embed = discord.Embed(title="❌ Error", description=f"Error creating subdomain: {str(e)}", color=ERROR_COLOR)
+        embed = error_embed(f"Error creating subdomain: {str(e)}")
         await ctx.send(embed=embed)
 
 @bot.command()
+@throttled
 async def list_subdomains(ctx):
     try:
         user_id = str(ctx.author.id)
-        if user_id not in users or not users[user_id].get("subdomains"):
+        if user_id not in users or not users.get(user_id).subdomains:
             embed = discord.Embed(
                 title="📋 Your Subdomains",
                 description="You don't have any subdomains yet.\nUse `%create_subdomain name` to create one.",
@@ -409,7 +3895,7 @@ async def list_subdomains(ctx):
             )
             return await ctx.send(embed=embed)
 
-        subdomains = users[user_id]["subdomains"]
+        subdomains = sorted(users.get(user_id).subdomains)
         embed = discord.Embed(
             title="📋 Your Subdomains",
             description=f"You have {len(subdomains)} subdomain(s):",
@@ -418,17 +3904,169 @@ async def list_subdomains(ctx):
         )
 
         for subdomain in subdomains:
-            full_domain = f"{subdomain}.{BASE_DOMAIN}"
+            full_domain = f"{subdomain}.{tenant().base_domain}"
             embed.add_field(name=full_domain, value="Use `%records` to manage DNS records.", inline=False)
 
         embed.set_footer(text=f"Requested by {ctx.author}", icon_url=ctx.author.avatar.url if ctx.author.avatar else None)
         await ctx.send(embed=embed)
     except Exception as e:
         print(f"Error in list_subdomains command: {str(e)}")
-        embed = discord.Embed(title="❌ Error", description="An error occurred while listing your subdomains.", color=ERROR_COLOR)
+        embed = error_embed("An error occurred while listing your subdomains.")
+        await ctx.send(embed=embed)
+
+@bot.command()
+async def subscribe(ctx):
+    """Toggle DMs about changes to records under your subdomains"""
+    try:
+        user_id = str(ctx.author.id)
+        if user_id in subscribers:
+            subscribers.discard(user_id)
+            description = "You will no longer get DMs about changes to your DNS records."
+        else:
+            subscribers.add(user_id)
+            description = "You will now get a DM whenever records under your subdomains change."
+        save_subscriptions()
+
+        embed = discord.Embed(title="🔔 Change Notifications", description=description, color=SUCCESS_COLOR)
+        await ctx.send(embed=embed)
+    except Exception as e:
+        print(f"Error in subscribe command: {str(e)}")
+        await ctx.send(embed=error_embed("An error occurred while updating your subscription."))
+
+@bot.command()
+@throttled
+async def check(ctx, name: str, record_type: str = None):
+    """Check whether a record is being served by the zone's nameservers"""
+    try:
+        record_types = CHECK_RECORD_TYPES
+        if record_type is not None:
+            record_type = record_type.upper()
+            if record_type not in DNS_TYPES:
+                embed = discord.Embed(title="❌ Invalid Record Type", description=f"Record type must be one of {', '.join(DNS_TYPES)}.", color=ERROR_COLOR)
+                return await ctx.send(embed=embed)
+            record_types = [record_type]
+
+        base_domain = tenant().base_domain
+        fqdn = name if name == base_domain or name.endswith(f".{base_domain}") else f"{name}.{base_domain}"
+        if not is_valid_hostname(fqdn.replace("_", "")):
+            embed = discord.Embed(title="❌ Invalid Name", description="That is not a valid DNS name.", color=ERROR_COLOR)
+            return await ctx.send(embed=embed)
+
+        report = await check_propagation(fqdn, record_types)
+        embed = discord.Embed(
+            title=f"🔎 DNS Check for {fqdn}",
+            description="Answers from the zone's authoritative nameservers:",
+            color=INFO_COLOR,
+            timestamp=datetime.now(timezone.utc)
+        )
+        for checked_type, answers_by_server in report.items():
+            answers = list(answers_by_server.values())
+            if not answers or all(a == [] for a in answers):
+                if record_type is not None:
+                    embed.add_field(name=checked_type, value="No records found yet.", inline=False)
+                continue
+            if all(a == answers[0] for a in answers) and not isinstance(answers[0], str):
+                values = "\n".join(f"`{v}`" for v in answers[0])
+                embed.add_field(name=f"✅ {checked_type}", value=f"Live on all {len(answers)} nameservers:\n{values}", inline=False)
+            else:
+                lines = []
+                for server, result in answers_by_server.items():
+                    shown = result if isinstance(result, str) else ", ".join(f"`{v}`" for v in result) or "no records"
+                    lines.append(f"{server[0]}: {shown}")
+                embed.add_field(name=f"⏳ {checked_type}", value="Still propagating:\n" + "\n".join(lines), inline=False)
+
+        if not embed.fields:
+            embed.description = "No records found on the zone's nameservers yet."
+        embed.set_footer(text=f"Requested by {ctx.author}", icon_url=ctx.author.avatar.url if ctx.author.avatar else None)
+        await ctx.send(embed=embed)
+    except Exception as e:
+        print(f"Error in check command: {str(e)}")
+        await ctx.send(embed=error_embed("An error occurred while checking DNS propagation."))
+
+@bot.command()
+@throttled
+async def acme(ctx, name: str, *values: str):
+    try:
+        user_id = str(ctx.author.id)
+        name, host = acme_target(name)
+        if not users.has_subdomain(user_id, name):
+            embed = discord.Embed(title="❌ Not Found", description=f"You don't own {name}.{tenant().base_domain}.", color=ERROR_COLOR)
+            return await ctx.send(embed=embed)
+        if not values:
+            embed = discord.Embed(title="❌ Missing Challenge", description="Give the challenge value(s) your ACME client printed, e.g. `%acme name value1 value2`.", color=ERROR_COLOR)
+            return await ctx.send(embed=embed)
+        if not cloudflare_breaker().available():
+            return await ctx.send(embed=render_embed("cloudflare_down"))
+
+        created = await create_acme_challenges(user_id, name, list(values), host)
+        embed = discord.Embed(
+            title="🔐 Challenge Records Created",
+            description=f"Created {len(created)} TXT record(s) at `{acme_record_name(name, host)}`.\nThey're removed automatically <t:{int(time.time() + ACME_CHALLENGE_TTL)}:R>, or use `%acme_clear {name}` once your certificate is issued.",
+            color=SUCCESS_COLOR,
+            timestamp=datetime.now(timezone.utc)
+        )
+        if len(created) < len(values):
+            embed.add_field(name="⚠️ Partly Failed", value=f"{len(values) - len(created)} value(s) couldn't be added.", inline=False)
+        await ctx.send(embed=embed)
+    except RecordChangeError as e:
+        await ctx.send(embed=discord.Embed(title=f"❌ {e.title}", description=e.description, color=ERROR_COLOR))
+    except Exception as e:
+        print(f"Error in acme command: {str(e)}")
+        await ctx.send(embed=error_embed("An error occurred while creating the challenge records."))
+
+@bot.command()
+@throttled
+async def acme_clear(ctx, name: str):
+    try:
+        user_id = str(ctx.author.id)
+        name = acme_target(name)[0]
+        if not users.has_subdomain(user_id, name):
+            embed = discord.Embed(title="❌ Not Found", description=f"You don't own {name}.{tenant().base_domain}.", color=ERROR_COLOR)
+            return await ctx.send(embed=embed)
+
+        deleted = await remove_acme_challenges([challenge for challenge in tenant_challenges() if challenge["subdomain"] == name])
+        embed = discord.Embed(title="🗑️ Challenges Removed", description=f"Deleted {deleted} challenge record(s) of {name}.{tenant().base_domain}.", color=SUCCESS_COLOR)
         await ctx.send(embed=embed)
+    except RecordChangeError as e:
+        await ctx.send(embed=discord.Embed(title=f"❌ {e.title}", description=e.description, color=ERROR_COLOR))
+    except Exception as e:
+        print(f"Error in acme_clear command: {str(e)}")
+        await ctx.send(embed=error_embed("An error occurred while removing the challenge records."))
+
+@bot.command()
+async def api_token(ctx, action: str = None):
+    try:
+        if config.api_port is None:
+            return await ctx.send(embed=error_embed("The HTTP API is turned off.", title="❌ API Disabled"))
+
+        user_id = str(ctx.author.id)
+        if action == "revoke":
+            revoke_api_token(user_id)
+            audit("revoke_api_token", user_id)
+            embed = discord.Embed(title="🔑 API Token Revoked", description="Your API token no longer works.", color=SUCCESS_COLOR)
+            return await ctx.send(embed=embed)
+
+        token = issue_api_token(user_id)
+        audit("issue_api_token", user_id)
+        embed = discord.Embed(
+            title="🔑 API Token",
+            description=f"`{token}`\n\nSend it as `Authorization: Bearer <token>`. This replaces any token you had before, use `%api_token revoke` to turn it off.",
+            color=INFO_COLOR
+        )
+        await ctx.author.send(embed=embed)
+        if ctx.guild is not None:
+            await ctx.send(embed=discord.Embed(title="🔑 API Token", description="Your new API token was sent to your DMs.", color=INFO_COLOR))
+    except discord.Forbidden:
+        await ctx.send(embed=error_embed(
+            "I couldn't send you a direct message. Please make sure your privacy settings allow DMs from server members.",
+            title="❌ DM Error"
+        ))
+    except Exception as e:
+        print(f"Error in api_token command: {str(e)}")
+        await ctx.send(embed=error_embed("An error occurred while creating your API token."))
 
 @bot.command()
+@throttled
 async def records(ctx):
     """Interactive DNS record management through DMs"""
     try:
@@ -441,7 +4079,7 @@ async def records(ctx):
         )
         await ctx.send(embed=initial_embed)
 
-        if user_id not in users or not users[user_id].get("subdomains"):
+        if user_id not in users or not users.get(user_id).subdomains:
             no_domains_embed = discord.Embed(
                 title="❌ No Subdomains",
                 description="You don't have any subdomains yet.\nUse `%create_subdomain name` to create one first.",
@@ -449,12 +4087,14 @@ async def records(ctx):
             )
             return await ctx.author.send(embed=no_domains_embed)
 
+        subdomains = sorted(users.get(user_id).subdomains)
         active_sessions[user_id] = {
             "step": "select_domain",
-            "data": {}
+            # The DM steps that follow work on the tenant of the guild this was run in
+            "data": {"subdomains": subdomains, "tenant": tenant().guild_id}
         }
+        persist_session(user_id)
 
-        subdomains = users[user_id]["subdomains"]
         domain_embed = discord.Embed(
             title="🌐 DNS Record Management",
             description="Please select a subdomain to manage by typing its number:",
@@ -463,111 +4103,129 @@ async def records(ctx):
         )
 
         for i, subdomain in enumerate(subdomains, 1):
-            domain_embed.add_field(name=f"{i}. {subdomain}.{BASE_DOMAIN}", value="Type the number to select", inline=False)
+            domain_embed.add_field(name=f"{i}. {subdomain}.{tenant().base_domain}", value="Type the number to select", inline=False)
 
         domain_embed.set_footer(text="Type 'cancel' at any time to exit")
         await ctx.author.send(embed=domain_embed)
 
     except discord.Forbidden:
-        error_embed = discord.Embed(
-            title="❌ DM Error",
-            description="I couldn't send you a direct message. Please make sure your privacy settings allow DMs from server members.",
-            color=ERROR_COLOR
-        )
-        await ctx.send(embed=error_embed)
+        await ctx.send(embed=error_embed(
+            "I couldn't send you a direct message. Please make sure your privacy settings allow DMs from server members.",
+            title="❌ DM Error"
+        ))
     except Exception as e:
         print(f"Error in records command: {str(e)}")
-        error_embed = discord.Embed(title="❌ Error", description="An error occurred while setting up record management.", color=ERROR_COLOR)
-        await ctx.send(embed=error_embed)
+        await ctx.send(embed=error_embed("An error occurred while setting up record management."))
 
 @bot.event
 async def on_message(message):
-    if message.author == bot.user:
+    if message.author.bot:
+        return
+
+    # Guild messages only matter if they are commands, skip everything else before doing any work
+    if message.content.startswith(COMMAND_PREFIX):
+        await bot.process_commands(message)
         return
 
-    await bot.process_commands(message)
+    if message.guild is not None:
+        return
 
-    if not isinstance(message.channel, discord.DMChannel):
+    await users_loaded.wait()
+    if users_load_error is not None:
+        await message.author.send(embed=DATA_UNAVAILABLE_EMBED)
         return
 
     user_id = str(message.author.id)
+    session = active_sessions.get(user_id)
+    if session is not None and session.get("expires", float("inf")) < time.time():
+        del active_sessions[user_id]
+        persist_session(user_id)
+        session = None
+    if session is None:
+        session = restore_session(user_id)
+    session_tenant = find_tenant(session["data"].get("tenant")) if session is not None else None
+    if session is not None and session_tenant is None:
+        # Started in a guild that is no longer a tenant
+        del active_sessions[user_id]
+        persist_session(user_id)
+        session = None
 
-    if user_id in active_sessions:
-        session = active_sessions[user_id]
+    if session is not None:
+        # Every message is handled in a task of its own, so the tenant only applies to this message
+        current_tenant.set(session_tenant)
         content = message.content.strip().lower()
 
         if content == "cancel":
-            await message.author.send(embed=discord.Embed(
-                title="✅ Cancelled",
-                description="DNS record management cancelled.",
-                color=INFO_COLOR
-            ))
+            await message.author.send(embed=render_embed("cancelled", description="DNS record management cancelled."))
             del active_sessions[user_id]
+            persist_session(user_id)
+            return
+
+        if session["step"] in CLOUDFLARE_WRITE_STEPS and not cloudflare_breaker().available():
+            # Fail fast and keep the session, so the user can send the same answer again later
+            await message.author.send(embed=render_embed("cloudflare_down", footer={"text": "Send your answer again later or type 'cancel' to exit"}))
             return
 
-        if session["step"] == "select_domain":
-            await process_domain_selection(message, user_id)
-        elif session["step"] == "select_action":
-            await process_action_selection(message, user_id)
-        elif session["step"] == "list_records":
-            await process_records_list(message, user_id)
-        elif session["step"] == "create_record_type":
-            await process_create_record_type(message, user_id)
-        elif session["step"] == "create_record_name":
-            await process_create_record_name(message, user_id)
-        elif session["step"] == "create_record_content":
-            await process_create_record_content(message, user_id)
-        elif session["step"] == "create_cname_target":
-            await process_create_cname_target(message, user_id)
-        elif session["step"] == "confirm_create":
-            await process_confirm_create(message, user_id)
-        elif session["step"] == "select_record_to_delete":
-            await process_record_deletion(message, user_id)
-        elif session["step"] == "confirm_delete":
-            await process_confirm_delete(message, user_id)
-        elif session["step"] == "select_record_to_edit":
-            await process_record_edit_selection(message, user_id)
-        elif session["step"] == "edit_record_content":
-            await process_edit_record_content(message, user_id)
-        elif session["step"] == "confirm_edit":
-            await process_confirm_edit(message, user_id)
+        start_trace(f"step:{session['step']}")
+        try:
+            if session["step"] in CLOUDFLARE_STEPS:
+                async with cloudflare_queue.slot(user_id):
+                    await dispatch_session_step(message, user_id, session["step"])
+            else:
+                await dispatch_session_step(message, user_id, session["step"])
+        finally:
+            persist_session(user_id)
+            finish_trace()
+
+async def dispatch_session_step(message, user_id, step):
+    if step == "select_domain":
+        await process_domain_selection(message, user_id)
+    elif step == "select_action":
+        await process_action_selection(message, user_id)
+    elif step == "list_records":
+        await process_records_list(message, user_id)
+    elif step == "create_record_type":
+        await process_create_record_type(message, user_id)
+    elif step == "create_record_name":
+        await process_create_record_name(message, user_id)
+    elif step == "create_record_content":
+        await process_create_record_content(message, user_id)
+    elif step == "create_cname_target":
+        await process_create_cname_target(message, user_id)
+    elif step == "confirm_create":
+        await process_confirm_create(message, user_id)
+    elif step == "select_record_to_delete":
+        await process_record_deletion(message, user_id)
+    elif step == "confirm_delete":
+        await process_confirm_delete(message, user_id)
+    elif step == "select_record_to_edit":
+        await process_record_edit_selection(message, user_id)
+    elif step == "edit_record_content":
+        await process_edit_record_content(message, user_id)
+    elif step == "confirm_edit":
+        await process_confirm_edit(message, user_id)
 
 async def process_domain_selection(message, user_id):
     try:
         session = active_sessions[user_id]
-        subdomains = users[user_id]["subdomains"]
+        subdomains = session["data"]["subdomains"]
 
         try:
             selection = int(message.content.strip())
             if selection < 1 or selection > len(subdomains):
                 raise ValueError()
         except ValueError:
-            await message.author.send(embed=discord.Embed(
-                title="❌ Invalid Selection",
-                description="Please enter a valid number from the list.",
-                color=ERROR_COLOR
-            ))
+            await message.author.send(embed=render_embed("invalid_selection"))
             return
 
         selected_domain = subdomains[selection - 1]
         session["data"]["domain"] = selected_domain
         session["step"] = "select_action"
 
-        action_embed = discord.Embed(
-            title=f"🔧 Managing {selected_domain}.{BASE_DOMAIN}",
-            description="What would you like to do?",
-            color=INFO_COLOR
-        )
-        action_embed.add_field(name="1. List Records", value="View all DNS records for this domain", inline=False)
-        action_embed.add_field(name="2. Add Record", value="Create a new DNS record", inline=False)
-        action_embed.add_field(name="3. Edit Record", value="Modify an existing DNS record", inline=False)
-        action_embed.add_field(name="4. Delete Record", value="Remove a DNS record", inline=False)
-        action_embed.set_footer(text="Type 'cancel' to exit")
-
-        await message.author.send(embed=action_embed)
+        await message.author.send(embed=action_menu_embed(selected_domain))
     except Exception as e:
         print(f"Error in process_domain_selection: {str(e)}")
-        await message.author.send(embed=discord.Embed(title="❌ Error", description="An error occurred while processing your selection.", color=ERROR_COLOR))
+        await message.author.send(embed=error_embed("An error occurred while processing your selection."))
         del active_sessions[user_id]
 
 async def process_action_selection(message, user_id):
@@ -580,30 +4238,10 @@ async def process_action_selection(message, user_id):
             await list_domain_records(message.author, user_id)
         elif content == "2":
             session["step"] = "create_record_type"
-            type_embed = discord.Embed(
-                title="🆕 Create DNS Record",
-                description=f"Select the record type for {session['data']['domain']}.{BASE_DOMAIN}:",
-                color=INFO_COLOR
+            type_embed = render_embed(
+                "record_type_menu",
+                description=f"Select the record type for {session['data']['domain']}.{tenant().base_domain}:"
             )
-
-            for i, record_type in enumerate(RECORD_TYPES, 1):
-                description = ""
-                if record_type == "A":
-                    description = "Maps a domain to an IPv4 address"
-                elif record_type == "AAAA":
-                    description = "Maps a domain to an IPv6 address"
-                elif record_type == "CNAME":
-                    description = "Creates an alias pointing to another domain"
-                elif record_type == "TXT":
-                    description = "Stores text information (e.g., verification)"
-                elif record_type == "MX":
-                    description = "Specifies mail servers for the domain"
-                elif record_type == "SRV":
-                    description = "Specifies location of services"
-
-                type_embed.add_field(name=f"{i}. {record_type}", value=description, inline=False)
-
-            type_embed.set_footer(text="Type 'cancel' to exit")
             await message.author.send(embed=type_embed)
         elif content == "3":
             session["step"] = "select_record_to_edit"
@@ -619,36 +4257,30 @@ async def process_action_selection(message, user_id):
             ))
     except Exception as e:
         print(f"Error in process_action_selection: {str(e)}")
-        await message.author.send(embed=discord.Embed(title="❌ Error", description="An error occurred while processing your selection.", color=ERROR_COLOR))
+        await message.author.send(embed=error_embed("An error occurred while processing your selection."))
         del active_sessions[user_id]
 
 async def list_domain_records(user, user_id):
     try:
         session = active_sessions[user_id]
         domain = session["data"]["domain"]
-        subdomain = f"{domain}.{BASE_DOMAIN}"
+        subdomain = f"{domain}.{tenant().base_domain}"
 
-        response = requests.get(
-            f"https://api.cloudflare.com/client/v4/zones/{ZONE_ID}/dns_records",
-            headers=headers
-        )
+        response = await cloudflare_get(f"/zones/{tenant().zone_id}/dns_records")
 
         if response.status_code != 200:
-            await user.send(embed=discord.Embed(
-                title="❌ API Error",
-                description=f"Failed to fetch DNS records. Status code: {response.status_code}",
-                color=ERROR_COLOR
-            ))
+            await user.send(embed=render_embed("api_error", description=f"Failed to fetch DNS records. Status code: {response.status_code}"))
             del active_sessions[user_id]
             return
 
         records = response.json().get("result", [])
-        domain_records = [r for r in records if r["name"].endswith(subdomain)]
+        with span("list scan"):
+            domain_records = [r for r in records if r["name"].endswith(subdomain)]
 
         if not domain_records:
             no_records_embed = discord.Embed(
                 title="📋 DNS Records",
-                description=f"No DNS records found for {subdomain}.",
+                description=f"No DNS records found for {subdomain}." + stale_note(response),
                 color=INFO_COLOR
             )
             no_records_embed.add_field(name="Add Record", value="Type '2' to add a new record", inline=False)
@@ -656,22 +4288,23 @@ async def list_domain_records(user, user_id):
         else:
             records_embed = discord.Embed(
                 title="📋 DNS Records",
-                description=f"Records for {subdomain}:",
+                description=f"Records for {subdomain}:" + stale_note(response),
                 color=INFO_COLOR
             )
 
-            for record in domain_records:
-                record_type = record["type"]
-                content = record["content"]
-                proxied = record["proxied"]
-                ttl = "Auto" if record["ttl"] == 1 else record["ttl"]
+            with span("embed build"):
+                for record in domain_records:
+                    record_type = record["type"]
+                    content = record["content"]
+                    proxied = record["proxied"]
+                    ttl = "Auto" if record["ttl"] == 1 else record["ttl"]
 
-                value = f"Content: `{content}`\nProxied: `{proxied}`\nTTL: `{ttl}`"
-                if record_type == "MX":
-                    value += f"\nPriority: `{record.get('priority', 'N/A')}`"
+                    value = f"Content: `{content}`\nProxied: `{proxied}`\nTTL: `{ttl}`"
+                    if record_type == "MX":
+                        value += f"\nPriority: `{record.get('priority', 'N/A')}`"
 
-                name = record.get("name").replace(f".{BASE_DOMAIN}", "")
-                records_embed.add_field(name=f"{record_type}: {name}", value=value, inline=False)
+                    name = record.get("name").replace(f".{tenant().base_domain}", "")
+                    records_embed.add_field(name=f"{record_type}: {name}", value=value, inline=False)
 
             records_embed.set_footer(text="Type 'back' to return to action selection or 'cancel' to exit")
             await user.send(embed=records_embed)
@@ -679,7 +4312,7 @@ async def list_domain_records(user, user_id):
         session["step"] = "list_records"
     except Exception as e:
         print(f"Error in list_domain_records: {str(e)}")
-        await user.send(embed=discord.Embed(title="❌ Error", description="An error occurred while fetching records.", color=ERROR_COLOR))
+        await user.send(embed=error_embed("An error occurred while fetching records."))
         del active_sessions[user_id]
 
 async def process_records_list(message, user_id):
@@ -689,24 +4322,9 @@ async def process_records_list(message, user_id):
         session["step"] = "select_action"
 
         selected_domain = session["data"]["domain"]
-        action_embed = discord.Embed(
-            title=f"🔧 Managing {selected_domain}.{BASE_DOMAIN}",
-            description="What would you like to do?",
-            color=INFO_COLOR
-        )
-        action_embed.add_field(name="1. List Records", value="View all DNS records for this domain", inline=False)
-        action_embed.add_field(name="2. Add Record", value="Create a new DNS record", inline=False)
-        action_embed.add_field(name="3. Edit Record", value="Modify an existing DNS record", inline=False)
-        action_embed.add_field(name="4. Delete Record", value="Remove a DNS record", inline=False)
-        action_embed.set_footer(text="Type 'cancel' to exit")
-
-        await message.author.send(embed=action_embed)
+        await message.author.send(embed=action_menu_embed(selected_domain))
     else:
-        await message.author.send(embed=discord.Embed(
-            title="ℹ️ Navigation",
-            description="Type '**back**' to return to the main menu or '**cancel**' to exit.",
-            color=INFO_COLOR
-        ))
+        await message.author.send(embed=render_embed("navigation"))
 
 async def process_create_record_type(message, user_id):
     try:
@@ -715,17 +4333,13 @@ async def process_create_record_type(message, user_id):
 
         try:
             selection = int(content)
-            if selection < 1 or selection > len(RECORD_TYPES):
+            if selection < 1 or selection > len(config.record_types):
                 raise ValueError()
         except ValueError:
-            await message.author.send(embed=discord.Embed(
-                title="❌ Invalid Selection",
-                description="Please enter a valid number from the list.",
-                color=ERROR_COLOR
-            ))
+            await message.author.send(embed=render_embed("invalid_selection"))
             return
 
-        record_type = RECORD_TYPES[selection - 1]
+        record_type = config.record_types[selection - 1]
         session["data"]["record_type"] = record_type
 
         if record_type == "CNAME":
@@ -748,7 +4362,7 @@ async def process_create_record_type(message, user_id):
             await message.author.send(embed=name_embed)
     except Exception as e:
         print(f"Error in process_create_record_type: {str(e)}")
-        await message.author.send(embed=discord.Embed(title="❌ Error", description="An error occurred while processing the record type.", color=ERROR_COLOR))
+        await message.author.send(embed=error_embed("An error occurred while processing the record type."))
         del active_sessions[user_id]
 
 async def process_create_record_name(message, user_id):
@@ -780,7 +4394,7 @@ async def process_create_record_name(message, user_id):
         await message.author.send(embed=confirm_embed)
     except Exception as e:
         print(f"Error in process_create_record_content: {str(e)}")
-        await message.author.send(embed=discord.Embed(title="❌ Error", description="An error occurred while processing the record content.", color=ERROR_COLOR))
+        await message.author.send(embed=error_embed("An error occurred while processing the record content."))
         del active_sessions[user_id]
 
 async def process_create_cname_target(message, user_id):
@@ -811,7 +4425,7 @@ async def process_create_cname_target(message, user_id):
         await message.author.send(embed=confirm_embed)
     except Exception as e:
         print(f"Error in process_create_cname_target: {str(e)}")
-        await message.author.send(embed=discord.Embed(title="❌ Error", description="An error occurred while processing the CNAME target.", color=ERROR_COLOR))
+        await message.author.send(embed=error_embed("An error occurred while processing the CNAME target."))
         del active_sessions[user_id]
 
 async def process_confirm_create(message, user_id):
@@ -825,7 +4439,7 @@ async def process_confirm_create(message, user_id):
 
             if record_type == "CNAME":
                 target_domain = session["data"]["cname_target"]
-                subdomain = f"{domain}.{BASE_DOMAIN}"
+                subdomain = f"{domain}.{tenant().base_domain}"
                 data = {
                     "type": record_type,
                     "name": subdomain,
@@ -835,7 +4449,7 @@ async def process_confirm_create(message, user_id):
                 }
             else:
                 record_name = session["data"]["record_name"]
-                subdomain = f"{record_name}.{domain}.{BASE_DOMAIN}" if record_name else f"{domain}.{BASE_DOMAIN}"
+                subdomain = f"{record_name}.{domain}.{tenant().base_domain}" if record_name else f"{domain}.{tenant().base_domain}"
                 data = {
                     "type": record_type,
                     "name": subdomain,
@@ -844,67 +4458,43 @@ async def process_confirm_create(message, user_id):
                     "proxied": False
                 }
 
-            create_response = requests.post(
-                f"https://api.cloudflare.com/client/v4/zones/{ZONE_ID}/dns_records",
-                headers=headers,
-                json=data
-            )
-
-            if create_response.status_code == 200 or create_response.json().get("success"):
+            try:
+                await create_user_record(user_id, domain, data)
                 await message.author.send(embed=discord.Embed(
                     title="✅ Record Created",
-                    description=f"Successfully created the {record_type} record for {subdomain}.",
+                    description=f"Successfully created the {record_type} record for {subdomain}.\nUse `%check {subdomain}` to see when it's live.",
                     color=SUCCESS_COLOR
                 ))
-            else:
-                print(f"Failed to create record: {create_response.text}")
-                await message.author.send(embed=discord.Embed(
-                    title="❌ Creation Failed",
-                    description=f"Failed to create the record. API Error: {create_response.json().get('errors')}",
-                    color=ERROR_COLOR
-                ))
+            except RecordChangeError as e:
+                await message.author.send(embed=discord.Embed(title=f"❌ {e.title}", description=e.description, color=ERROR_COLOR))
         else:
-            await message.author.send(embed=discord.Embed(
-                title="✅ Cancelled",
-                description="Record creation cancelled.",
-                color=INFO_COLOR
-            ))
+            await message.author.send(embed=render_embed("cancelled", description="Record creation cancelled."))
 
         del active_sessions[user_id]
     except Exception as e:
         print(f"Error in process_confirm_create: {str(e)}")
-        await message.author.send(embed=discord.Embed(title="❌ Error", description="An error occurred while confirming the record creation.", color=ERROR_COLOR))
+        await message.author.send(embed=error_embed("An error occurred while confirming the record creation."))
         del active_sessions[user_id]
 
 async def process_record_deletion(message, user_id):
     try:
         session = active_sessions[user_id]
         domain = session["data"]["domain"]
-        subdomain = f"{domain}.{BASE_DOMAIN}"
+        subdomain = f"{domain}.{tenant().base_domain}"
 
-        response = requests.get(
-            f"https://api.cloudflare.com/client/v4/zones/{ZONE_ID}/dns_records",
-            headers=headers
-        )
+        response = await cloudflare_get(f"/zones/{tenant().zone_id}/dns_records")
 
         if response.status_code != 200:
-            await message.author.send(embed=discord.Embed(
-                title="❌ API Error",
-                description=f"Failed to fetch DNS records. Status code: {response.status_code}",
-                color=ERROR_COLOR
-            ))
+            await message.author.send(embed=render_embed("api_error", description=f"Failed to fetch DNS records. Status code: {response.status_code}"))
             del active_sessions[user_id]
             return
 
         records = response.json().get("result", [])
-        domain_records = [r for r in records if r["name"].endswith(subdomain)]
+        with span("list scan"):
+            domain_records = [r for r in records if r["name"].endswith(subdomain)]
 
         if not domain_records:
-            await message.author.send(embed=discord.Embed(
-                title="❌ No Records",
-                description=f"No DNS records found for {subdomain}.",
-                color=ERROR_COLOR
-            ))
+            await message.author.send(embed=render_embed("no_records", description=f"No DNS records found for {subdomain}."))
             del active_sessions[user_id]
             return
 
@@ -914,20 +4504,21 @@ async def process_record_deletion(message, user_id):
             color=INFO_COLOR
         )
 
-        for i, record in enumerate(domain_records, 1):
-            record_type = record["type"]
-            content = record["content"]
-            name = record.get("name").replace(f".{BASE_DOMAIN}", "")
-            delete_embed.add_field(name=f"{i}. {record_type}: {name}", value=f"Content: `{content}`", inline=False)
+        with span("embed build"):
+            for i, record in enumerate(domain_records, 1):
+                record_type = record["type"]
+                content = record["content"]
+                name = record.get("name").replace(f".{tenant().base_domain}", "")
+                delete_embed.add_field(name=f"{i}. {record_type}: {name}", value=f"Content: `{content}`", inline=False)
 
         delete_embed.set_footer(text="Type the number to select or 'cancel' to exit")
         await message.author.send(embed=delete_embed)
 
         session["step"] = "confirm_delete"
-        session["data"]["records"] = domain_records
+        session["data"]["records"] = compact_records(domain_records)
     except Exception as e:
         print(f"Error in process_record_deletion: {str(e)}")
-        await message.author.send(embed=discord.Embed(title="❌ Error", description="An error occurred while processing the record deletion.", color=ERROR_COLOR))
+        await message.author.send(embed=error_embed("An error occurred while processing the record deletion."))
         del active_sessions[user_id]
 
 async def process_confirm_delete(message, user_id):
@@ -940,22 +4531,20 @@ async def process_confirm_delete(message, user_id):
             if selection < 1 or selection > len(session["data"]["records"]):
                 raise ValueError()
         except ValueError:
-            await message.author.send(embed=discord.Embed(
-                title="❌ Invalid Selection",
-                description="Please enter a valid number from the list.",
-                color=ERROR_COLOR
-            ))
+            await message.author.send(embed=render_embed("invalid_selection"))
             return
 
         record = session["data"]["records"][selection - 1]
         record_id = record["id"]
 
-        delete_response = requests.delete(
-            f"https://api.cloudflare.com/client/v4/zones/{ZONE_ID}/dns_records/{record_id}",
-            headers=headers
+        delete_response = await cloudflare_request(
+            "DELETE",
+            f"/zones/{tenant().zone_id}/dns_records/{record_id}"
         )
 
         if delete_response.status_code == 200 and delete_response.json().get("success"):
+            audit("delete_record", user_id, type=record["type"], name=record["name"], content=record.get("content"))
+            count_record(subdomain_of(record["name"]), record["type"], -1)
             await message.author.send(embed=discord.Embed(
                 title="✅ Record Deleted",
                 description=f"Successfully deleted the record for {record['name']}.",
@@ -972,38 +4561,28 @@ async def process_confirm_delete(message, user_id):
         del active_sessions[user_id]
     except Exception as e:
         print(f"Error in process_confirm_delete: {str(e)}")
-        await message.author.send(embed=discord.Embed(title="❌ Error", description="An error occurred while confirming the record deletion.", color=ERROR_COLOR))
+        await message.author.send(embed=error_embed("An error occurred while confirming the record deletion."))
         del active_sessions[user_id]
 
 async def process_record_edit_selection(message, user_id):
     try:
         session = active_sessions[user_id]
         domain = session["data"]["domain"]
-        subdomain = f"{domain}.{BASE_DOMAIN}"
+        subdomain = f"{domain}.{tenant().base_domain}"
 
-        response = requests.get(
-            f"https://api.cloudflare.com/client/v4/zones/{ZONE_ID}/dns_records",
-            headers=headers
-        )
+        response = await cloudflare_get(f"/zones/{tenant().zone_id}/dns_records")
 
         if response.status_code != 200:
-            await message.author.send(embed=discord.Embed(
-                title="❌ API Error",
-                description=f"Failed to fetch DNS records. Status code: {response.status_code}",
-                color=ERROR_COLOR
-            ))
+            await message.author.send(embed=render_embed("api_error", description=f"Failed to fetch DNS records. Status code: {response.status_code}"))
             del active_sessions[user_id]
             return
 
         records = response.json().get("result", [])
-        domain_records = [r for r in records if r["name"].endswith(subdomain)]
+        with span("list scan"):
+            domain_records = [r for r in records if r["name"].endswith(subdomain)]
 
         if not domain_records:
-            await message.author.send(embed=discord.Embed(
-                title="❌ No Records",
-                description=f"No DNS records found for {subdomain}.",
-                color=ERROR_COLOR
-            ))
+            await message.author.send(embed=render_embed("no_records", description=f"No DNS records found for {subdomain}."))
             del active_sessions[user_id]
             return
 
@@ -1013,20 +4592,21 @@ async def process_record_edit_selection(message, user_id):
             color=INFO_COLOR
         )
 
-        for i, record in enumerate(domain_records, 1):
-            record_type = record["type"]
-            content = record["content"]
-            name = record.get("name").replace(f".{BASE_DOMAIN}", "")
-            edit_embed.add_field(name=f"{i}. {record_type}: {name}", value=f"Content: `{content}`", inline=False)
+        with span("embed build"):
+            for i, record in enumerate(domain_records, 1):
+                record_type = record["type"]
+                content = record["content"]
+                name = record.get("name").replace(f".{tenant().base_domain}", "")
+                edit_embed.add_field(name=f"{i}. {record_type}: {name}", value=f"Content: `{content}`", inline=False)
 
         edit_embed.set_footer(text="Type the number to select or 'cancel' to exit")
         await message.author.send(embed=edit_embed)
 
         session["step"] = "edit_record_content"
-        session["data"]["records"] = domain_records
+        session["data"]["records"] = compact_records(domain_records)
     except Exception as e:
         print(f"Error in process_record_edit_selection: {str(e)}")
-        await message.author.send(embed=discord.Embed(title="❌ Error", description="An error occurred while processing the record edit selection.", color=ERROR_COLOR))
+        await message.author.send(embed=error_embed("An error occurred while processing the record edit selection."))
         del active_sessions[user_id]
 
 async def process_edit_record_content(message, user_id):
@@ -1039,11 +4619,7 @@ async def process_edit_record_content(message, user_id):
             if selection < 1 or selection > len(session["data"]["records"]):
                 raise ValueError()
         except ValueError:
-            await message.author.send(embed=discord.Embed(
-                title="❌ Invalid Selection",
-                description="Please enter a valid number from the list.",
-                color=ERROR_COLOR
-            ))
+            await message.author.send(embed=render_embed("invalid_selection"))
             return
 
         record = session["data"]["records"][selection - 1]
@@ -1059,7 +4635,7 @@ async def process_edit_record_content(message, user_id):
         await message.author.send(embed=edit_embed)
     except Exception as e:
         print(f"Error in process_edit_record_content: {str(e)}")
-        await message.author.send(embed=discord.Embed(title="❌ Error", description="An error occurred while processing the record edit content.", color=ERROR_COLOR))
+        await message.author.send(embed=error_embed("An error occurred while processing the record edit content."))
         del active_sessions[user_id]
 
 async def process_confirm_edit(message, user_id):
@@ -1068,17 +4644,10 @@ async def process_confirm_edit(message, user_id):
         new_content = message.content.strip()
         record_id = session["data"]["record_id"]
 
-        response = requests.get(
-            f"https://api.cloudflare.com/client/v4/zones/{ZONE_ID}/dns_records/{record_id}",
-            headers=headers
-        )
+        response = await cloudflare_get(f"/zones/{tenant().zone_id}/dns_records/{record_id}")
 
         if response.status_code != 200:
-            await message.author.send(embed=discord.Embed(
-                title="❌ API Error",
-                description=f"Failed to fetch the DNS record. Status code: {response.status_code}",
-                color=ERROR_COLOR
-            ))
+            await message.author.send(embed=render_embed("api_error", description=f"Failed to fetch the DNS record. Status code: {response.status_code}"))
             del active_sessions[user_id]
             return
 
@@ -1109,16 +4678,17 @@ async def process_confirm_edit(message, user_id):
             "proxied": record["proxied"]
         }
 
-        update_response = requests.put(
-            f"https://api.cloudflare.com/client/v4/zones/{ZONE_ID}/dns_records/{record_id}",
-            headers=headers,
+        update_response = await cloudflare_request(
+            "PUT",
+            f"/zones/{tenant().zone_id}/dns_records/{record_id}",
             json=data
         )
 
         if update_response.status_code == 200 and update_response.json().get("success"):
+            audit("edit_record", user_id, type=record_type, name=record["name"], old=record.get("content"), new=new_content)
             await message.author.send(embed=discord.Embed(
                 title="✅ Record Updated",
-                description=f"Successfully updated the {record_type} record for {record['name']}.",
+                description=f"Successfully updated the {record_type} record for {record['name']}.\nUse `%check {record['name']}` to see when it's live.",
                 color=SUCCESS_COLOR
             ))
         else:
@@ -1132,38 +4702,28 @@ async def process_confirm_edit(message, user_id):
         del active_sessions[user_id]
     except Exception as e:
         print(f"Error in process_confirm_edit: {str(e)}")
-        await message.author.send(embed=discord.Embed(title="❌ Error", description="An error occurred while confirming the record edit.", color=ERROR_COLOR))
+        await message.author.send(embed=error_embed("An error occurred while confirming the record edit."))
         del active_sessions[user_id]
 
 async def list_domain_records_for_edit(user, user_id):
     try:
         session = active_sessions[user_id]
         domain = session["data"]["domain"]
-        subdomain = f"{domain}.{BASE_DOMAIN}"
+        subdomain = f"{domain}.{tenant().base_domain}"
 
-        response = requests.get(
-            f"https://api.cloudflare.com/client/v4/zones/{ZONE_ID}/dns_records",
-            headers=headers
-        )
+        response = await cloudflare_get(f"/zones/{tenant().zone_id}/dns_records")
 
         if response.status_code != 200:
-            await user.send(embed=discord.Embed(
-                title="❌ API Error",
-                description=f"Failed to fetch DNS records. Status code: {response.status_code}",
-                color=ERROR_COLOR
-            ))
+            await user.send(embed=render_embed("api_error", description=f"Failed to fetch DNS records. Status code: {response.status_code}"))
             del active_sessions[user_id]
             return
 
         records = response.json().get("result", [])
-        domain_records = [r for r in records if r["name"].endswith(subdomain)]
+        with span("list scan"):
+            domain_records = [r for r in records if r["name"].endswith(subdomain)]
 
         if not domain_records:
-            await user.send(embed=discord.Embed(
-                title="❌ No Records",
-                description=f"No DNS records found for {subdomain}.",
-                color=ERROR_COLOR
-            ))
+            await user.send(embed=render_embed("no_records", description=f"No DNS records found for {subdomain}."))
             del active_sessions[user_id]
             return
 
@@ -1173,51 +4733,42 @@ async def list_domain_records_for_edit(user, user_id):
             color=INFO_COLOR
         )
 
-        for i, record in enumerate(domain_records, 1):
-            record_type = record["type"]
-            content = record["content"]
-            name = record.get("name").replace(f".{BASE_DOMAIN}", "")
-            edit_embed.add_field(name=f"{i}. {record_type}: {name}", value=f"Content: `{content}`", inline=False)
+        with span("embed build"):
+            for i, record in enumerate(domain_records, 1):
+                record_type = record["type"]
+                content = record["content"]
+                name = record.get("name").replace(f".{tenant().base_domain}", "")
+                edit_embed.add_field(name=f"{i}. {record_type}: {name}", value=f"Content: `{content}`", inline=False)
 
         edit_embed.set_footer(text="Type the number to select or 'cancel' to exit")
         await user.send(embed=edit_embed)
 
         session["step"] = "edit_record_content"
-        session["data"]["records"] = domain_records
+        session["data"]["records"] = compact_records(domain_records)
     except Exception as e:
         print(f"Error in list_domain_records_for_edit: {str(e)}")
-        await user.send(embed=discord.Embed(title="❌ Error", description="An error occurred while processing the record edit selection.", color=ERROR_COLOR))
+        await user.send(embed=error_embed("An error occurred while processing the record edit selection."))
         del active_sessions[user_id]
 
 async def list_domain_records_for_deletion(user, user_id):
     try:
         session = active_sessions[user_id]
         domain = session["data"]["domain"]
-        subdomain = f"{domain}.{BASE_DOMAIN}"
+        subdomain = f"{domain}.{tenant().base_domain}"
 
-        response = requests.get(
-            f"https://api.cloudflare.com/client/v4/zones/{ZONE_ID}/dns_records",
-            headers=headers
-        )
+        response = await cloudflare_get(f"/zones/{tenant().zone_id}/dns_records")
 
         if response.status_code != 200:
-            await user.send(embed=discord.Embed(
-                title="❌ API Error",
-                description=f"Failed to fetch DNS records. Status code: {response.status_code}",
-                color=ERROR_COLOR
-            ))
+            await user.send(embed=render_embed("api_error", description=f"Failed to fetch DNS records. Status code: {response.status_code}"))
             del active_sessions[user_id]
             return
 
         records = response.json().get("result", [])
-        domain_records = [r for r in records if r["name"].endswith(subdomain)]
+        with span("list scan"):
+            domain_records = [r for r in records if r["name"].endswith(subdomain)]
 
         if not domain_records:
-            await user.send(embed=discord.Embed(
-                title="❌ No Records",
-                description=f"No DNS records found for {subdomain}.",
-                color=ERROR_COLOR
-            ))
+            await user.send(embed=render_embed("no_records", description=f"No DNS records found for {subdomain}."))
             del active_sessions[user_id]
             return
 
@@ -1227,26 +4778,30 @@ async def list_domain_records_for_deletion(user, user_id):
             color=INFO_COLOR
         )
 
-        for i, record in enumerate(domain_records, 1):
-            record_type = record["type"]
-            content = record["content"]
-            name = record.get("name").replace(f".{BASE_DOMAIN}", "")
-            delete_embed.add_field(name=f"{i}. {record_type}: {name}", value=f"Content: `{content}`", inline=False)
+        with span("embed build"):
+            for i, record in enumerate(domain_records, 1):
+                record_type = record["type"]
+                content = record["content"]
+                name = record.get("name").replace(f".{tenant().base_domain}", "")
+                delete_embed.add_field(name=f"{i}. {record_type}: {name}", value=f"Content: `{content}`", inline=False)
 
         delete_embed.set_footer(text="Type the number to select or 'cancel' to exit")
         await user.send(embed=delete_embed)
 
         session["step"] = "confirm_delete"
-        session["data"]["records"] = domain_records
+        session["data"]["records"] = compact_records(domain_records)
     except Exception as e:
         print(f"Error in list_domain_records_for_deletion: {str(e)}")
-        await user.send(embed=discord.Embed(title="❌ Error", description="An error occurred while processing the record deletion selection.", color=ERROR_COLOR))
+        await user.send(embed=error_embed("An error occurred while processing the record deletion selection."))
         del active_sessions[user_id]
 
 # Loop
-try:
-    bot.run(TOKEN)
-except discord.errors.LoginFailure:
-    print("Invalid token. Please check your Discord bot token.")
-except Exception as e:
-    print(f"Error starting bot: {str(e)}")
+if __name__ == "__main__":
+    try:
+        bot.run(config.token)
+    except discord.errors.LoginFailure:
+        print("Invalid token. Please check your Discord bot token.")
+    except Exception as e:
+        print(f"Error starting bot: {str(e)}")
+    flush_audit_log()
+    flush_sessions()
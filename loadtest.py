@@ -0,0 +1,506 @@
+"""Load test for the %records DM flow.
+
+Drives synthetic users through full create, edit and delete sequences by calling the bot's
+on_message with fake Discord objects, against a local stand-in for the Cloudflare API.
+For every concurrency level it reports throughput, tail latency per message, event loop lag
+and how much memory active_sessions takes. Before that it compares the user data snapshot
+formats by file size and save and load time, measures memory per loaded user, times
+render_embed for every embed template and measures CPU time and memory per 1,000 gateway
+messages with and without lean_gateway's caching.
+
+    python loadtest.py --levels 50,200,1000,2000 --latency 50
+
+Everything runs in a temporary directory, the bot's real data files are never touched.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from discord.ext import commands as discord_commands
+
+ZONE_ID = "loadtest"
+BASE_DOMAIN = "loadtest.invalid"
+
+# Local Cloudflare stand-in
+zone_records = {}
+zone_lock = threading.Lock()
+api_latency = 0.0
+
+class FakeCloudflare(BaseHTTPRequestHandler):
+    """Just enough of the dns_records API for the DM flow and the batch endpoint"""
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, result, status=200):
+        body = json.dumps({"success": status == 200, "errors": [] if status == 200 else [{"message": "not found"}], "result": result}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length)) if length else {}
+
+    def record_path(self):
+        """(record id or None, is batch) for /client/v4/zones/<zone>/dns_records[/<id>|/batch]"""
+        parts = self.path.split("?")[0].strip("/").split("/")
+        record_id = parts[5] if len(parts) > 5 else None
+        return (None, True) if record_id == "batch" else (record_id, False)
+
+    def create(self, data):
+        record = dict(data, id=uuid.uuid4().hex, modified_on=time.strftime("%Y-%m-%dT%H:%M:%SZ"))
+        zone_records[record["id"]] = record
+        return record
+
+    def update(self, record_id, data):
+        if record_id not in zone_records:
+            return None
+        zone_records[record_id].update(data)
+        return zone_records[record_id]
+
+    def handle_change(self, method):
+        time.sleep(api_latency)
+        record_id, batch = self.record_path()
+        data = self.body() if method in ("POST", "PUT", "PATCH") else {}
+        with zone_lock:
+            if batch:
+                result = {
+                    "deletes": [zone_records.pop(change["id"], None) for change in data.get("deletes", [])],
+                    "patches": [self.update(change["id"], change) for change in data.get("patches", [])],
+                    "puts": [self.update(change["id"], change) for change in data.get("puts", [])],
+                    "posts": [self.create(change) for change in data.get("posts", [])]
+                }
+            elif method == "GET":
+                result = zone_records.get(record_id) if record_id else list(zone_records.values())
+            elif method == "POST":
+                result = self.create(data)
+            elif method == "DELETE":
+                result = zone_records.pop(record_id, None)
+            else:
+                result = self.update(record_id, data)
+        self.reply(result, 200 if result is not None else 404)
+
+    def do_GET(self):
+        self.handle_change("GET")
+
+    def do_POST(self):
+        self.handle_change("POST")
+
+    def do_PUT(self):
+        self.handle_change("PUT")
+
+    def do_PATCH(self):
+        self.handle_change("PATCH")
+
+    def do_DELETE(self):
+        self.handle_change("DELETE")
+
+def start_fake_cloudflare():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeCloudflare)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# Fake Discord objects
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.name = f"loadtest-{user_id}"
+        self.bot = False
+        self.avatar = None
+        self.mention = f"<@{user_id}>"
+        self.replies = []
+
+    def __str__(self):
+        return self.name
+
+    async def send(self, content=None, embed=None, **kwargs):
+        self.replies.append(embed.title if embed else content)
+
+class FakeChannel:
+    def __init__(self, user):
+        self.user = user
+
+    async def send(self, content=None, embed=None, **kwargs):
+        await self.user.send(content, embed=embed)
+
+class FakeMessage:
+    def __init__(self, user, content):
+        self.id = random.getrandbits(63)
+        self.author = user
+        self.channel = FakeChannel(user)
+        self.content = content
+        self.guild = None
+        self.attachments = []
+        self._state = None
+
+def load_bot(workdir, users_count):
+    """Import bot.py against a throwaway config and data file in workdir"""
+    repo = os.path.dirname(os.path.abspath(__file__))
+    users = {str(1000 + i): {"credits": 1000, "subdomains": [f"lt-{i:06d}"]} for i in range(users_count)}
+    with open(os.path.join(workdir, "users.json"), "w") as f:
+        json.dump(users, f)
+    with open(os.path.join(workdir, "config.json"), "w") as f:
+        json.dump({
+            "token": "loadtest",
+            "zone_id": ZONE_ID,
+            "base_domain": BASE_DOMAIN,
+            "record_types": ["A", "AAAA", "CNAME", "TXT"],
+            "user_rate_limit": [1000000, 1],
+            "guild_rate_limit": [1000000, 1]
+        }, f)
+    os.chdir(workdir)
+    os.environ["BOT_CONFIG"] = os.path.join(workdir, "config.json")
+    sys.path.insert(0, repo)
+    import bot as app
+
+    # Replies from commands go to the fake channel instead of Discord's HTTP API
+    async def send(ctx, content=None, **kwargs):
+        return await ctx.channel.send(content, **kwargs)
+    discord_commands.Context.send = send
+    app.bot._connection.user = FakeUser(1)
+    return app
+
+# Measurements
+def deep_size(obj, seen=None):
+    """Bytes used by obj and everything it references, counted once each"""
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, seen) for item in obj)
+    return size
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+class Stats:
+    def __init__(self):
+        self.latencies = []
+        self.lags = []
+        self.peak_sessions = 0
+        self.peak_session_bytes = 0
+        self.errors = 0
+        self.sequences = 0
+
+async def send_dm(app, stats, user, content):
+    started = time.perf_counter()
+    await app.on_message(FakeMessage(user, content))
+    stats.latencies.append(time.perf_counter() - started)
+
+async def run_user(app, stats, index, think):
+    """One create, edit and delete pass over the user's subdomain"""
+    user = FakeUser(1000 + index)
+    type_choice = str(app.config.record_types.index("A") + 1)
+    sequences = [
+        ["%records", "1", "2", type_choice, f"10.0.{index // 256 % 256}.{index % 256}", "yes"],
+        ["%records", "1", "3", "1", f"10.1.{index // 256 % 256}.{index % 256}"],
+        ["%records", "1", "4", "1"]
+    ]
+    for steps in sequences:
+        for content in steps:
+            if think:
+                await asyncio.sleep(random.uniform(0, think))
+            await send_dm(app, stats, user, content)
+        stats.sequences += 1
+    stats.errors += sum(1 for reply in user.replies if reply and reply.startswith("❌"))
+
+async def monitor(app, stats, stop):
+    """Samples event loop lag every 10ms and the session table every half second"""
+    last_sample = 0
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(0.01)
+        stats.lags.append(time.perf_counter() - started - 0.01)
+        if started - last_sample >= 0.5 and len(app.active_sessions) > stats.peak_sessions:
+            last_sample = started
+            stats.peak_sessions = len(app.active_sessions)
+            stats.peak_session_bytes = deep_size(app.active_sessions)
+
+async def run_level(app, concurrency, think):
+    stats = Stats()
+    gc.collect()
+    sessions_before = deep_size(app.active_sessions)
+    stop = asyncio.Event()
+    monitor_task = asyncio.create_task(monitor(app, stats, stop))
+    started = time.perf_counter()
+    await asyncio.gather(*(run_user(app, stats, i, think) for i in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await monitor_task
+    gc.collect()
+    return {
+        "concurrency": concurrency,
+        "seconds": elapsed,
+        "messages_per_second": len(stats.latencies) / elapsed,
+        "sequences_per_second": stats.sequences / elapsed,
+        "p50_ms": percentile(stats.latencies, 0.50) * 1000,
+        "p99_ms": percentile(stats.latencies, 0.99) * 1000,
+        "max_ms": max(stats.latencies) * 1000,
+        "lag_p99_ms": percentile(stats.lags, 0.99) * 1000,
+        "lag_max_ms": max(stats.lags, default=0) * 1000,
+        "peak_sessions": stats.peak_sessions,
+        "peak_session_kb": stats.peak_session_bytes / 1024,
+        "session_growth_kb": (deep_size(app.active_sessions) - sessions_before) / 1024,
+        "errors": stats.errors
+    }
+
+# (result key, heading, width, format spec)
+COLUMNS = [
+    ("concurrency", "users", 7, "d"),
+    ("messages_per_second", "msg/s", 8, ".0f"),
+    ("sequences_per_second", "seq/s", 7, ".1f"),
+    ("p50_ms", "p50 ms", 8, ".1f"),
+    ("p99_ms", "p99 ms", 8, ".1f"),
+    ("max_ms", "max ms", 8, ".1f"),
+    ("lag_p99_ms", "lag p99", 8, ".1f"),
+    ("lag_max_ms", "lag max", 8, ".1f"),
+    ("peak_sessions", "sessions", 9, "d"),
+    ("peak_session_kb", "peak KB", 8, ".0f"),
+    ("session_growth_kb", "growth KB", 9, ".1f"),
+    ("errors", "errors", 7, "d")
+]
+
+def print_header():
+    print("  ".join(title.rjust(width) for _, title, width, _ in COLUMNS))
+
+def print_row(result):
+    print("  ".join(format(result[key], f">{width}{spec}") for key, _, width, spec in COLUMNS))
+
+def saturation_point(results, slo_ms):
+    """The first level where throughput stopped growing by 10% or p99 latency broke the SLO"""
+    for previous, current in zip(results, results[1:]):
+        if current["messages_per_second"] < previous["messages_per_second"] * 1.1 or current["p99_ms"] > slo_ms:
+            return current["concurrency"]
+    return None
+
+# Snapshot formats
+def synthetic_users(app, count):
+    """A UserStore shaped like production data, some users with several subdomains and renewals"""
+    rng = random.Random(count)
+    raw = {}
+    for i in range(count):
+        subdomains = [f"user{i}-{n}" for n in range(rng.choice((1, 1, 1, 2, 3)))]
+        renewals = {name: 1700000000 + rng.randrange(86400 * 30) for name in subdomains} if rng.random() < 0.3 else None
+        raw[str(100000000000000000 + i * 7919)] = (rng.randrange(1000), subdomains, renewals)
+    return app.UserStore(raw)
+
+def write_legacy_snapshot(data, path):
+    """The pretty-printed users.json the bot wrote before snapshot version 2"""
+    users = {}
+    for user_id, credits, subdomains, renewals in data.rows():
+        users[user_id] = {"credits": credits, "subdomains": subdomains}
+        if renewals:
+            users[user_id]["renewals"] = renewals
+    with open(path, "w") as f:
+        json.dump(users, f, indent=4)
+
+def best_time(function, repeat=3):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+def benchmark_snapshots(app, count, workdir):
+    """(format, size in bytes, save seconds, load seconds) for every snapshot format the bot can write"""
+    data = synthetic_users(app, count)
+    writers = [("json v1", lambda path: write_legacy_snapshot(data, path))]
+    writers += [
+        (name, lambda path, name=name: app.write_snapshot(data, path, name))
+        for name in app.SNAPSHOT_FORMATS if name != "msgpack" or app.msgpack is not None
+    ]
+    results = []
+    for name, write in writers:
+        path = os.path.join(workdir, f"snapshot-{name.replace(' ', '-')}")
+        save_seconds = best_time(lambda: write(path))
+        load_seconds = best_time(lambda: app.UserStore(app.read_snapshot(path)))
+        results.append((name, os.path.getsize(path), save_seconds, load_seconds))
+    return results
+
+def benchmark_user_memory(app, count, workdir):
+    """Bytes per user of a store loaded from a snapshot, (as loaded, once every user has been touched)"""
+    data = app.UserStore(app.read_snapshot(os.path.join(workdir, "snapshot-json")))
+    loaded = data.memory_usage() / count
+    for user_id in list(data.raw):
+        data.get(user_id)
+    return loaded, data.memory_usage() / count
+
+def print_snapshot_results(app, count, results, memory):
+    encoder = "orjson" if app.orjson is not None else "json"
+    print(f"Snapshots of {count} users, JSON through {encoder}\n")
+    print(f"{'format':>10}  {'size KB':>9}  {'save ms':>8}  {'load ms':>8}")
+    for name, size, save_seconds, load_seconds in results:
+        print(f"{name:>10}  {size / 1024:>9.0f}  {save_seconds * 1000:>8.1f}  {load_seconds * 1000:>8.1f}")
+    loaded, touched = memory
+    print(f"\nMemory per user: ~{loaded:.0f} bytes as loaded, ~{touched:.0f} bytes once every user has been touched")
+    print()
+
+# Embed rendering
+def benchmark_embeds(app, renders):
+    """(template, fields, microseconds per render_embed call) for every embed template"""
+    results = []
+    for name, template in app.EMBED_TEMPLATES.items():
+        seconds = best_time(lambda: [app.render_embed(name) for _ in range(renders)])
+        results.append((name, len(template.get("fields", ())), seconds / renders * 1e6))
+    return results
+
+def print_embed_results(renders, results):
+    print(f"render_embed, best of 3 runs of {renders} renders\n")
+    print(f"{'template':>18}  {'fields':>6}  {'us/render':>9}")
+    for name, fields, micros in results:
+        print(f"{name:>18}  {fields:>6}  {micros:>9.1f}")
+    print()
+
+# Gateway messages
+GUILD_PAYLOAD = {
+    "id": "1",
+    "name": "loadtest",
+    "owner_id": "1",
+    "channels": [{"id": "1", "type": 0, "name": "general", "position": 0, "permission_overwrites": []}],
+    "roles": [],
+    "emojis": [],
+    "stickers": [],
+    "features": [],
+    "member_count": 1
+}
+
+def chatter_payload(index):
+    """A MESSAGE_CREATE payload for an ordinary guild message that isn't a command"""
+    return {
+        "id": str(10 ** 17 + index),
+        "channel_id": "1",
+        "guild_id": "1",
+        "author": {"id": str(2000 + index % 500), "username": f"chatter{index % 500}", "discriminator": "0", "avatar": None},
+        "content": f"just chatting {index}",
+        "timestamp": "2026-01-01T00:00:00+00:00",
+        "edited_timestamp": None,
+        "tts": False,
+        "mention_everyone": False,
+        "mentions": [],
+        "mention_roles": [],
+        "attachments": [],
+        "embeds": [],
+        "pinned": False,
+        "type": 0
+    }
+
+async def feed_gateway(app, payloads):
+    """Parse and dispatch the payloads the way discord.py does for MESSAGE_CREATE, letting on_message run"""
+    state = app.bot._connection
+    for data in payloads:
+        state.parse_message_create(data)
+        await asyncio.sleep(0)
+
+async def benchmark_gateway(app, messages, repeat=3):
+    """(setting, CPU ms per 1,000 messages, KB kept afterwards) without and with discord.py's message cache.
+
+    The message cache, which holds the last 1,000 messages, is what lean_gateway turns off for
+    ordinary traffic. Members aren't cached from messages in either case, only from member events and chunking.
+    """
+    state = app.bot._connection
+    guild = state._add_guild_from_data(GUILD_PAYLOAD)
+    cache = state._messages
+    payloads = [chatter_payload(i) for i in range(messages)]
+    settings = (("lean_gateway on", lambda: None), ("lean_gateway off", lambda: deque(maxlen=1000)))
+    timings = {setting: [] for setting, _ in settings}
+    for _ in range(repeat):
+        for setting, make_cache in settings:
+            state._messages = make_cache()
+            gc.collect()
+            started = time.process_time()
+            await feed_gateway(app, payloads)
+            timings[setting].append(time.process_time() - started)
+
+    results = []
+    for setting, make_cache in settings:
+        state._messages = None
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        state._messages = make_cache()
+        await feed_gateway(app, payloads)
+        gc.collect()
+        kept = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        results.append((setting, min(timings[setting]) / messages * 1e6, kept / 1024))
+    state._messages = cache
+    state._remove_guild(guild)
+    return results
+
+def print_gateway_results(messages, results):
+    print(f"Gateway, best of 3 runs of {messages} guild messages that aren't commands\n")
+    print(f"{'setting':>18}  {'CPU ms/1k':>9}  {'KB kept':>8}")
+    for setting, cpu_ms, kept_kb in results:
+        print(f"{setting:>18}  {cpu_ms:>9.1f}  {kept_kb:>8.0f}")
+    print()
+
+async def main(args):
+    global api_latency
+    api_latency = args.latency / 1000
+    server = start_fake_cloudflare()
+    workdir = tempfile.mkdtemp(prefix="loadtest-")
+    app = load_bot(workdir, max(args.levels))
+    app.CLOUDFLARE_API = f"http://127.0.0.1:{server.server_port}/client/v4"
+
+    if args.snapshot_users:
+        results = benchmark_snapshots(app, args.snapshot_users, workdir)
+        print_snapshot_results(app, args.snapshot_users, results, benchmark_user_memory(app, args.snapshot_users, workdir))
+    if args.embed_renders:
+        print_embed_results(args.embed_renders, benchmark_embeds(app, args.embed_renders))
+
+    await app.bot._async_setup_hook()
+    if args.gateway_messages:
+        print_gateway_results(args.gateway_messages, await benchmark_gateway(app, args.gateway_messages))
+    await app.bot.setup_hook()
+    await app.users_loaded.wait()
+
+    print(f"Cloudflare stand-in on port {server.server_port} with {args.latency}ms latency\n")
+    print_header()
+    results = []
+    for concurrency in args.levels:
+        result = await run_level(app, concurrency, args.think / 1000)
+        results.append(result)
+        print_row(result)
+
+    point = saturation_point(results, args.slo)
+    print()
+    print(f"Saturation at about {point} concurrent users" if point else "No saturation within the tested levels")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=4)
+    server.shutdown()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the %records DM flow")
+    parser.add_argument("--levels", default="10,50,100,250,500,1000", type=lambda v: [int(level) for level in v.split(",")], help="concurrent users per run, comma separated")
+    parser.add_argument("--latency", default=20.0, type=float, help="milliseconds the Cloudflare stand-in waits per request")
+    parser.add_argument("--think", default=0.0, type=float, help="up to this many milliseconds between a user's messages")
+    parser.add_argument("--slo", default=1000.0, type=float, help="p99 latency in milliseconds that counts as saturated")
+    parser.add_argument("--snapshot-users", default=100000, type=int, help="users in the snapshot format comparison, 0 skips it")
+    parser.add_argument("--embed-renders", default=10000, type=int, help="renders per embed template in the render timing, 0 skips it")
+    parser.add_argument("--gateway-messages", default=10000, type=int, help="guild messages in the gateway CPU and memory measurement, 0 skips it")
+    parser.add_argument("--json", help="also write the results to this file")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,87 @@
+import asyncio
+import functools
+import importlib
+import inspect
+import json
+import os
+import sys
+import types
+
+import pytest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASE_DOMAIN = "example.test"
+
+
+@pytest.fixture(scope="session")
+def app(tmp_path_factory):
+    """The bot module, imported once in a scratch directory with a minimal config"""
+    workdir = tmp_path_factory.mktemp("bot")
+    with open(workdir / "config.json", "w") as f:
+        json.dump({"token": "test", "zone_id": "zone", "base_domain": BASE_DOMAIN}, f)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    os.environ["BOT_CONFIG"] = str(workdir / "config.json")
+    sys.path.insert(0, REPO)
+    try:
+        yield importlib.import_module("bot")
+    finally:
+        os.chdir(cwd)
+
+
+def run_async(test):
+    """Run an async test on a fresh event loop, no pytest plugin needed"""
+    @functools.wraps(test)
+    def wrapper(*args, **kwargs):
+        return asyncio.run(test(*args, **kwargs))
+    return wrapper
+
+
+class FakeZone:
+    """Stands in for the Cloudflare zone, every call yields to the loop like the real threaded ones"""
+
+    def __init__(self):
+        self.records = []
+
+    async def get(self, path):
+        await asyncio.sleep(0.01)
+        return types.SimpleNamespace(status_code=200, text="", json=lambda: {"success": True, "result": list(self.records)})
+
+    async def request(self, method, path, json=None, **kwargs):
+        await asyncio.sleep(0.01)
+        if method == "PUT":
+            record_id = path.rsplit("/", 1)[1]
+            record = dict(json, id=record_id)
+            self.records = [record if r["id"] == record_id else r for r in self.records]
+        else:
+            record = dict(json, id=str(len(self.records) + 1))
+            self.records.append(record)
+        return types.SimpleNamespace(status_code=200, text="", json=lambda: {"success": True, "result": record})
+
+
+class FakeContext:
+    def __init__(self, user_id):
+        self.author = types.SimpleNamespace(id=user_id, avatar=None, __str__=lambda self: "tester")
+        self.guild = None
+        self.sent = []
+
+    async def send(self, embed=None, **kwargs):
+        self.sent.append(embed)
+
+
+@pytest.fixture
+def zone(app, monkeypatch):
+    """A fresh default tenant with no users and a fake zone"""
+    fake = FakeZone()
+    monkeypatch.setattr(app, "cloudflare_get", fake.get)
+    monkeypatch.setattr(app, "cloudflare_request", fake.request)
+    monkeypatch.setattr(app.default_tenant, "users", app.UserStore())
+    monkeypatch.setattr(app.default_tenant, "record_counts", None)
+    monkeypatch.setattr(app, "hold_state", {"next_id": 1, "holds": {}, "approved": {}})
+    app.recent_creates.clear()
+    return fake
+
+
+def create_subdomain(app):
+    """%create_subdomain without its rate limit and Cloudflare slot"""
+    return inspect.unwrap(app.create_subdomain.callback)
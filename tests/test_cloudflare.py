@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+
+from conftest import run_async
+
+
+@pytest.fixture
+def breakers(app, monkeypatch):
+    """Fresh circuit breakers that open after one failure and allow a trial straight away"""
+    monkeypatch.setattr(app, "cloudflare_breakers", {})
+    monkeypatch.setattr(app, "CIRCUIT_FAILURES", 1)
+    monkeypatch.setattr(app, "CIRCUIT_RESET", 0)
+    return app.cloudflare_breakers
+
+
+def failing(app):
+    def request(*args, **kwargs):
+        raise app.requests.ConnectionError("unreachable")
+    return request
+
+
+@run_async
+async def test_cancelled_trial_lets_the_next_request_try(app, breakers, monkeypatch):
+    monkeypatch.setattr(app.requests, "request", failing(app))
+    with pytest.raises(app.CloudflareUnavailable):
+        await app.cloudflare_request("GET", "/zones")
+    assert app.cloudflare_breaker().opened_at is not None
+
+    monkeypatch.setattr(app.requests, "request", lambda *args, **kwargs: None)
+    trial = asyncio.ensure_future(app.cloudflare_request("GET", "/zones"))
+    await asyncio.sleep(0)
+    # Cancelled while it waits for the worker thread, like a command timeout or a cancelled job
+    trial.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await trial
+
+    assert app.cloudflare_breaker().allow()
+
+
+@run_async
+async def test_trial_failing_without_an_answer_lets_the_next_request_try(app, breakers, monkeypatch):
+    monkeypatch.setattr(app.requests, "request", failing(app))
+    with pytest.raises(app.CloudflareUnavailable):
+        await app.cloudflare_request("GET", "/zones")
+
+    def broken(*args, **kwargs):
+        raise TypeError("bad arguments")
+    monkeypatch.setattr(app.requests, "request", broken)
+    with pytest.raises(TypeError):
+        await app.cloudflare_request("GET", "/zones")
+
+    assert app.cloudflare_breaker().allow()
@@ -0,0 +1,190 @@
+import asyncio
+import struct
+
+import pytest
+
+from conftest import BASE_DOMAIN, run_async
+
+
+def encode_name(name):
+    return b"".join(bytes([len(label)]) + label.encode() for label in name.split(".")) + b"\x00"
+
+
+def header(query_id, flags=0x8400, answers=0):
+    return struct.pack("!HHHHHH", query_id, flags, 1, answers, 0, 0)
+
+
+def answer(record_type, ttl, rdata, name=b"\xc0\x0c"):
+    """An answer record, named with a pointer back to the question by default"""
+    return name + struct.pack("!HHIH", record_type, 1, ttl, len(rdata)) + rdata
+
+
+class Responder(asyncio.DatagramProtocol):
+    """A nameserver on localhost that replies with whatever reply(query) builds"""
+
+    def __init__(self, reply):
+        self.reply = reply
+        self.queries = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.queries.append(data)
+        self.transport.sendto(self.reply(data), addr)
+
+
+async def serve(reply, tcp_reply=None):
+    """Start a responder on UDP (and TCP if tcp_reply is given) on the same port, returns (server, responder, close)"""
+    loop = asyncio.get_running_loop()
+    transport, responder = await loop.create_datagram_endpoint(lambda: Responder(reply), local_addr=("127.0.0.1", 0))
+    address = transport.get_extra_info("sockname")[:2]
+    tcp_server = None
+    if tcp_reply is not None:
+        async def handle(reader, writer):
+            length = struct.unpack("!H", await reader.readexactly(2))[0]
+            response = tcp_reply(await reader.readexactly(length))
+            writer.write(struct.pack("!H", len(response)) + response)
+            await writer.drain()
+            writer.close()
+        tcp_server = await asyncio.start_server(handle, *address)
+
+    def close():
+        transport.close()
+        if tcp_server is not None:
+            tcp_server.close()
+    return address, responder, close
+
+
+def question(query):
+    """The query id and the raw question section of a query"""
+    return query[:2], query[12:]
+
+
+@pytest.fixture(autouse=True)
+def clear_cache(app):
+    app.dns_cache.clear()
+
+
+def test_parse_follows_compression_pointers(app):
+    name = f"www.{BASE_DOMAIN}"
+    packet = header(7, answers=3) + encode_name(name) + struct.pack("!HH", 5, 1)
+    # CNAME to a name that ends in a pointer to the question's parent domain
+    packet += answer(5, 300, b"\x03cdn\xc0\x10")
+    packet += answer(15, 60, struct.pack("!H", 10) + b"\x04mail\xc0\x10")
+    packet += answer(33, 60, struct.pack("!HHH", 1, 2, 25565) + b"\xc0\x0c")
+    rcode, truncated, answers = app.parse_dns_response(packet, 7)
+    assert rcode == 0 and not truncated
+    assert answers == [
+        ("CNAME", 300, f"cdn.{BASE_DOMAIN}"),
+        ("MX", 60, f"10 mail.{BASE_DOMAIN}"),
+        ("SRV", 60, f"1 2 25565 {name}"),
+    ]
+
+
+def test_parse_rejects_pointer_loops(app):
+    packet = header(7, answers=1) + encode_name(BASE_DOMAIN) + struct.pack("!HH", 1, 1)
+    # The answer's name points at itself
+    packet += answer(1, 60, b"\x01\x02\x03\x04", name=struct.pack("!H", 0xC000 | len(packet)))
+    with pytest.raises(ValueError):
+        app.parse_dns_response(packet, 7)
+
+
+@pytest.mark.parametrize("cut", [4, 20, -3, -1])
+def test_parse_rejects_cut_short_packets(app, cut):
+    packet = header(7, answers=1) + encode_name(BASE_DOMAIN) + struct.pack("!HH", 16, 1) + answer(16, 60, b"\x05hello")
+    with pytest.raises(ValueError):
+        app.parse_dns_response(packet[:cut], 7)
+
+
+def test_parse_reports_the_truncated_flag_and_nxdomain(app):
+    packet = header(7, flags=0x8603) + encode_name(BASE_DOMAIN) + struct.pack("!HH", 1, 1)
+    assert app.parse_dns_response(packet, 7) == (3, True, [])
+
+
+def test_parse_rejects_other_query_ids(app):
+    with pytest.raises(ValueError):
+        app.parse_dns_response(header(8) + encode_name(BASE_DOMAIN) + struct.pack("!HH", 1, 1), 7)
+
+
+@run_async
+async def test_query_returns_answers_and_caches_them(app):
+    def reply(query):
+        query_id, rest = question(query)
+        return query_id + header(0, answers=2)[2:] + rest + answer(1, 300, bytes([192, 0, 2, 1])) + answer(5, 300, b"\xc0\x0c")
+
+    server, responder, close = await serve(reply)
+    try:
+        assert await app.dns_query(server, f"foo.{BASE_DOMAIN}", "A") == [("A", 300, "192.0.2.1")]
+        assert await app.dns_query(server, f"FOO.{BASE_DOMAIN}", "A") == [("A", 300, "192.0.2.1")]
+    finally:
+        close()
+    assert len(responder.queries) == 1
+
+
+@run_async
+async def test_query_caches_nxdomain_as_empty(app):
+    def reply(query):
+        query_id, rest = question(query)
+        return query_id + header(0, flags=0x8403)[2:] + rest
+
+    server, responder, close = await serve(reply)
+    try:
+        assert await app.dns_query(server, f"missing.{BASE_DOMAIN}", "TXT") == []
+        assert await app.dns_query(server, f"missing.{BASE_DOMAIN}", "TXT") == []
+    finally:
+        close()
+    assert len(responder.queries) == 1
+    assert app.dns_cache[(server, f"missing.{BASE_DOMAIN}", "TXT")][0] > 0
+
+
+@run_async
+async def test_query_retries_truncated_answers_over_tcp(app):
+    def udp_reply(query):
+        query_id, rest = question(query)
+        return query_id + header(0, flags=0x8600)[2:] + rest
+
+    def tcp_reply(query):
+        query_id, rest = question(query)
+        text = b"x" * 200
+        answers = b"".join(answer(16, 60, bytes([len(text)]) + text) for _ in range(3))
+        return query_id + header(0, answers=3)[2:] + rest + answers
+
+    server, _, close = await serve(udp_reply, tcp_reply)
+    try:
+        answers = await app.dns_query(server, f"big.{BASE_DOMAIN}", "TXT")
+    finally:
+        close()
+    assert answers == [("TXT", 60, "x" * 200)] * 3
+
+
+@run_async
+async def test_query_raises_on_server_errors(app):
+    def reply(query):
+        query_id, rest = question(query)
+        return query_id + header(0, flags=0x8402)[2:] + rest
+
+    server, _, close = await serve(reply)
+    try:
+        with pytest.raises(RuntimeError):
+            await app.dns_query(server, f"foo.{BASE_DOMAIN}", "A")
+    finally:
+        close()
+    assert not app.dns_cache
+
+
+@run_async
+async def test_cache_drops_least_recently_used(app, monkeypatch):
+    def reply(query):
+        query_id, rest = question(query)
+        return query_id + header(0, answers=1)[2:] + rest + answer(1, 300, bytes([192, 0, 2, 1]))
+
+    monkeypatch.setattr(app, "DNS_CACHE_SIZE", 2)
+    server, responder, close = await serve(reply)
+    try:
+        for name in ("a", "b", "a", "c", "a"):
+            await app.dns_query(server, f"{name}.{BASE_DOMAIN}", "A")
+    finally:
+        close()
+    assert [key[1] for key in app.dns_cache] == [f"c.{BASE_DOMAIN}", f"a.{BASE_DOMAIN}"]
+    assert len(responder.queries) == 3
@@ -0,0 +1,77 @@
+import json
+import time
+
+import pytest
+
+from conftest import FakeContext, create_subdomain, run_async
+
+
+@pytest.mark.parametrize("name, reserved", [
+    ("paypal", "paypal"),
+    ("paypa1", "paypal"),
+    ("paypal-login", "paypal"),
+    ("g00gle", "google"),
+    ("myproject", None),
+    ("rapid", None),
+])
+def test_reserved_names_and_lookalikes(app, name, reserved):
+    assert app.reserved_match(name) == reserved
+
+
+def test_near_duplicates_of_the_requesters_own_names_are_flagged(app, zone):
+    for name in ("shop1", "shop2", "shop3"):
+        app.users.add_subdomain("1", name)
+
+    assert any("near-duplicate" in reason for reason in app.squat_reasons("1", "shop4"))
+    # Another user's names don't count unless they were just asked for
+    assert app.squat_reasons("2", "shop5") == []
+
+
+def test_bursts_of_requests_are_flagged(app, zone):
+    count, _ = app.config.squat_burst
+    reasons = [app.squat_reasons("1", f"name{i}x") for i in range(count + 1)]
+
+    assert all(not r for r in reasons[:count])
+    assert any("create requests" in reason for reason in reasons[count])
+
+
+def test_asking_again_reuses_the_open_hold(app, zone):
+    first = app.hold_request("1", "paypal", ["matches the reserved name `paypal`"])
+    assert app.hold_request("1", "paypal", ["matches the reserved name `paypal`"]) == first
+    assert app.hold_request("2", "paypal", ["matches the reserved name `paypal`"]) != first
+    assert len(app.hold_state["holds"]) == 2
+
+
+@run_async
+async def test_approval_is_used_up_by_the_create(app, zone):
+    app.users.get_or_create("1").credits = 100
+    ctx = FakeContext(1)
+    await create_subdomain(app)(ctx, "paypal")
+    assert ctx.sent[-1].title.startswith("⏸️")
+    assert not zone.records
+
+    app.hold_state["approved"][app.tenant().scoped("1:paypal")] = time.time()
+    await create_subdomain(app)(ctx, "paypal")
+    assert ctx.sent[-1].title.startswith("✅")
+    assert not app.is_hold_approved("1", "paypal")
+    assert app.hold_state["approved"] == {}
+
+
+def test_approvals_expire(app, zone):
+    key = app.tenant().scoped("1:paypal")
+    app.hold_state["approved"][key] = time.time() - app.HOLD_APPROVAL_TTL - 1
+    assert not app.is_hold_approved("1", "paypal")
+
+    app.hold_state["approved"]["2:other"] = time.time() - app.HOLD_APPROVAL_TTL - 1
+    app.consume_hold_approval("3", "unrelated")
+    assert app.hold_state["approved"] == {}
+
+
+def test_approvals_without_a_time_are_loaded_as_given_now(app):
+    with open(app.HOLDS_FILE, "w") as f:
+        json.dump({"next_id": 2, "holds": {}, "approved": ["1:paypal"]}, f)
+
+    state = app.load_holds()
+
+    assert list(state["approved"]) == ["1:paypal"]
+    assert state["approved"]["1:paypal"] > time.time() - 60
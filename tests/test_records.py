@@ -0,0 +1,162 @@
+import asyncio
+import json
+
+import pytest
+
+from conftest import FakeContext, create_subdomain, run_async
+
+
+@run_async
+async def test_concurrent_creates_of_one_name_only_create_it_once(app, zone):
+    app.users.get_or_create("1").credits = 10
+    app.users.get_or_create("2").credits = 10
+    first, second = FakeContext(1), FakeContext(2)
+    await asyncio.gather(create_subdomain(app)(first, "shared"), create_subdomain(app)(second, "shared"))
+
+    assert len(zone.records) == 1
+    titles = [ctx.sent[-1].title for ctx in (first, second)]
+    assert sum(title.startswith("✅") for title in titles) == 1
+    owner = app.users.owner_of("shared")
+    other = "2" if owner == "1" else "1"
+    assert app.users.get(other).credits == 10 and "shared" not in app.users.get(other).subdomains
+    assert not app.claimed_subdomains
+
+
+@run_async
+async def test_concurrent_creates_cannot_spend_the_same_credits(app, zone, monkeypatch):
+    monkeypatch.setattr(app.config, "subdomain_price", 10)
+    app.users.get_or_create("1").credits = 10
+    first, second = FakeContext(1), FakeContext(1)
+    await asyncio.gather(create_subdomain(app)(first, "alpha"), create_subdomain(app)(second, "beta"))
+
+    assert len(zone.records) == 1
+    assert app.users.get("1").credits == 0
+    assert len(app.users.get("1").subdomains) == 1
+
+
+@run_async
+async def test_failed_create_refunds_and_releases_the_name(app, zone, monkeypatch):
+    monkeypatch.setattr(app.config, "subdomain_price", 5)
+    app.users.get_or_create("1").credits = 5
+
+    async def unavailable(*args, **kwargs):
+        raise app.CloudflareUnavailable("down")
+    monkeypatch.setattr(app, "cloudflare_request", unavailable)
+    await create_subdomain(app)(FakeContext(1), "alpha")
+
+    assert app.users.get("1").credits == 5
+    assert app.users.owner_of("alpha") is None
+    assert not app.claimed_subdomains and not app.pending_subdomains
+
+
+@run_async
+async def test_concurrent_record_creates_cannot_spend_the_same_credits(app, zone, monkeypatch):
+    monkeypatch.setattr(app.config, "record_prices", {"TXT": 3})
+    app.users.add_subdomain("1", "alpha")
+    app.users.get("1").credits = 3
+    record = {"type": "TXT", "name": f"alpha.{app.tenant().base_domain}", "content": "x", "ttl": 1}
+    results = await asyncio.gather(
+        app.create_user_record("1", "alpha", dict(record)),
+        app.create_user_record("1", "alpha", dict(record)),
+        return_exceptions=True
+    )
+
+    assert sum(isinstance(result, app.RecordChangeError) for result in results) == 1
+    assert app.users.get("1").credits == 0
+    assert len(zone.records) == 1
+
+
+class FakeRequest(dict):
+    def __init__(self, user_id, body, **match_info):
+        super().__init__(user_id=user_id)
+        self.body = body
+        self.match_info = match_info
+
+    async def json(self):
+        return self.body
+
+
+@run_async
+async def test_api_updates_srv_records_and_returns_their_fields(app, zone, monkeypatch):
+    audited = []
+    monkeypatch.setattr(app, "audit", lambda action, actor, targets=(), **details: audited.append((action, details)))
+    app.users.add_subdomain("1", "alpha")
+    name = f"_sip._tcp.alpha.{app.tenant().base_domain}"
+    zone.records.append({"id": "7", "type": "SRV", "name": name, "content": "10 5 5060 old.example.com", "ttl": 1, "proxied": False})
+
+    response = await app.api_update_record(FakeRequest("1", {"content": "10 5 5061 sip.example.com"}, name="alpha", record_id="7"))
+
+    assert response.status == 200
+    assert json.loads(response.body)["data"] == {"priority": 10, "weight": 5, "port": 5061, "target": "sip.example.com"}
+    assert audited == [("edit_record", {"type": "SRV", "name": name, "old": "10 5 5060 old.example.com", "new": "10 5 5061 sip.example.com", "via": "api"})]
+
+
+def txt_record(app, subdomain, host="@"):
+    name = f"{subdomain}.{app.tenant().base_domain}" if host == "@" else f"{host}.{subdomain}.{app.tenant().base_domain}"
+    return {"type": "TXT", "name": name, "content": "x", "ttl": 1}
+
+
+def test_quota_total_is_case_insensitive(app):
+    assert app.parse_quotas({"Total": 5, "txt": 2}) == {"total": 5, "TXT": 2}
+
+
+@run_async
+async def test_zone_is_not_fetched_without_quotas(app, zone, monkeypatch):
+    async def fetch(path):
+        raise AssertionError("the zone was fetched")
+    monkeypatch.setattr(app, "cloudflare_get", fetch)
+    await app.ensure_record_index()
+    assert app.tenant().record_counts is None
+
+
+@run_async
+async def test_user_quota_counts_records_across_subdomains(app, zone, monkeypatch):
+    monkeypatch.setattr(app.config, "user_record_quota", {"total": 3})
+    app.users.add_subdomain("1", "alpha")
+    app.users.add_subdomain("1", "beta")
+    zone.records += [dict(txt_record(app, "alpha"), id="a"), dict(txt_record(app, "beta"), id="b")]
+
+    await app.create_user_record("1", "alpha", txt_record(app, "alpha", "www"))
+    with pytest.raises(app.RecordChangeError) as refused:
+        await app.create_user_record("1", "beta", txt_record(app, "beta", "www"))
+
+    assert refused.value.status == 403
+    assert len(zone.records) == 3
+
+
+@run_async
+async def test_subdomain_quota_limits_each_type(app, zone, monkeypatch):
+    monkeypatch.setattr(app.config, "subdomain_record_quota", {"TXT": 1})
+    app.users.add_subdomain("1", "alpha")
+    app.users.add_subdomain("1", "beta")
+
+    await app.create_user_record("1", "alpha", txt_record(app, "alpha"))
+    with pytest.raises(app.RecordChangeError):
+        await app.create_user_record("1", "alpha", txt_record(app, "alpha", "www"))
+    await app.create_user_record("1", "beta", txt_record(app, "beta"))
+
+
+@run_async
+async def test_concurrent_creates_cannot_overshoot_a_quota(app, zone, monkeypatch):
+    monkeypatch.setattr(app.config, "subdomain_record_quota", {"total": 2})
+    app.users.add_subdomain("1", "alpha")
+    results = await asyncio.gather(
+        *(app.create_user_record("1", "alpha", txt_record(app, "alpha", f"r{i}")) for i in range(4)),
+        return_exceptions=True
+    )
+
+    assert sum(not isinstance(result, Exception) for result in results) == 2
+    assert len(zone.records) == 2
+    assert app.subdomain_record_counts("alpha") == {"TXT": 2}
+
+
+@run_async
+async def test_subdomains_being_created_count_toward_the_user_quota(app, zone, monkeypatch):
+    monkeypatch.setattr(app.config, "user_record_quota", {"total": 1})
+    app.users.get_or_create("1").credits = 100
+    first, second = FakeContext(1), FakeContext(1)
+    await asyncio.gather(create_subdomain(app)(first, "alpha"), create_subdomain(app)(second, "beta"))
+
+    assert len(zone.records) == 1
+    assert len(app.users.get("1").subdomains) == 1
+    assert not app.pending_subdomains
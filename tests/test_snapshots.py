@@ -0,0 +1,74 @@
+import json
+
+import pytest
+
+from conftest import run_async
+
+
+@pytest.fixture
+def data_file(app, tmp_path, monkeypatch):
+    path = tmp_path / "users.json"
+    monkeypatch.setattr(app.config, "data_file", str(path))
+    monkeypatch.setattr(app, "users_load_error", None)
+    monkeypatch.setattr(app.default_tenant, "users", None)
+    return path
+
+
+def sample_users(app):
+    return app.UserStore({
+        "1": (5, ["alpha", "beta"], {"alpha": 1700000000}),
+        "2": (0, ["gamma"], None),
+        "3": (12, [], None),
+    })
+
+
+def formats(app):
+    return [name for name in app.SNAPSHOT_FORMATS if name != "msgpack" or app.msgpack is not None]
+
+
+def test_snapshots_round_trip(app, data_file):
+    for format_name in formats(app):
+        users = sample_users(app)
+        users.get("3").credits = 20
+        app.write_snapshot(users, str(data_file), format_name)
+
+        loaded = app.load_data()
+
+        assert sorted(loaded.rows()) == sorted(users.rows())
+        assert loaded.owner_of("beta") == "1"
+
+
+def test_version_1_files_are_read(app, data_file):
+    with open(data_file, "w") as f:
+        json.dump({"1": {"credits": 5, "subdomains": ["alpha"], "renewals": {"alpha": 1700000000}}}, f, indent=4)
+
+    loaded = app.load_data()
+
+    assert list(loaded.rows()) == [["1", 5, ["alpha"], {"alpha": 1700000000}]]
+
+
+@pytest.mark.parametrize("content", [
+    b'{"snapshot":99,"format":"json","users":0}\n',
+    b'{"1": {"credits": 5, ',
+    b'{"snapshot":2,"format":"json","users":1}\n["1",5]\n',
+    b"\x93\x01\x02\x03",
+])
+def test_unreadable_files_are_refused(app, data_file, content):
+    data_file.write_bytes(content)
+    with pytest.raises(RuntimeError):
+        app.load_data()
+    assert data_file.read_bytes() == content
+
+
+@run_async
+async def test_failed_load_stops_saves(app, data_file, monkeypatch):
+    for name in ("start_job_workers", "start_renewals", "start_acme_sweeper", "start_squat_detection", "start_sweeper"):
+        monkeypatch.setattr(app, name, lambda: None)
+    content = b'{"snapshot":99,"format":"json","users":0}\n'
+    data_file.write_bytes(content)
+
+    await app.load_users_in_background()
+    app.save_data(sample_users(app))
+
+    assert app.users_load_error is not None
+    assert data_file.read_bytes() == content
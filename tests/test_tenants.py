@@ -0,0 +1,54 @@
+import types
+
+import pytest
+
+from conftest import run_async
+
+
+@pytest.fixture
+def guild_tenant(app, monkeypatch):
+    """Guild 5 as a tenant of its own"""
+    tenant = app.Tenant("5")
+    monkeypatch.setitem(app.tenants, "5", tenant)
+    return tenant
+
+
+def context(guild_id, administrator=True):
+    return types.SimpleNamespace(
+        guild=types.SimpleNamespace(id=guild_id),
+        author=types.SimpleNamespace(guild_permissions=types.SimpleNamespace(administrator=administrator))
+    )
+
+
+@run_async
+async def test_breakers_are_kept_per_tenant(app, guild_tenant, monkeypatch):
+    monkeypatch.setattr(app, "cloudflare_breakers", {})
+
+    def unreachable(*args, **kwargs):
+        raise app.requests.ConnectionError("unreachable")
+    monkeypatch.setattr(app.requests, "request", unreachable)
+    with app.tenant_scope(guild_tenant):
+        for _ in range(app.CIRCUIT_FAILURES):
+            with pytest.raises(app.CloudflareUnavailable):
+                await app.cloudflare_request("GET", "/zones")
+        assert not app.cloudflare_breaker().available()
+
+    assert app.cloudflare_breaker().available()
+    assert app.cloudflare_breaker().allow()
+
+
+def test_guild_admins_manage_their_own_tenant(app, guild_tenant, monkeypatch):
+    monkeypatch.setattr(app.config, "admin_guild_id", None)
+    assert app.is_admin(context(5))
+    assert app.is_admin(context(7))
+    assert not app.is_admin(context(5, administrator=False))
+    assert app.is_bot_admin(context(7)) and not app.is_bot_admin(context(5))
+
+
+def test_admin_guild_alone_manages_the_default_tenant(app, guild_tenant, monkeypatch):
+    monkeypatch.setattr(app.config, "admin_guild_id", 1)
+    assert app.is_admin(context(1))
+    assert not app.is_admin(context(7))
+    # Tenant guilds keep managing themselves
+    assert app.is_admin(context(5))
+    assert app.is_bot_admin(context(1)) and not app.is_bot_admin(context(5))